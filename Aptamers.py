@@ -45,6 +45,21 @@ class Aptamers:
             sn = sn // self.La
         return sl[::-1]
 
+    # Vectorized pseudoAptamerGenerator over an array of sequence indices
+    # Indices that do not fit in 64 bits are converted one by one, and negative indices
+    # (tail bins, see utils.tail_key) give a sequence of N's
+    def pseudoAptamerGenerator_batch(self, seqIdxs):
+        seqIdxs = np.asarray(seqIdxs)
+        if self.La**self.seqLength > 2**64 or seqIdxs.dtype == object:
+            return [self.pseudoAptamerGenerator(sn) if sn >= 0 else "N"*self.seqLength for sn in seqIdxs]
+        tail = seqIdxs < 0 if seqIdxs.dtype.kind == 'i' else np.zeros(len(seqIdxs), dtype=bool)
+        seqIdxs = np.where(tail, 0, seqIdxs).astype(np.uint64)
+        powers = np.uint64(self.La)**np.arange(self.seqLength-1, -1, -1, dtype=np.uint64)
+        digits = (seqIdxs[:, None] // powers) % np.uint64(self.La)
+        chars = np.frombuffer(self.alphabetSet.encode(), dtype=np.uint8)[digits.astype(np.intp)]
+        chars[tail] = ord("N")
+        return np.ascontiguousarray(chars).view("S{}".format(self.seqLength)).ravel().astype(str).tolist()
+
     # method to get seqArray given seq index
     def get_seqArray(self, seqIdx):
         seqArray = np.zeros(self.seqLength)
@@ -113,9 +128,16 @@ class Aptamers:
         print("first generation completed")
         return initialLibrary
 
-###NEED TO MODIFY TO ALLOW MULTIPLE OPTIMUM APTAMERS
-
+    # This chooses aptamerNum random reference aptamers and returns them as a comma
+    # separated string (see utils.references), with the number of possible sequences
     def optimumAptamerGenerator(self, aptamerNum):
+        seqs = []
+        for aptNum in range(aptamerNum):
+            seq, initialSeqNum = self.optimumAptamerGenerator_()
+            seqs.append(seq)
+        return ",".join(seqs), initialSeqNum
+
+    def optimumAptamerGenerator_(self):
         seq = str()  # initialize seq
         seqArray = np.zeros(self.seqLength)
         initialSeqNum = self.La**(self.seqLength)
@@ -1,33 +1,116 @@
-import RNA
-
 import numpy as np
 
+import folding
+import instrument
+import kernels
+
 
 class Distance:
-    def __init__(self, bias=0.1):
+    # backend is the name of the fold backend (see folding.py)
+    def __init__(self, bias=0.1, cache=None, backend="vienna"):
         # maximum absolute value of bias
         self.bias = bias
+        # optional FoldCache storing structures and fold-based distances
+        self.cache = cache
+        self.folder = folding.create(backend)
+
+    # This function folds a sequence and returns its secondary structure
+    # All folds go through here so that they are counted by the instrumentation
+    # and looked up in the fold cache if there is one (for exact fold backends only)
+    # Input: str()
+    # Output: str()
+    def fold(self, seq):
+        if self.cache is not None and self.folder.exact:
+            struct = self.cache.get_fold(seq)
+            if struct is not None:
+                instrument.count("fold_cache_hits")
+                return struct
+            instrument.count("fold_cache_misses")
+        instrument.count("folds")
+        with instrument.timed("fold_time"):
+            struct = self.folder.fold(seq)
+        if self.cache is not None and self.folder.exact:
+            self.cache.put_fold(seq, struct)
+        return struct
+
+    # This function folds a list of sequences and returns their secondary structures,
+    # all at once for the backends that fold batches of sequences
+    # Input: list(str())
+    # Output: list(str())
+    def fold_batch(self, seqs):
+        if self.folder.exact:
+            return [self.fold(seq) for seq in seqs]
+        instrument.count("folds", len(seqs))
+        with instrument.timed("fold_time"):
+            return self.folder.fold_batch(seqs)
+
+    # This function returns the free energy (kcal/mol) of a sequence: the minimum free
+    # energy of its fold (mode mfe), the free energy of its ensemble of structures (mode
+    # ensemble), or, with a target sequence, the minimum free energy of its duplex with
+    # the target
+    # Input: str(), str(), str(), float()
+    # Output: float()
+    def energy(self, seq, mode="mfe", target=None, temperature=37.0):
+        instrument.count("energies")
+        with instrument.timed("energy_time"):
+            return self.folder.energy(seq, mode, target, temperature)
+
+    # This function returns the key under which the distances of a metric are stored in
+    # the fold cache: those computed with approximate structures are kept apart
+    # Input: str()
+    # Output: str()
+    def cache_key(self, key):
+        if self.folder.exact:
+            return key
+        return "{}:{}".format(self.folder.name, key)
+
+    # This function wraps a distance function of a single sequence so that its values
+    # are looked up in and stored to the fold cache under the given metric key.
+    # The key must identify both the metric and the reference.
+    # Input: str(), function(str())
+    # Output: function(str())
+    def cached(self, key, func):
+        if self.cache is None:
+            return func
+        key = self.cache_key(key)
+
+        def cached_func(seq):
+            d = self.cache.get_dist(key, seq)
+            if d is not None:
+                instrument.count("dist_cache_hits")
+                return d
+            instrument.count("dist_cache_misses")
+            d = func(seq)
+            self.cache.put_dist(key, seq, d)
+            return d
+        return cached_func
+
+    # This function computes the distances of a list of sequences with func, which takes
+    # a list of sequences, looking them up in and storing them to the fold cache under the
+    # given metric key (see cached)
+    # Input: str(), list(str()), function(list(str()))
+    # Output: list()
+    def cached_batch(self, key, seqs, func):
+        if self.cache is None:
+            return func(seqs)
+        key = self.cache_key(key)
+        values = [self.cache.get_dist(key, seq) for seq in seqs]
+        missing = [n for n, d in enumerate(values) if d is None]
+        instrument.count("dist_cache_hits", len(seqs)-len(missing))
+        instrument.count("dist_cache_misses", len(missing))
+        if len(missing) > 0:
+            for n, d in zip(missing, func([seqs[n] for n in missing])):
+                self.cache.put_dist(key, seqs[n], d)
+                values[n] = d
+        return values
+
     # This function takes the sequences of two loop regions and returns
     # their Lavenshtein distance
     # Input: str(), str()
     # Output: int()
     def lavenshtein_func(self, loop1, loop2):
-        # if statement for switching loops
-        if len(loop1) < len(loop2):
-            return self.lavenshtein_func(loop2, loop1)
-        if len(loop2) == 0:
-            return len(loop1)
-        # separate individual nucleotides in each loop
-        loop1 = np.array(tuple(loop1))
-        loop2 = np.array(tuple(loop2))
-        prev_row = np.arange(loop2.size + 1)
-        for nt in loop1:
-            curr_row = prev_row + 1
-            curr_row[1:] = np.minimum(curr_row[1:], np.add(prev_row[:-1], loop2 != nt))
-            curr_row[1:] = np.minimum(curr_row[1:], curr_row[0:-1] + 1)
-            prev_row = curr_row
-        loop2_dist = prev_row[-1]
-        return loop2_dist
+        return kernels.levenshtein(np.frombuffer(loop1.encode(), dtype=np.uint8),
+                                   np.frombuffer(loop2.encode(), dtype=np.uint8))
 
     # This function takes two sequences of equal length and returns
     # their Hamming distance
@@ -41,23 +124,121 @@ class Distance:
                 s += 1
         return s
 
+    # This function takes a sequence and a list of sequences of the same length and
+    # returns the array of their Hamming distances, computed in a single vectorized pass
+    # Input: str(), list(str())
+    # Output: np.array(int)
+    def hamming_batch(self, str1, strs):
+        L = len(str1)
+        if len(strs) == 0:
+            return np.zeros(0, dtype=int)
+        ref = np.frombuffer(str1.encode(), dtype=np.uint8)
+        seqs = np.frombuffer("".join(strs).encode(), dtype=np.uint8)
+        assert len(seqs) == L*len(strs)
+        return (seqs.reshape(-1, L) != ref).sum(axis=1)
+
+    # This function takes a list of K reference sequences and a list of N sequences of the
+    # same length and returns the N x K matrix of their Hamming distances.
+    # With several references the sequences are one-hot encoded and the numbers of matching
+    # positions obtained as matrix products (one per letter), chunkSize sequences at a time,
+    # so that the cost barely depends on K
+    # Input: list(str()), list(str())
+    # Output: np.array(int)
+    def hamming_matrix(self, refs, strs, chunkSize=2**16):
+        L = len(refs[0])
+        if len(strs) == 0:
+            return np.zeros((0, len(refs)), dtype=int)
+        seqs = np.frombuffer("".join(strs).encode(), dtype=np.uint8)
+        assert len(seqs) == L*len(strs)
+        seqs = seqs.reshape(-1, L)
+        if len(refs) == 1:
+            return (seqs != np.frombuffer(refs[0].encode(), dtype=np.uint8)).sum(axis=1)[:, None]
+        refs = np.frombuffer("".join(refs).encode(), dtype=np.uint8).reshape(-1, L)
+        dists = np.zeros((len(seqs), len(refs)), dtype=int)
+        for i in range(0, len(seqs), chunkSize):
+            chunk = seqs[i:i+chunkSize]
+            matches = np.zeros((len(chunk), len(refs)), dtype=np.float32)
+            # one-hot encoding, one letter of the references at a time
+            for letter in np.unique(refs):
+                matches += (chunk == letter).astype(np.float32) @ (refs == letter).T.astype(np.float32)
+            dists[i:i+chunkSize] = L - np.rint(matches).astype(int)
+        return dists
+
+    # This function takes a list of reference sequences and a sequence and returns
+    # the Hamming distance to the nearest reference
+    # Input: list(str()), str()
+    # Output: int()
+    def hamming_min_func(self, refs, seq):
+        if len(refs) == 1:
+            return self.hamming_func(refs[0], seq)
+        return int(self.hamming_batch(seq, refs).min())
+
     # This function takes the secondary structure of the reference aptamer
     # and an arbitrary sequence and returns
     # their Base-pair distance
     # Input: str(), str()
     # Output: int()
     def bp_func(self, seq1_struct, seq2):
-        seq2_struct = RNA.fold(seq2)[0]
-        seq2_dist = RNA.bp_distance(seq1_struct, seq2_struct)
+        seq2_struct = self.fold(seq2)
+        seq2_dist = self.folder.bp_distance(seq1_struct, seq2_struct)
         return seq2_dist
 
+    # This function takes the secondary structures of the reference aptamers and an
+    # arbitrary sequence and returns the Base-pair distance to the nearest reference.
+    # The sequence is folded once whatever the number of references
+    # Input: list(str()), str()
+    # Output: int()
+    def bp_min_func(self, seq1_structs, seq2):
+        return self.bp_min_struct(seq1_structs, self.fold(seq2))
+
+    # This function is bp_min_func for a sequence of known secondary structure
+    # Input: list(str()), str()
+    # Output: int()
+    def bp_min_struct(self, seq1_structs, seq2_struct):
+        return min(self.folder.bp_distance(seq1_struct, seq2_struct) for seq1_struct in seq1_structs)
+
     # This function takes the sequence, loop region and secondary structure of the reference aptamer
     # and an arbitrary sequence and their lengths and returns the Loop-based distance
     # Input: str(), str(), str(), str(), int()
     # Output: int()
     def loop_func(self, seq1, seq1_struct, seq1_loop, seqLength, seq2):
         # compute secondary structure of sequence
-        seq2_struct = RNA.fold(seq2)[0]
+        seq2_struct = self.fold(seq2)
+        seq2_loop = self.seq_loop(seq2, seq2_struct, seqLength)
+        # compute Lavenshtein distance
+        seq2_loopDist = self.lavenshtein_func(seq1_loop, seq2_loop)
+        # compute BP distance
+        seq2_bpDist = self.folder.bp_distance(seq1_struct, seq2_struct)
+        # sum distances
+        seq2_dist = int(seq2_loopDist + seq2_bpDist)
+        return seq2_dist
+
+    # This function takes the sequences, secondary structures and loop regions of the
+    # reference aptamers and an arbitrary sequence and returns the Loop-based distance
+    # to the nearest reference. The sequence is folded and its loop found once
+    # Input: list(str()), list(str()), list(str()), int(), str()
+    # Output: int()
+    def loop_min_func(self, seqs1, seq1_structs, seq1_loops, seqLength, seq2):
+        return self.loop_min_struct(seqs1, seq1_structs, seq1_loops, seqLength, seq2, self.fold(seq2))
+
+    # This function is loop_min_func for a sequence of known secondary structure
+    # Input: list(str()), list(str()), list(str()), int(), str(), str()
+    # Output: int()
+    def loop_min_struct(self, seqs1, seq1_structs, seq1_loops, seqLength, seq2, seq2_struct):
+        return self.loop_min_loop(seq1_structs, seq1_loops, seq2_struct, self.seq_loop(seq2, seq2_struct, seqLength))
+
+    # This function is loop_min_struct for a sequence of known loop region
+    # Input: list(str()), list(str()), str(), str()
+    # Output: int()
+    def loop_min_loop(self, seq1_structs, seq1_loops, seq2_struct, seq2_loop):
+        return min(int(self.lavenshtein_func(seq1_loop, seq2_loop) + self.folder.bp_distance(seq1_struct, seq2_struct))
+                   for seq1_struct, seq1_loop in zip(seq1_structs, seq1_loops))
+
+    # This function takes a sequence, its secondary structure and its length and returns
+    # its loop region (the whole sequence when it has no loop)
+    # Input: str(), str(), int()
+    # Output: str()
+    def seq_loop(self, seq2, seq2_struct, seqLength):
         base = None
         baseIdx = 0
         # find a 3' paired nucleotide
@@ -82,13 +263,18 @@ class Distance:
                 base = seq2_struct[baseIdx-1]
             # grab loop
             seq2_loop = seq2[baseIdx:loop_end]
-        # compute Lavenshtein distance
-        seq2_loopDist = self.lavenshtein_func(seq1_loop, seq2_loop)
-        # compute BP distance
-        seq2_bpDist = RNA.bp_distance(seq1_struct, seq2_struct)
-        # sum distances
-        seq2_dist = int(seq2_loopDist + seq2_bpDist)
-        return seq2_dist
+        return seq2_loop
+
+    # This function returns the loop regions of sequences of the same length seqLength,
+    # given their secondary structures, as seq_loop (see kernels.loop_bounds)
+    # Input: list(str()), list(str()), int()
+    # Output: list(str())
+    def seq_loops(self, seqs, structs, seqLength):
+        if len(seqs) == 0:
+            return []
+        codes = np.frombuffer("".join(structs).encode(), dtype=np.uint8).reshape(len(structs), seqLength)
+        starts, stops = kernels.loop_bounds(codes, seqLength)
+        return [seq[start:stop] for seq, start, stop in zip(seqs, starts.tolist(), stops.tolist())]
 
     # This function takes the sequence, loop region and secondary structure of the reference aptamer
     # and an arbitrary sequence and their lengths and returns the component Lavenshtein and BP
@@ -96,7 +282,7 @@ class Distance:
     # Input: str(), str(), str(), str(), int()
     # Output: int(), int()
     def loop_components_func(self, seq1, seq1_struct, seq1_loop, seq2, seqLength):
-        seq2_struct = RNA.fold(seq2)[0]
+        seq2_struct = self.fold(seq2)
         base = None
         baseIdx = 0
         while(base != ')' and baseIdx < seqLength-1):
@@ -117,7 +303,7 @@ class Distance:
                 base = seq2_struct[baseIdx-1]
             seq2_loop = seq2[baseIdx:loop_end]
         seq2_loopDist = self.lavenshtein_func(seq1_loop, seq2_loop)
-        seq2_bpDist = RNA.bp_distance(seq1_struct, seq2_struct)
+        seq2_bpDist = self.folder.bp_distance(seq1_struct, seq2_struct)
         return seq2_loopDist, seq2_bpDist
 
     # This function takes a sequence and its length and computes its bias score
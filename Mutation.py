@@ -1,15 +1,20 @@
-import functools
-
-from scipy import stats
 import numpy as np
 from numpy import random
 from numpy.random import binomial as binom, poisson
 from math import factorial as fact
-from sklearn.preprocessing import normalize
+import metrics
 import utils
+import instrument
+
+# number of new mutants whose distances are computed at once
+Nbatch = 10**4
+
 
-# append ViennaRNA package to python path
-import RNA
+# This scales v so that its elements sum to one (in absolute value), leaving zero vectors
+# unchanged
+def normalize(v):
+    total = np.abs(v).sum()
+    return v/total if total > 0 else np.zeros(len(v))
 
 
 class Mutation(object):
@@ -21,7 +26,9 @@ class Mutation(object):
                  aptamerSeqs=None,
                  errorRate=0,
                  pcrCycleNum=0, pcrYld=0,
-                 seqPop=None):
+                 seqPop=None,
+                 poolBudget=0, tailThreshold=1,
+                 metricOptions=None):
         # initialize parameters
         self.dist = dist
         self.seqLength = seqLength
@@ -31,18 +38,25 @@ class Mutation(object):
         self.pcrCycleNum = pcrCycleNum
         self.pcrYld = pcrYld
         self.seqPop = seqPop
+        # maximum number of entries in the pool (0 for no limit), beyond which low abundance
+        # mutants are merged into tail bins (see utils.prune_pool)
+        self.poolBudget = poolBudget
+        self.tailThreshold = tailThreshold
+        # options of the distance metric (see metrics.create)
+        self.metricOptions = metricOptions or dict()
         # add error handling for invalid param values
 
     # This method computes the probability of drawing a seq after each pcr cycle
     def get_cycleNumber_probabilities(self, seqPop):
         # normalize each element so that they all sum to one (i.e. probability measures)
-        cycleNumProbs = normalize(seqPop.reshape(1, -1), norm='l1')[0]
+        cycleNumProbs = normalize(seqPop)
         return cycleNumProbs
 
     # This method computes the distribution of drawing seqs after the different pcr cycles
     def get_cycleNumber_distribution(self, seqPop):
+        from scipy import stats
         N = self.pcrCycleNum
-        cycleNumProbs = normalize(seqPop.reshape(1, -1), norm='l1')[0]
+        cycleNumProbs = normalize(seqPop)
         cycleVec = np.arange(N)
         # compute discrete distribution
         cycleNumDist = stats.discrete.rv_discrete(name='cycleNumDist',
@@ -87,6 +101,7 @@ class Mutation(object):
     # This distribution can be used to draw random numbers of mutations
     # The method is relatively slow but can be used when sequence count is small
     def get_mutation_distribution(self):
+        from scipy import stats
         L = self.seqLength
         N = self.pcrCycleNum
         e = self.errorRate
@@ -112,6 +127,7 @@ class Mutation(object):
     # These probabilities can used to approximated the fraction of sequences that will undergo
     # certain numbers of mutation, assuming sequence count is sufficiently large
     def get_mutation_distribution_original(self):
+        from scipy import stats
         L = self.seqLength
         e = self.errorRate
         mutNumProbs = np.zeros(L+1)
@@ -123,19 +139,24 @@ class Mutation(object):
                                     values=(mut_m, mutNumProbs))
         return mutDist
 
+    # This returns the distance metric (see metrics.py) prepared for the reference aptamers
+    def choose_metric(self, distname, aptamerSeqs):
+        return metrics.create(distname, self.dist, **self.metricOptions).prepare(aptamerSeqs)
+
+    # This returns the function giving the distance of a sequence to the nearest of the
+    # reference aptamers (see metrics.py)
     def choose_dist(self, distname, distance, aptamerSeqs):
-        # compute 2D structure of aptamer(s)
-        # find loop in 2D structure
-        if distname == "hamming":
-            return functools.partial(self.dist.hamming_func, aptamerSeqs)
-        if distname == "random":
-            return functools.partial(self.dist.nodist_func, aptamerSeqs)
-        aptamerSeqsStruct = RNA.fold(str(aptamerSeqs))[0]
-        if distname == "basepair":
-            return functools.partial(self.dist.bp_func, aptamerSeqsStruct)
-        aptamerLoop = utils.apt_loopFinder(aptamerSeqs, aptamerSeqsStruct, self.seqLength)
-        if distname == "loop":
-            return functools.partial(self.dist.loop_func, aptamerSeqs, aptamerSeqsStruct, aptamerLoop, self.seqLength)
+        return self.choose_metric(distname, aptamerSeqs).func()
+
+    # This sets the distances of the new mutants listed in pending (pairs of index and
+    # sequence), computed at once by the metric, and empties pending
+    def set_distances(self, amplfdSeqs, metric, pending):
+        if len(pending) == 0:
+            return
+        dists = metric.distances([seq for seqIdx, seq in pending])
+        for (seqIdx, seq), mutDist in zip(pending, dists.tolist()):
+            amplfdSeqs[seqIdx][1] = mutDist
+        del pending[:]
 
     # This method aims to carry out the mutations on the pool of sequences that are in
     # the given mutated pool. It also updates the counts of the wild-type sequence and their
@@ -143,6 +164,7 @@ class Mutation(object):
     def generate_mutants(self,
                          mutatedPool, amplfdSeqs,
                          aptamerSeqs, apt, distname):
+        from scipy import stats
         pcrCycleNum = self.pcrCycleNum
         pcrYld = self.pcrYld
         seqLength = self.seqLength
@@ -253,24 +275,45 @@ class Mutation(object):
         mutNumProbs = self.get_mutation_probabilities_original()
         # initialize distance class
         d = self.dist
-        md = self.choose_dist(distname, d, aptamerSeqs)
-        # save copy number
-        prevSeqs = [k for k in amplfdSeqs.keys()]
-        prevCopies = [v[0] for v in amplfdSeqs.values()]
+        metric = self.choose_metric(distname, aptamerSeqs)
+        # the distances of the new mutants are only used when the pool is pruned and in the
+        # next rounds, so they are computed in batches (see set_distances)
+        pending = []
+        # save copy number (as arrays for pools stored on disk)
+        if hasattr(amplfdSeqs, "arrays"):
+            prevSeqs, data = amplfdSeqs.arrays()
+            prevCopies = data[:, 0]
+        else:
+            prevSeqs = [k for k in amplfdSeqs.keys()]
+            prevCopies = [v[0] for v in amplfdSeqs.values()]
         Lc = len(prevCopies)
+        # the sequences of the previous pool are still to be mutated and are never pruned
+        prevSet = set(map(int, prevSeqs)) if self.poolBudget > 0 else ()
         # keep track of sequence count after each pcr cycle (except last one)
         seqPop = np.zeros(pcrCycleNum)
         # for each seq in the mutation pool
-        mutatedPool = np.zeros(self.seqLength, dtype=np.int)
-        for si, (seqIdx, sc) in enumerate(zip(prevSeqs, prevCopies)):
-            sn = sc
+        for si, (seqIdx, sc) in enumerate(zip(map(int, prevSeqs), prevCopies)):
+            sn = int(sc)
             # random PCR with bias using brute force
             for n in range(pcrCycleNum):
                 # sequence count after n cycles
                 seqPop[n] = sn
                 # amplify count using initial count, polymerase yield, and bias score
                 sn += int(binom(sn, min(0.99999, pcrYld+amplfdSeqs[seqIdx][2])))
-            amplfdSeqs[seqIdx][0] = sn
+            instrument.count("rng_draws", pcrCycleNum)
+            # add the amplified copies, keeping the mutant copies of other sequences that may
+            # have been added to this one already
+            utils.add_count(amplfdSeqs[seqIdx], sn - int(sc))
+            # tail bins are amplified but not mutated
+            if utils.is_tail(seqIdx):
+                continue
+            # keep the new mutants within the budget by merging them into tail bins. The
+            # sequences of the previous pool are not counted, as they cannot be pruned, and
+            # the new mutants are pruned down to the budget, so that the next prune is at
+            # least poolBudget new mutants away
+            if self.poolBudget > 0 and len(amplfdSeqs) - len(prevSet) > 2*self.poolBudget:
+                self.set_distances(amplfdSeqs, metric, pending)
+                utils.prune_pool(amplfdSeqs, len(prevSet) + self.poolBudget, self.tailThreshold, prevSet)
             # compute cycle number probabilities
             # grab probabilities to draw it after each pcr cycle
             cycleNumProbs = seqPop / seqPop.sum()
@@ -285,12 +328,15 @@ class Mutation(object):
                 # draw random mutNum from the mutation distribution for each seq copy
                 # poisson call returns mostly 0, should be optimisable
                 muts = poisson(self.errorRate*self.seqLength, int(np.sum(seqPop)))  # SLOW STEP
+                instrument.count("rng_draws", len(muts))
                 # remove all drawn numbers equal to zero
-                muts = muts[muts != 0]
+                muts = muts[(muts != 0) & (muts <= self.seqLength)]
                 # for each non-zero mutation number
+                # (index i of mutatedPool holds the copies with i+1 mutations, as above)
+                mutatedPool = np.zeros(self.seqLength, dtype=int)
                 for mutNum in muts:
                     # increment copy number to be mutated
-                    mutatedPool[mutNum] += 1
+                    mutatedPool[mutNum-1] += 1
 
             if mutatedPool.sum() == 0:
                 continue
@@ -304,6 +350,7 @@ class Mutation(object):
                     # compute a discrete distribution from probabilities
                     # draw random cycle numbers after which the sequences were drawn for mutation
                     cycleNums = random.choice(np.arange(pcrCycleNum), p=cycleNumProbs, size=mutFreq)
+                    instrument.count("rng_draws", mutFreq)
                     # generate the wild-type sequence string
                     wildTypeSeq = apt.pseudoAptamerGenerator(seqIdx)
                     # for each copy to be mutated
@@ -319,12 +366,14 @@ class Mutation(object):
                                          mutatedSeq[pos:]
                         # generate index of mutant based on string
                         mutatedSeqIdx = apt.pseudoAptamerIndexGenerator(mutatedSeq)
+                        instrument.count("mutants")
                         # if mutant not found in amplified pool
                         if mutatedSeqIdx not in amplfdSeqs:
                             # add seq and its info to the amplified pool
-                            mutDist = md(mutatedSeq)
                             mutBias = d.bias_func(mutatedSeq, self.seqLength)
-                            amplfdSeqs[mutatedSeqIdx] = np.array([1, mutDist, mutBias])
+                            amplfdSeqs[mutatedSeqIdx] = np.array([1, 0, mutBias])
+                            pending.append((mutatedSeqIdx, mutatedSeq))
+                            instrument.count("new_mutants")
                         wildTypeCount = 1
                         mutantCount = 1
                         # mutantNum = (1+pcrYld)**(pcrCycleNum - cycleNums[mut])
@@ -336,10 +385,23 @@ class Mutation(object):
                             # compute loss of count from wild-type
                             wildTypeCount += int(binom(wildTypeCount,
                                                  min(0.99999, pcrYld+amplfdSeqs[seqIdx][2])))
-                        # increment mutant seq count in amplified pool
-                        amplfdSeqs[mutatedSeqIdx][0] += mutantCount
+                        instrument.count("rng_draws", int(2*(mutNum+1+pcrCycleNum-cycleNums[mut])))
+                        # a mutation can give back the wild-type sequence, whose count then
+                        # changes by the difference of the two lineages
+                        if mutatedSeqIdx == seqIdx:
+                            if mutantCount >= wildTypeCount:
+                                utils.add_count(amplfdSeqs[seqIdx], mutantCount - wildTypeCount)
+                            else:
+                                utils.remove_count(amplfdSeqs[seqIdx], wildTypeCount - mutantCount)
+                            continue
                         # decrement wild-type seq count in amplfied pool
-                        amplfdSeqs[seqIdx][0] -= wildTypeCount
+                        removed = utils.remove_count(amplfdSeqs[seqIdx], wildTypeCount)
+                        # when the wild-type holds fewer copies than its lineage lost, the
+                        # mutant lineage only grows from the copies actually removed
+                        if removed < wildTypeCount:
+                            mutantCount = mutantCount*removed//wildTypeCount
+                        # increment mutant seq count in amplified pool
+                        utils.add_count(amplfdSeqs[mutatedSeqIdx], mutantCount)
                 # if mutation carried out on more than 10,000 copies, avoid drawing random nums
                 elif mutFreq > 10000:
                     # calculate fraction of mutants for each possible mutation
@@ -361,20 +423,22 @@ class Mutation(object):
                             if mutatedSeqIdx not in amplfdSeqs:
                                 # generate seq string using its index
                                 mutatedSeq = apt.pseudoAptamerGenerator(mutatedSeqIdx)
-                                mutDist = md(mutatedSeq)
                                 # compute bias score of seq
                                 mutBias = d.bias_func(mutatedSeq, self.seqLength)
                                 # add to amplified pool
-                                amplfdSeqs[mutatedSeqIdx] = np.array([0, mutDist, mutBias])
+                                amplfdSeqs[mutatedSeqIdx] = np.array([0, 0, mutBias])
+                                pending.append((mutatedSeqIdx, mutatedSeq))
                             for cycleNum, cycleNumProb in enumerate(cycleNumProbs):
                                 # compute expected number of mutant copies after amplification
-                                amplfdSeqs[mutatedSeqIdx][0] += int(cycleNumProb *
-                                                                    initialMutCount *
-                                                                    (1+pcrYld)**(pcrCycleNum-cycleNum))
-                                # compute expected decrease in no. of wild type seq
-                                amplfdSeqs[seqIdx][0] -= int(cycleNumProb*initialMutCount *
-                                                             (1+pcrYld)**(pcrCycleNum-cycleNum))
+                                mutantCount = int(cycleNumProb*initialMutCount*(1+pcrYld)**(pcrCycleNum-cycleNum))
+                                # the wild type loses these copies (at most those it holds),
+                                # which become mutants
+                                removed = utils.remove_count(amplfdSeqs[seqIdx], mutantCount)
+                                utils.add_count(amplfdSeqs[mutatedSeqIdx], removed)
+            if len(pending) >= Nbatch:
+                self.set_distances(amplfdSeqs, metric, pending)
             if int(Lc/20) == 0 or si % int(Lc/20) == 0:
                 print("Mutated {:6.2f}%".format(100.0*si/Lc))
+        self.set_distances(amplfdSeqs, metric, pending)
         print("Mutation has been carried out")
         return amplfdSeqs
@@ -1,79 +1,144 @@
+import functools
+
 import numpy as np
 import utils
-
-# append path for ViennaRNA module
-import RNA
+import instrument
+import kernels
+import metrics
+import roundwriter
+import sharedpool
 
 
 # NEED TO CHANGE SAMPLING FOR SELECTION TO BE WEIGHTED BY COUNT OF EACH UNIQUE SEQ
 
 # number of random samples to draw at a time
 Nrsamples = 10**4
+# maximum expected number of batches of random samples for a selection by binding probability
+maxBatches = 10**4
 
 
 class Selection:
-    def __init__(self, distname, selectionThreshold, initialSize, samplingSize, stringency, dist):
-        self.distances = ("hamming", "basepair", "loop", "random")
+    # The samples files are written by writer (a roundwriter.RoundWriter) when one is
+    # given, and synchronously otherwise.
+    # samplingMode is the way sequencing samples are drawn (see samplingProcess).
+    # newPool creates the initial pool, e.g. a memmappool.MemmapPool to keep it on disk.
+    # jobs is the number of processes used to compute the distances of the initial library.
+    # metricOptions are the options of the distance metric (see metrics.create).
+    # selectionModel is the way sequences bind the target (see selectionProcess), and
+    # kdReference the dissociation constant of the references for the equilibrium model
+    def __init__(self, distname, selectionThreshold, initialSize, samplingSize, stringency, dist,
+                 writer=None, samplingMode="multinomial", newPool=dict, jobs=1, metricOptions=None,
+                 selectionModel="threshold", kdReference=1000.0, pipeline=None):
         self.distname = distname
+        self.metricOptions = metricOptions or dict()
         self.dist = dist
         self.selectionThreshold = selectionThreshold
         self.initialSize = initialSize
         self.samplingSize = samplingSize
         self.stringency = stringency
-        if self.distname not in self.distances:
+        self.writer = writer
+        self.newPool = newPool
+        self.jobs = jobs
+        self.samplingModes = ("multinomial", "hypergeometric", "choice")
+        self.samplingMode = samplingMode
+        self.selectionModels = ("threshold", "equilibrium")
+        self.selectionModel = selectionModel
+        self.kdReference = kdReference
+        # selection steps run before the selection of each round (see SelectionPipeline)
+        self.pipeline = pipeline
+        if self.distname not in metrics.metrics:
             print("Invalid argument for distance measure")
-            raise
-        self.distance = None
-        if self.distname == "hamming":
-            self.distance = self.dist.hamming_func
-        elif self.distname == "basepair":
-            self.distance = self.dist.bp_func
-        elif self.distname == "loop":
-            self.distance = self.dist.loop_func
-        elif self.distname == "random":
-            self.distance = self.dist.nodist_func
+            raise ValueError("distance must be one of {}".format(", ".join(metrics.metrics)))
+        # the metric giving the probability of the sequences to bind (see selectionProcess)
+        self.acceptor = metrics.create(self.distname, self.dist, **self.metricOptions)
+        if self.samplingMode not in self.samplingModes:
+            print("Invalid argument for sampling mode")
+            raise ValueError("sampling mode must be one of {}".format(", ".join(self.samplingModes)))
+        if self.selectionModel not in self.selectionModels:
+            print("Invalid argument for selection model")
+            raise ValueError("selection model must be one of {}".format(", ".join(self.selectionModels)))
+        if self.kdReference <= 0:
+            raise ValueError("kd_reference must be positive")
+
+    # This returns the distance metric (see metrics.py) prepared for the reference
+    # sequence(s) aptref
+    def metric(self, apt, aptref):
+        return metrics.create(self.distname, self.dist, apt, **self.metricOptions).prepare(aptref)
 
     def createInitialLibrary(self, apt, totalSeqNum, aptref):
-        seqPool = dict()
-        for randIdx in utils.randint(0, int(totalSeqNum-1), size=self.initialSize):
-            if randIdx in seqPool:
-                seqPool[randIdx][0] += 1
-            else:
-                randSeq = apt.pseudoAptamerGenerator(randIdx)
-                randSeqBias = self.dist.bias_func(randSeq, apt.seqLength)
-                randSeqDist = self.distance(aptref, randSeq)
-                seqPool[randIdx] = np.array([1, randSeqDist, randSeqBias])
-        return seqPool
+        return self.initialPool(apt, totalSeqNum, self.metric(apt, aptref))
 
-    def createInitialLibrary_loop(self, apt, totalSeqNum, seqref, structref, loopref):
-        seqPool = dict()
-        for randIdx in utils.randint(0, int(totalSeqNum-1), size=self.initialSize):
-            if randIdx in seqPool:
-                seqPool[randIdx][0] += 1
-            else:
-                randSeq = apt.pseudoAptamerGenerator(randIdx)
-                randSeqBias = self.dist.bias_func(randSeq, apt.seqLength)
-                randSeqDist = self.dist.loop_func(seqref, structref, loopref, apt.seqLength, randSeq)
-                seqPool[randIdx] = np.array([1, randSeqDist, randSeqBias])
+    # This draws the initial library and computes the distance (with metric, prepared for
+    # the references) and the bias of its sequences. The distances of the distinct sequences
+    # are computed at once (metric.distances), and with jobs > 1 those of fold-based
+    # metrics are computed by worker processes (see library_distances) from the sequence
+    # indices placed in shared memory.
+    # Pools stored on disk (memmappool.MemmapPool) are drawn chunkSize sequences at a time,
+    # with the same random numbers, so that the draws are never all held in memory.
+    def initialPool(self, apt, totalSeqNum, metric):
+        seqPool = self.newPool()
+        chunkSize = getattr(seqPool, "chunkSize", self.initialSize)
+        for size in utils.batch_size(self.initialSize, max(chunkSize, 1)):
+            draws = utils.randint(0, int(totalSeqNum-1), size=size)
+            self.add_draws(seqPool, apt, totalSeqNum, metric, draws)
         return seqPool
 
+    # This adds the sequences of index draws to the initial library seqPool
+    def add_draws(self, seqPool, apt, totalSeqNum, metric, draws):
+        if totalSeqNum > 2**63:
+            distance = metric.func()
+            for randIdx in draws:
+                if randIdx in seqPool:
+                    seqPool[randIdx][0] += 1
+                else:
+                    randSeq = apt.pseudoAptamerGenerator(randIdx)
+                    randSeqBias = self.dist.bias_func(randSeq, apt.seqLength)
+                    randSeqDist = distance(randSeq)
+                    seqPool[randIdx] = np.array([1, randSeqDist, randSeqBias])
+            return
+        # unique sequences in order of first appearance, as in the loop above
+        idx, counts = first_appearance(draws)
+        if len(seqPool) > 0:
+            # sequences drawn in an earlier chunk
+            seen = np.array([seqIdx in seqPool for seqIdx in idx.tolist()], dtype=bool)
+            for seqIdx, n in zip(idx[seen].tolist(), counts[seen].tolist()):
+                seqPool[seqIdx][0] += n
+            idx, counts = idx[~seen], counts[~seen]
+        if len(idx) == 0:
+            return
+        if self.jobs > 1 and metric.cost == "fold":
+            dists, biases = self.parallel_distances(apt, idx, metric)
+        else:
+            seqs = apt.pseudoAptamerGenerator_batch(idx)
+            dists = metric.distances(seqs).tolist()
+            biases = [self.dist.bias_func(seq, apt.seqLength) for seq in seqs]
+        for seqIdx, n, d, b in zip(idx.tolist(), counts.tolist(), dists, biases):
+            seqPool[seqIdx] = np.array([n, d, b])
+
+    def parallel_distances(self, apt, idx, metric):
+        cacheFile = self.dist.cache.fileName if self.dist.cache is not None else None
+        if self.dist.cache is not None:
+            # workers read the folds already computed
+            self.dist.cache.flush()
+        with sharedpool.SharedColumns.create({"idx": idx,
+                                              "dist": (np.float64, len(idx)),
+                                              "bias": (np.float64, len(idx))}) as cols:
+            worker = functools.partial(library_distances, cols.spec, metric, apt.alphabetSet, apt.seqLength,
+                                       self.dist.bias, cacheFile, self.dist.folder.name)
+            for cnts in sharedpool.run_slices(worker, len(idx), self.jobs):
+                for name, n in cnts.items():
+                    instrument.count(name, n)
+            return cols["dist"].tolist(), cols["bias"].tolist()
+
     def stochasticSelection_initial(self, apt, aptPool,
                                     totalSeqNum,
                                     outputFileNames, rnd):
-        slctdSeqs = None
-        ref = aptPool
-        if self.distname == "basepair":
-            ref = RNA.fold(aptPool)[0]
-            print("Optimum aptamer structure: {}".format(ref))
+        # the structures of the references are computed once
+        metric = self.metric(apt, aptPool)
+        if hasattr(metric, "structs"):
+            print("Optimum aptamer structure: {}".format(", ".join(metric.structs)))
         print("Creating initial library...", flush=True)
-        # stochastic selection until threshold is met
-        if self.distname == "loop":
-            aptStruct = RNA.fold(aptPool)[0]
-            print("Optimum aptamer structure: {}".format(aptStruct))
-            aptLoop = utils.apt_loopFinder(aptPool, aptStruct, apt.seqLength)
-            slctdSeqs = self.createInitialLibrary_loop(apt, totalSeqNum, aptPool, aptStruct, aptLoop)
-        else:
-            slctdSeqs = self.createInitialLibrary(apt, totalSeqNum, ref)
+        slctdSeqs = self.initialPool(apt, totalSeqNum, metric)
         print("Initial library created")
         selectionDist = utils.rv_int(slctdSeqs, "selectionDist")
         print("Sampling has started...")
@@ -93,33 +158,57 @@ class Selection:
         self.samplingProcess(apt, seqPool, selectionDist, self.samplingSize,
                              outputFileNames, rnd)
         print("Sampling has completed")
+        # positive and negative selection steps, which change the counts of the pool
+        if self.pipeline is not None:
+            if self.pipeline.apply(seqPool, rnd, apt.seqLength)[0] == 0:
+                print("Error: no sequence of the pool is left after the selection steps")
+                raise ValueError("no sequence left after the selection steps of round {}".format(rnd))
+            selectionDist = utils.rv_int(seqPool, "selectionDist")
         # reset all seq counts prior to selection
-        for k in seqPool:
-            seqPool[k][0] = 0
+        if hasattr(seqPool, "reset_counts"):
+            seqPool.reset_counts()
+        else:
+            for k in seqPool:
+                seqPool[k][0] = 0
         # draw a bunch of random seqs
         self.selectionProcess(seqPool, selectionDist, apt.seqLength)
         # remove all seqs that haven't been selected
-        for ki in [k for k, v in seqPool.items() if v[0] == 0]:
-            del seqPool[ki]
+        if hasattr(seqPool, "remove_zero"):
+            seqPool.remove_zero()
+        else:
+            for ki in [k for k, v in seqPool.items() if v[0] == 0]:
+                del seqPool[ki]
         print("sequence selection has been carried out")
         return seqPool
 
+    # This simulates the sequencing of samplingSize sequences of the pool and writes the
+    # sampled sequences with their counts to the samples file of the round.
+    # The samples are drawn
+    #   multinomial:    with replacement, as one multinomial draw over the pool
+    #   hypergeometric: without replacement, at most the count of each sequence
+    #   choice:         with replacement, one draw per sample (slow for large samplingSize)
     def samplingProcess(self, apt,
                         seqPool, selectionDist, samplingSize,
                         outputFileNames, rnd):
-        samps = dict()
         # draw random samples from distribution
-        for seqIdx in selectionDist.rvs(size=samplingSize):
-            if seqIdx in samps:
-                samps[seqIdx] += 1
-            else:
-                samps[seqIdx] = 1
+        if self.samplingMode == "multinomial":
+            samps, N = selectionDist.multinomial(samplingSize)
+        elif self.samplingMode == "hypergeometric":
+            samps, N = selectionDist.hypergeometric(samplingSize)
+        else:
+            draws = selectionDist.rvs(size=samplingSize)
+            # count the samples, in order of first appearance
+            samps, first, N = np.unique(draws, return_index=True, return_counts=True)
+            order = np.argsort(first, kind="stable")
+            samps, N = samps[order], N[order]
+        dist = np.array([seqPool[seqIdx][1] for seqIdx in samps.tolist()]).reshape(-1).astype(np.int64)
         sampleFileName = outputFileNames+"_samples_R{:03d}".format(rnd)
         # write to samples file
-        with open(sampleFileName, 'w') as s:
-            for seqIdx, N in samps.items():
-                seq = apt.pseudoAptamerGenerator(seqIdx)
-                s.write(str(seq)+'\t'+str(int(seqPool[seqIdx][1]))+'\t'+str(N)+'\n')
+        with instrument.timed("sample_write_time"):
+            if self.writer is not None:
+                self.writer.submit(sampleFileName, samps, dist, N)
+            else:
+                roundwriter.write_pool(sampleFileName, apt, samps, dist, N)
         return
 
     # This function takes an empty selected pool, aptamer sequence structure and loop,
@@ -128,18 +217,199 @@ class Selection:
     # Input: np.array(), int(), stats.obj(), int()
     # Output: np.array()
     def selectionProcess(self, seqPool, selectionDist, seqLength):
+        if self.selectionModel == "equilibrium":
+            return self.selectionProcess_equilibrium(seqPool, selectionDist)
+        if not self.acceptor.threshold:
+            return self.selectionProcess_probability(seqPool, selectionDist, seqLength)
+        if hasattr(seqPool, "arrays"):
+            dists = seqPool.arrays()[1][:, 1]
+        else:
+            dists = np.array([seqPool[seqIdx][1] for seqIdx in selectionDist.si], dtype=np.float64)
+        dists = dists.astype(np.int64)
+        counts = np.zeros(len(dists), dtype=np.int64)
         selectedSeqs = 0
         # until all sites are occupied
         print("Drawing sample batch")
         while(selectedSeqs < self.selectionThreshold):
-            # draw random sequences
-            # warning: looping here causes large memory consumption
-            for randIdx in selectionDist.rvs(size=Nrsamples):
-                # carry out stochastic selection
-                # draw random affinities
-                if(int(seqPool[randIdx][1]) < utils.randint(0, seqLength-self.stringency)):
-                    seqPool[randIdx][0] += 1
-                    selectedSeqs += 1
-                    if selectedSeqs % Nrsamples == 0:
-                        print("{}% completed".format(100.0*selectedSeqs/self.selectionThreshold))
+            # draw random sequences and random affinities, and carry out stochastic selection
+            # (see kernels.select_threshold)
+            pos = selectionDist.positions(size=Nrsamples)
+            thresholds = utils.randint(0, seqLength-self.stringency, size=Nrsamples)
+            selectedSeqs += kernels.select_threshold(pos, thresholds, dists, counts)
+            print("{}% completed".format(100.0*selectedSeqs/self.selectionThreshold))
+        for n in np.flatnonzero(counts).tolist():
+            seqPool[selectionDist.si[n]][0] += counts[n]
         return
+
+    # This carries out the selection for metrics that give the binding probability of the
+    # sequences (e.g. energy): every random sequence binds with the probability given by
+    # the metric acceptance for its distance
+    def selectionProcess_probability(self, seqPool, selectionDist, seqLength):
+        # give up when the pool is too unlikely to bind for the selection to complete
+        # (e.g. when the references bind far better than any sequence of the pool)
+        if hasattr(seqPool, "arrays"):
+            dists = seqPool.arrays()[1][:, 1]
+        else:
+            dists = np.array([seqPool[seqIdx][1] for seqIdx in selectionDist.si], dtype=np.float64)
+        binding = float(np.dot(selectionDist.probas, self.acceptor.acceptance(dists, seqLength, self.stringency)))
+        print("average binding probability = {}".format(binding))
+        if binding*Nrsamples*maxBatches < self.selectionThreshold:
+            print("Error: the sequences of the pool are too unlikely to bind for selection to complete")
+            raise ValueError("average binding probability {} is too low to select {} sequences"
+                             .format(binding, self.selectionThreshold))
+        selectedSeqs = 0
+        print("Drawing sample batch")
+        while(selectedSeqs < self.selectionThreshold):
+            draws = selectionDist.rvs(size=Nrsamples)
+            dists = np.array([seqPool[randIdx][1] for randIdx in draws.tolist()], dtype=np.float64)
+            p = self.acceptor.acceptance(dists, seqLength, self.stringency)
+            instrument.count("rng_draws", len(draws))
+            for randIdx in draws[np.random.random_sample(len(draws)) < p].tolist():
+                seqPool[randIdx][0] += 1
+                selectedSeqs += 1
+            print("{}% completed".format(100.0*selectedSeqs/self.selectionThreshold))
+        return
+
+    # This carries out the selection as a binding equilibrium: the scale target sites are
+    # shared by all the sequences of the pool, each binding with the dissociation constant
+    # kdReference times that given by the metric for its distance (see free_target), and
+    # the bound copies of every sequence are drawn binomially
+    def selectionProcess_equilibrium(self, seqPool, selectionDist):
+        if hasattr(seqPool, "arrays"):
+            dists = seqPool.arrays()[1][:, 1]
+        else:
+            dists = np.array([seqPool[seqIdx][1] for seqIdx in selectionDist.si], dtype=np.float64)
+        kd = self.kdReference*self.acceptor.dissociation(dists)
+        counts = selectionDist.counts
+        free = free_target(lambda F: float(np.dot(counts, F/(F + kd))), self.selectionThreshold)
+        bound = np.random.binomial(counts.astype(np.int64), free/(free + kd))
+        instrument.count("rng_draws", len(bound))
+        print("free target fraction = {}, bound sequences = {}".format(free/self.selectionThreshold,
+                                                                       int(bound.sum())))
+        if bound.sum() == 0:
+            print("Error: no sequence of the pool is bound at equilibrium")
+            raise ValueError("no sequence bound at equilibrium, increase scale or lower kd_reference or "
+                             "kd_factor")
+        for seqIdx, n in zip(selectionDist.si, bound.tolist()):
+            if n > 0:
+                seqPool[seqIdx][0] = n
+        return
+
+
+# A selection step run before the scale limited selection of a round: every copy of every
+# sequence binds the step target (the reference aptamers of the step) with the probability
+# given by the step metric (prepared for these references) at the step stringency.
+# Positive steps keep the copies that bind, negative steps (counter-selection) those that
+# do not. rounds lists the rounds the step is run in (all of them if empty).
+class SelectionStep:
+    def __init__(self, name, positive, metric, stringency, rounds=()):
+        self.name = name
+        self.positive = positive
+        self.metric = metric
+        self.stringency = stringency
+        self.rounds = rounds
+
+    def runs(self, rnd):
+        return len(self.rounds) == 0 or rnd in self.rounds
+
+
+# The selection steps run before the selection of every round (see SelectionStep).
+# The distances of the sequences for every step are computed when a sequence is first met,
+# for all the steps at once (see metrics.fused_distances), and kept as long as the sequence
+# stays in the pool. Tail bins (see utils.prune_pool) are not affected by the steps.
+class SelectionPipeline:
+    def __init__(self, steps, apt):
+        self.steps = steps
+        self.apt = apt
+        # distances of the sequences for each step, by sequence index
+        self.dists = dict()
+
+    # This returns the step distances of the sequences of index idx, as a
+    # (len(idx), len(steps)) array
+    def distances(self, idx):
+        keys = idx.tolist()
+        new = [k for k in keys if k not in self.dists and k >= 0]
+        if len(new) > 0:
+            seqs = self.apt.pseudoAptamerGenerator_batch(utils.index_array(new))
+            values = metrics.fused_distances([step.metric for step in self.steps], seqs)
+            instrument.count("step_distances", values.size)
+            self.dists.update(zip(new, values))
+        empty = np.zeros(len(self.steps))
+        return np.array([self.dists.get(k, empty) for k in keys]).reshape(-1, len(self.steps))
+
+    # This runs the steps of round rnd on the counts of seqPool, removes the sequences left
+    # without copies and returns the total and unique numbers of sequences that remain
+    def apply(self, seqPool, rnd, seqLength):
+        steps = [(n, step) for n, step in enumerate(self.steps) if step.runs(rnd)]
+        idx, data = utils.pool_arrays(seqPool)
+        counts = np.maximum(data[:, 0], 0).astype(np.int64)
+        if len(steps) > 0:
+            dists = self.distances(idx)
+            tail = idx < 0 if idx.dtype.kind == 'i' else np.zeros(len(idx), dtype=bool)
+            for n, step in steps:
+                p = step.metric.acceptance(dists[:, n], seqLength, step.stringency)
+                p = np.where(tail, 1.0, p if step.positive else 1 - p)
+                before = int(counts.sum())
+                counts = np.random.binomial(counts, p)
+                instrument.count("rng_draws", len(counts))
+                print("{} selection step {}: {} of {} sequences kept".format(
+                    "positive" if step.positive else "negative", step.name, int(counts.sum()), before))
+            for seqIdx, n in zip(idx.tolist(), counts.tolist()):
+                seqPool[seqIdx][0] = n
+            if hasattr(seqPool, "remove_zero"):
+                seqPool.remove_zero()
+            else:
+                for ki in [k for k, v in seqPool.items() if v[0] == 0]:
+                    del seqPool[ki]
+        # forget the sequences that left the pool
+        if len(self.dists) > len(seqPool):
+            self.dists = {k: self.dists[k] for k in seqPool if k in self.dists}
+        return int(counts.sum()), len(seqPool)
+
+
+# This returns the free target concentration at the binding equilibrium of target sites
+# with a pool of sequences, where bound(F) is the concentration of bound sequences at the
+# free target concentration F (the sum over the sequences of count*F/(F+Kd)), i.e. the root
+# of F + bound(F) = target, which lies between 0 and target.
+# Concentrations are in numbers of molecules, as the counts of the pool.
+def free_target(bound, target):
+    from scipy.optimize import brentq
+    if target <= 0:
+        return 0.0
+    if bound(float(target)) <= 0:
+        return float(target)
+    return brentq(lambda F: F + bound(F) - target, 0.0, float(target), xtol=1e-12*target)
+
+
+# This returns the distinct values of draws in order of first appearance, with their counts
+def first_appearance(draws):
+    idx, first, counts = np.unique(draws.astype(np.int64), return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    return idx[order], counts[order]
+
+
+# This computes, in a worker process, the distances (with metric, prepared for the
+# references) and biases of the sequences start:stop of the shared columns, and returns
+# the counters it incremented
+def library_distances(spec, metric, alphabetSet, seqLength, bias, cacheFile, backend, start, stop):
+    from Aptamers import Aptamers
+    from Distance import Distance
+    c0 = instrument.snapshot()
+    cols = sharedpool.SharedColumns.attach(spec)
+    cache = None
+    if cacheFile is not None:
+        from foldcache import FoldCache
+        cache = FoldCache(cacheFile)
+    try:
+        metric.apt = Aptamers(alphabetSet, seqLength)
+        metric.dist = Distance(bias, cache, backend)
+        seqs = metric.apt.pseudoAptamerGenerator_batch(cols["idx"][start:stop])
+        cols["dist"][start:stop] = metric.distances(seqs)
+        cols["bias"][start:stop] = [metric.dist.bias_func(seq, seqLength) for seq in seqs]
+    finally:
+        if cache is not None:
+            cache.close()
+        cols.close()
+    delta = instrument.snapshot()
+    delta.subtract(c0)
+    return {k: v for k, v in delta.items() if v != 0}
@@ -0,0 +1,350 @@
+# Micro-benchmarks of the hot paths of the simulation, run on synthetic pools.
+#
+# Usage:
+#     python -m bench [-n POOL_SIZE] [--skew SKEW] [-o results.json] [-k PATTERN]
+#     python -m bench --compare old.json new.json
+#
+# Every benchmark times one stage in isolation and the results are stored as JSON
+# together with the commit and the library versions so that runs can be compared.
+import atexit
+import contextlib
+import copy
+import fnmatch
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import kernels as kernels_
+import metrics
+import utils
+from Aptamers import Aptamers
+from Distance import Distance
+from Mutation import Mutation
+from Selection import Selection
+
+# registered benchmarks, in the order they are run
+benchmarks = []
+
+
+def benchmark(name, needs_fold=False):
+    def register(func):
+        benchmarks.append((name, func, needs_fold))
+        return func
+    return register
+
+
+# This holds everything a benchmark needs: the settings of the synthetic experiment
+# and the synthetic pool itself
+class Context:
+    def __init__(self, size=10000, skew=1.5, seqLength=20, scale=1000,
+                 errorRate=1e-5, pcrCycleNum=15, pcrYld=0.85, stringency=-3, seed=1, backend="vienna",
+                 kernels="auto"):
+        self.size = size
+        self.skew = skew
+        self.seqLength = seqLength
+        self.scale = scale
+        self.errorRate = errorRate
+        self.pcrCycleNum = pcrCycleNum
+        self.pcrYld = pcrYld
+        self.stringency = stringency
+        self.seed = seed
+        self.backend = backend
+        # name of the kernels used (see kernels.py)
+        self.kernels = kernels_.use(kernels)
+        self.apt = Aptamers("ACGT", seqLength)
+        self.dist = Distance(backend=backend)
+        self.totalSeqNum = self.apt.La**seqLength
+        reseed(seed)
+        self.reference = self.apt.pseudoAptamerGenerator(random.randint(0, self.totalSeqNum-1))
+        self.pool = synthetic_pool(self.apt, self.dist, self.reference, size, skew)
+        self.seqs = [self.apt.pseudoAptamerGenerator(k) for k in self.pool]
+
+    def selection(self, distname="hamming", initialSize=None, selectionModel="threshold"):
+        return Selection(distname, self.scale, initialSize or self.size, 1000,
+                         self.stringency, self.dist, selectionModel=selectionModel)
+
+    def mutation(self):
+        return Mutation(self.dist, seqLength=self.seqLength, errorRate=self.errorRate,
+                        pcrCycleNum=self.pcrCycleNum, pcrYld=self.pcrYld)
+
+
+def reseed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+# This builds a pool of size unique random sequences with the same layout as the
+# simulation pool, i.e. {seqIdx: np.array([count, distance, bias])}.
+# Counts follow a Zipf law with exponent skew (skew <= 1 gives all counts equal to 1)
+# and distances are Hamming distances to the reference.
+def synthetic_pool(apt, dist, reference, size, skew):
+    seqPool = dict()
+    idxs = utils.randint(0, apt.La**apt.seqLength-1, size=size)
+    if skew > 1:
+        counts = np.random.zipf(skew, size=size)
+    else:
+        counts = np.ones(size, dtype=int)
+    for seqIdx, c in zip(idxs, counts):
+        seq = apt.pseudoAptamerGenerator(seqIdx)
+        seqPool[seqIdx] = np.array([c, dist.hamming_func(reference, seq),
+                                    dist.bias_func(seq, apt.seqLength)])
+    return seqPool
+
+
+@benchmark("Selection.createInitialLibrary")
+def bench_initial_library(ctx):
+    S = ctx.selection("hamming")
+    return lambda: S.createInitialLibrary(ctx.apt, ctx.totalSeqNum, ctx.reference), ctx.size
+
+
+@benchmark("Selection.createInitialLibrary[loop]", needs_fold=True)
+def bench_initial_library_loop(ctx):
+    n = max(1, ctx.size//10)
+    S = ctx.selection("loop", initialSize=n)
+    return lambda: S.createInitialLibrary(ctx.apt, ctx.totalSeqNum, ctx.reference), n
+
+
+@benchmark("utils.rv_int")
+def bench_rv_int(ctx):
+    return lambda: utils.rv_int(ctx.pool, "selectionDist"), len(ctx.pool)
+
+
+@benchmark("utils.rv_int.rvs")
+def bench_rv_int_rvs(ctx):
+    selectionDist = utils.rv_int(ctx.pool, "selectionDist")
+    return lambda: selectionDist.rvs(size=ctx.size), ctx.size
+
+
+def bench_selection_process(selectionModel):
+    def bench(ctx):
+        S = ctx.selection(selectionModel=selectionModel)
+        selectionDist = utils.rv_int(ctx.pool, "selectionDist")
+        pool = copy.deepcopy(ctx.pool)
+
+        def run():
+            for k in pool:
+                pool[k][0] = 0
+            S.selectionProcess(pool, selectionDist, ctx.seqLength)
+        return run, ctx.scale
+    return bench
+
+
+benchmark("Selection.selectionProcess")(bench_selection_process("threshold"))
+benchmark("Selection.selectionProcess[equilibrium]")(bench_selection_process("equilibrium"))
+
+
+@benchmark("Mutation.generate_mutants_new")
+def bench_generate_mutants(ctx):
+    mut = ctx.mutation()
+    # amplification multiplies the pool size, so keep the selected pool small
+    n = min(len(ctx.pool), ctx.scale)
+    keys = list(ctx.pool)[:n]
+
+    def run():
+        pool = {k: ctx.pool[k].copy() for k in keys}
+        mut.generate_mutants_new(pool, ctx.reference, ctx.apt, "hamming")
+    return run, n
+
+
+@benchmark("Distance.hamming_func")
+def bench_hamming(ctx):
+    return lambda: [ctx.dist.hamming_func(ctx.reference, s) for s in ctx.seqs], len(ctx.seqs)
+
+
+@benchmark("Distance.bias_func")
+def bench_bias(ctx):
+    return lambda: [ctx.dist.bias_func(s, ctx.seqLength) for s in ctx.seqs], len(ctx.seqs)
+
+
+@benchmark("Distance.lavenshtein_func")
+def bench_lavenshtein(ctx):
+    loops = [s[:ctx.seqLength//2] for s in ctx.seqs]
+    ref = ctx.reference[:ctx.seqLength//2]
+    return lambda: [ctx.dist.lavenshtein_func(ref, s) for s in loops], len(loops)
+
+
+@benchmark("Distance.seq_loops", needs_fold=True)
+def bench_seq_loops(ctx):
+    seqs = ctx.seqs[:max(1, ctx.size//10)]
+    structs = ctx.dist.fold_batch(seqs)
+    return lambda: ctx.dist.seq_loops(seqs, structs, ctx.seqLength), len(seqs)
+
+
+@benchmark("Distance.fold_batch", needs_fold=True)
+def bench_fold_batch(ctx):
+    seqs = ctx.seqs[:max(1, ctx.size//10)]
+    return lambda: ctx.dist.fold_batch(seqs), len(seqs)
+
+
+@benchmark("Distance.bp_func", needs_fold=True)
+def bench_bp(ctx):
+    seqs = ctx.seqs[:max(1, ctx.size//10)]
+    struct = ctx.dist.fold(ctx.reference)
+    return lambda: [ctx.dist.bp_func(struct, s) for s in seqs], len(seqs)
+
+
+@benchmark("Distance.loop_func", needs_fold=True)
+def bench_loop(ctx):
+    seqs = ctx.seqs[:max(1, ctx.size//10)]
+    struct = ctx.dist.fold(ctx.reference)
+    loop = utils.apt_loopFinder(ctx.reference, struct, ctx.seqLength)
+    return lambda: [ctx.dist.loop_func(ctx.reference, struct, loop, ctx.seqLength, s)
+                    for s in seqs], len(seqs)
+
+
+@benchmark("Aptamers.pseudoAptamerGenerator")
+def bench_seq_generator(ctx):
+    return lambda: [ctx.apt.pseudoAptamerGenerator(k) for k in ctx.pool], len(ctx.pool)
+
+
+@benchmark("Aptamers.pseudoAptamerIndexGenerator")
+def bench_idx_generator(ctx):
+    return lambda: [ctx.apt.pseudoAptamerIndexGenerator(s) for s in ctx.seqs], len(ctx.seqs)
+
+
+@benchmark("sim_.write_round")
+def bench_write_round(ctx):
+    import sim_
+    outDir = tempfile.mkdtemp(prefix="selex_bench_")
+    atexit.register(shutil.rmtree, outDir, ignore_errors=True)
+    outFile = os.path.join(outDir, "bench_R001")
+    return lambda: sim_.write_round(outFile, ctx.pool, ctx.apt), len(ctx.pool)
+
+
+# This times the batch evaluation of a registered distance metric
+def bench_metric(name):
+    def bench(ctx):
+        seqIdxs = utils.index_array(list(ctx.pool))
+        if metrics.metrics[name].cost == "fold":
+            seqIdxs = seqIdxs[:max(1, ctx.size//10)]
+        metric = metrics.create(name, ctx.dist, ctx.apt).prepare(ctx.reference)
+        return lambda: metric.evaluate(seqIdxs), len(seqIdxs)
+    return bench
+
+
+for name in metrics.metrics:
+    benchmark("metrics.{}.evaluate".format(name),
+              needs_fold=metrics.metrics[name].cost == "fold")(bench_metric(name))
+
+
+def bench_write_compressed(compression):
+    def bench(ctx):
+        import roundwriter
+        outDir = tempfile.mkdtemp(prefix="selex_bench_")
+        atexit.register(shutil.rmtree, outDir, ignore_errors=True)
+        outFile = os.path.join(outDir, "bench_R001")
+        snapshot = roundwriter.snapshot(ctx.pool)
+        return lambda: roundwriter.write_pool(outFile, ctx.apt, *snapshot, compression), len(ctx.pool)
+    return bench
+
+
+for compression in ("gzip", "xz"):
+    benchmark("roundwriter.write_pool[{}]".format(compression))(bench_write_compressed(compression))
+
+
+# This times the start of a new interpreter running code from the repository: importing
+# the simulation, and setting up a Hamming distance experiment without outputs (the rounds
+# are not run). The heavy dependencies (scipy, pandas, ViennaRNA, matplotlib) are only
+# imported by the stages that need them, so they should not be loaded here.
+def bench_startup(code):
+    def bench(ctx):
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        command = [sys.executable, "-c", code]
+        return lambda: subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, check=True), 1
+    return bench
+
+
+benchmark("startup.import")(bench_startup("import sim_"))
+benchmark("startup.setup[hamming]")(bench_startup(
+    "import sim_; sim_.SelexSimulation({'distance': 'hamming', 'fold_cache': ''}).close()"))
+
+
+# This times func repeat times, reseeding the random generators before each call
+# The progress messages printed by the stages are discarded
+def time_func(func, repeat, seed):
+    times = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeat):
+            reseed(seed)
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+    return times
+
+
+def run_benchmarks(ctx, repeat=3, pattern="*"):
+    results = []
+    fold = ctx.dist.folder.available()
+    for name, setup, needs_fold in benchmarks:
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        if needs_fold and not fold:
+            print("{:40s} skipped (no folding backend)".format(name))
+            continue
+        reseed(ctx.seed)
+        try:
+            func, nitems = setup(ctx)
+        except NotImplementedError as e:
+            print("{:40s} skipped ({})".format(name, e))
+            continue
+        times = time_func(func, repeat, ctx.seed)
+        res = {"name": name,
+               "items": int(nitems),
+               "times": times,
+               "min": min(times),
+               "mean": float(np.mean(times)),
+               "per_item": min(times)/max(1, nitems)}
+        print("{:40s} {:10.4f} s  {:10.3e} s/item  ({} items)".format(name, res["min"],
+                                                                     res["per_item"], nitems),
+              flush=True)
+        results.append(res)
+    return results
+
+
+# This collects what is needed to compare results between commits and machines
+def metadata(ctx, repeat):
+    meta = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "params": {k: v for k, v in vars(ctx).items()
+                       if isinstance(v, (int, float, str)) and k != "reference"}}
+    try:
+        meta["commit"] = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                                 cwd=os.path.dirname(os.path.abspath(__file__)),
+                                                 stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        meta["commit"] = None
+    return meta
+
+
+def save_results(fileName, meta, results):
+    with open(fileName, 'w') as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+
+
+def load_results(fileName):
+    with open(fileName, 'r') as f:
+        return json.load(f)
+
+
+# This prints the speedup of each benchmark of new relative to old
+def compare(old, new):
+    oldRes = {r["name"]: r for r in old["results"]}
+    print("{:40s} {:>12s} {:>12s} {:>8s}".format("benchmark", old["meta"].get("commit") or "old",
+                                                  new["meta"].get("commit") or "new", "speedup"))
+    for r in new["results"]:
+        if r["name"] not in oldRes:
+            continue
+        o = oldRes[r["name"]]
+        print("{:40s} {:12.3e} {:12.3e} {:8.2f}".format(r["name"], o["per_item"], r["per_item"],
+                                                       o["per_item"]/r["per_item"]))
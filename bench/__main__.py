@@ -0,0 +1,28 @@
+import argparse
+
+import bench
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the stage micro-benchmarks.')
+    parser.add_argument('-n', '--size', type=int, default=10000, help="number of unique sequences in the pool")
+    parser.add_argument('--skew', type=float, default=1.5, help="Zipf exponent of the counts (<= 1: flat)")
+    parser.add_argument('-L', '--length', type=int, default=20, help="sequence length")
+    parser.add_argument('--scale', type=int, default=1000, help="selection threshold")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fold-backend', type=str, default="vienna", help="fold backend (vienna or stem)")
+    parser.add_argument('--kernels', type=str, default="auto", help="inner loop kernels (auto, numba or numpy)")
+    parser.add_argument('-k', '--pattern', type=str, default="*", help="only run benchmarks matching this glob")
+    parser.add_argument('-o', '--output', type=str, default="bench_results.json")
+    parser.add_argument('--compare', nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        bench.compare(bench.load_results(args.compare[0]), bench.load_results(args.compare[1]))
+    else:
+        ctx = bench.Context(size=args.size, skew=args.skew, seqLength=args.length,
+                            scale=args.scale, seed=args.seed, backend=args.fold_backend,
+                            kernels=args.kernels)
+        results = bench.run_benchmarks(ctx, repeat=args.repeat, pattern=args.pattern)
+        bench.save_results(args.output, bench.metadata(ctx, args.repeat), results)
+        print("Results saved to {}".format(args.output))
@@ -0,0 +1,192 @@
+# End-to-end scaling study of the simulation.
+#
+# Usage:
+#     python -m bench.scaling -s settings.init -o scaling \
+#         --initial_samples 10000 100000 1000000 --scale 1000 10000 \
+#         --number_of_pcr 15 --sequence_length 20 --distance hamming loop
+#
+# Every point of the parameter grid is simulated by sim_.py in its own process (so that
+# peak memory is measured per run) with the run stats enabled. The per round runtime and
+# peak memory are gathered from the [experiment_name]_runstats.jsonl files into
+#     scaling_rounds.csv   one line per run and round
+#     scaling_summary.csv  one line per run
+# and the scaling curves of runtime and memory against each parameter are plotted in
+# scaling_[parameter].png, with the fitted log-log exponent of the curve.
+import argparse
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+import sim_
+import sweep
+import utils
+from instrument import read_stats
+
+# parameters of the grid, with the type of their values
+grid_params = (("initial_samples", int),
+               ("scale", int),
+               ("number_of_pcr", int),
+               ("sequence_length", int),
+               ("distance", str))
+
+# exponent above which the growth of runtime or memory with a parameter is reported
+superlinear_exponent = 1.2
+
+
+# This returns the reference aptamers (comma separated, see utils.references) resized to
+# the given length, each built by repeating the corresponding reference of base
+def reference_of_length(base, seqLength):
+    return ",".join((ref*(seqLength//len(ref)+1))[:seqLength] for ref in utils.references(base))
+
+
+# This runs one simulation and returns its per round statistics
+def run_point(baseSettings, runDir, params, rounds, timeout):
+    params = dict(params)
+    if rounds is not None:
+        params["number_of_rounds"] = rounds
+    if "sequence_length" in params:
+        base = sim_.read_settings(baseSettings).get('general', 'reference_aptamer')
+        params["reference_aptamer"] = reference_of_length(base, params["sequence_length"])
+    sweep.write_run_settings(baseSettings, runDir, params)
+    status, wall = sweep.run_simulation(runDir, timeout)
+    statsFile = os.path.join(runDir, sweep.run_name+"_runstats.jsonl")
+    records = read_stats(statsFile) if os.path.exists(statsFile) else []
+    return status, wall, round_table(records)
+
+
+# This sums the stages of each round: runtime is the total wall time of the round and
+# memory the peak resident set size reached at the end of the round
+def round_table(records):
+    rows = dict()
+    for rec in records:
+        row = rows.setdefault(rec["round"], {"round": rec["round"], "wall_time": 0.0,
+                                             "cpu_time": 0.0, "peak_rss": 0, "unique": 0, "total": 0})
+        row["wall_time"] += rec["wall_time"]
+        row["cpu_time"] += rec["cpu_time"]
+        row["peak_rss"] = max(row["peak_rss"], rec["peak_rss"])
+        row["{}_time".format(rec["stage"])] = rec["wall_time"]
+        if "unique" in rec:
+            row["unique"] = rec["unique"]
+            row["total"] = rec["total"]
+        row["folds"] = row.get("folds", 0) + rec["counters"].get("folds", 0)
+    return [rows[r] for r in sorted(rows)]
+
+
+# This fits log(y) = a*log(x) + b and returns the exponent a
+def loglog_exponent(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    ok = (x > 0) & (y > 0)
+    if len(np.unique(x[ok])) < 2:
+        return np.nan
+    return np.polyfit(np.log(x[ok]), np.log(y[ok]), 1)[0]
+
+
+# This computes, for each numerical parameter that takes several values in the grid,
+# the scaling exponent of runtime and memory while the other parameters are held fixed
+def scaling_exponents(summary, names):
+    rows = []
+    for name in names:
+        if summary[name].dtype == object or summary[name].nunique() < 2:
+            continue
+        others = [n for n in names if n != name]
+        groups = summary.groupby(others) if others else [((), summary)]
+        for key, group in groups:
+            group = group[group["status"] == "ok"].sort_values(name)
+            if len(group) < 2:
+                continue
+            row = {"parameter": name}
+            row.update(dict(zip(others, key if isinstance(key, tuple) else (key,))))
+            row["time_exponent"] = loglog_exponent(group[name], group["time_per_round"])
+            row["memory_exponent"] = loglog_exponent(group[name], group["peak_rss"])
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def plot_scaling(summary, names, outDir):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    ok = summary[summary["status"] == "ok"]
+    for name in names:
+        if ok[name].dtype == object or ok[name].nunique() < 2:
+            continue
+        others = [n for n in names if n != name]
+        fig, axes = plt.subplots(1, 2, figsize=(10, 4))
+        groups = ok.groupby(others) if others else [((), ok)]
+        for key, group in groups:
+            group = group.sort_values(name)
+            key = key if isinstance(key, tuple) else (key,)
+            label = ", ".join("{}={}".format(n, k) for n, k in zip(others, key))
+            axes[0].plot(group[name], group["time_per_round"], 'o-', label=label)
+            axes[1].plot(group[name], group["peak_rss"]/2**20, 'o-', label=label)
+        for ax in axes:
+            ax.set_xscale("log")
+            ax.set_yscale("log")
+            ax.set_xlabel(name)
+        axes[0].set_ylabel("Wall time per round (s)")
+        axes[1].set_ylabel("Peak memory (MiB)")
+        axes[0].legend(prop={'size': 6})
+        plt.tight_layout()
+        fig.savefig(os.path.join(outDir, "scaling_{}.png".format(name)))
+        plt.close(fig)
+
+
+def run_grid(baseSettings, outDir, grid, rounds=None, timeout=None):
+    names = [n for n, t in grid_params if n in grid]
+    os.makedirs(outDir, exist_ok=True)
+    runs = []
+    roundRows = []
+    points = list(itertools.product(*[grid[n] for n in names]))
+    for i, values in enumerate(points):
+        params = dict(zip(names, values))
+        runDir = os.path.join(outDir, "run{:04d}".format(i))
+        print("[{}/{}] {}".format(i+1, len(points), params), flush=True)
+        status, wall, rows = run_point(baseSettings, runDir, params, rounds, timeout)
+        run = dict(params)
+        run["run"] = i
+        run["status"] = status
+        run["wall_time"] = wall
+        run["rounds"] = len(rows)
+        run["time_per_round"] = np.mean([r["wall_time"] for r in rows]) if rows else np.nan
+        run["max_round_time"] = max([r["wall_time"] for r in rows]) if rows else np.nan
+        run["peak_rss"] = max([r["peak_rss"] for r in rows]) if rows else np.nan
+        run["final_unique"] = rows[-1]["unique"] if rows else np.nan
+        runs.append(run)
+        print("    {}: {:.2f} s, {:.2f} s/round, peak memory {:.1f} MiB".format(
+              status, wall, run["time_per_round"], run["peak_rss"]/2**20), flush=True)
+        for r in rows:
+            r = dict(r)
+            r["run"] = i
+            r.update(params)
+            roundRows.append(r)
+    summary = pd.DataFrame(runs)
+    summary.to_csv(os.path.join(outDir, "scaling_summary.csv"), index=False)
+    pd.DataFrame(roundRows).to_csv(os.path.join(outDir, "scaling_rounds.csv"), index=False)
+    exponents = scaling_exponents(summary, names)
+    exponents.to_csv(os.path.join(outDir, "scaling_exponents.csv"), index=False)
+    plot_scaling(summary, names, outDir)
+    print(summary.to_string(index=False))
+    if len(exponents) > 0:
+        print(exponents.to_string(index=False))
+        for _, row in exponents.iterrows():
+            if row["time_exponent"] > superlinear_exponent or row["memory_exponent"] > superlinear_exponent:
+                print("WARNING: super-linear scaling with {}: time exponent {:.2f}, memory exponent {:.2f}".format(
+                      row["parameter"], row["time_exponent"], row["memory_exponent"]))
+    return summary, exponents
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the simulation over a parameter grid.')
+    parser.add_argument('-s', '--settings', type=str, default="settings.init", help="base settings file")
+    parser.add_argument('-o', '--output', type=str, default="scaling", help="output directory")
+    parser.add_argument('-r', '--rounds', type=int, default=None, help="override the number of rounds")
+    parser.add_argument('-t', '--timeout', type=float, default=None, help="time limit per run (s)")
+    for name, typ in grid_params:
+        parser.add_argument('--'+name, type=typ, nargs='+')
+    args = parser.parse_args()
+
+    grid = {n: getattr(args, n) for n, t in grid_params if getattr(args, n) is not None}
+    run_grid(args.settings, args.output, grid, rounds=args.rounds, timeout=args.timeout)
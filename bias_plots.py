@@ -3,6 +3,7 @@ from scipy.interpolate import spline
 import matplotlib.pyplot as plt
 
 import Distance
+import utils
 
 d = Distance.Distance()
 
@@ -13,7 +14,7 @@ def bias_avg(seqFile, seqLength):
     w_bias = 0
     totalSeqs = 0
     uniqSeqs = 0
-    with open(seqFile, 'r') as f:
+    with utils.open_round(seqFile) as f:
         for line in f:
             row = line.split()
             seq = row[0]
@@ -31,7 +32,7 @@ def bias_avg_per_dist(seqFile, seqLength):
     w_bias_per_dist = np.zeros(seqLength+5)
     totalSeqs_per_dist = np.zeros(seqLength+5)
     uniqSeqs_per_dist = np.zeros(seqLength+5)
-    with open(seqFile, 'r') as f:
+    with utils.open_round(seqFile) as f:
         for line in f:
             row = line.split()
             #grab sequence
@@ -119,7 +120,7 @@ def distance_range(scale, ref_seq, seqLength, alphabetSet):
 def aptamer_structs(fileNames, seqLength, roundNum, rounds='final'):
     if(rounds == 'final'):
         top_seq_info = [0,0]
-        with open(fileNames+"_R"+str(roundNum), 'r') as f:
+        with utils.open_round(fileNames+"_R"+str(roundNum)) as f:
             for line in f:
                 row = line.split()
                 seq = str(row[0])
@@ -138,7 +139,7 @@ def aptamer_structs(fileNames, seqLength, roundNum, rounds='final'):
     elif(rounds == 'all'):
         top_seqs_info = []
         for rnd in range(roundNum):
-            with open(fileNames+"_R"+str(rnd+1), 'r') as f:
+            with utils.open_round(fileNames+"_R"+str(rnd+1)) as f:
                 for line in f:
                     row = line.split()
                     seq = str(row[0])
@@ -165,7 +166,7 @@ def aptamer_structs(fileNames, seqLength, roundNum, rounds='final'):
 def aptamer_structs_aff(fileNames, seqLength, roundNum, rounds='final'):
     if(rounds == 'final'):
         top_seq_info = [0,0,np.infty]
-        with open(fileNames+"_R"+str(roundNum), 'r') as f:
+        with utils.open_round(fileNames+"_R"+str(roundNum)) as f:
             for line in f:
                 row = line.split()
                 seq = str(row[0])
@@ -187,7 +188,7 @@ def aptamer_structs_aff(fileNames, seqLength, roundNum, rounds='final'):
     elif(rounds == 'all'):
         top_seqs_info = []
         for rnd in range(roundNum):
-            with open(fileNames+"_R"+str(rnd+1), 'r') as f:
+            with utils.open_round(fileNames+"_R"+str(rnd+1)) as f:
                 for line in f:
                     row = line.split()
                     seq = str(row[0])
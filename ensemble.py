@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+# -*- coding: UTF8 -*-
+
+# Replicate ensemble mode.
+#
+# Usage:
+#     python ensemble.py -s settings.init -n 16 -j 4 [--library lib.npz] [--write-rounds]
+#
+# The initial library (round 0 selection, including the distances of all its sequences)
+# is created once, or loaded from --library, and saved to [experiment_name]_library.npz.
+# N replicate simulations then start from it in parallel, each with its own independent
+# random stream derived from random_seed, and output prefix [experiment_name]_repXXX.
+# The per round statistics of every replicate (total and unique sequence numbers,
+# average and weighted average distance) are gathered as the replicates finish into
+#     [experiment_name]_ensemble_replicates.csv   one line per replicate and round
+#     [experiment_name]_ensemble.csv              mean, std and 95% CI over replicates
+# Replicates only write their log, and their round and samples files with --write-rounds.
+# The ensemble runs every replicate in a single process: shards is ignored.
+import argparse
+import contextlib
+import multiprocessing
+import os
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import sim_
+import utils
+
+statNames = ("total", "unique", "avdist", "wavdist")
+
+# initial library inherited by forked replicate processes
+_library = None
+
+
+# This computes the summary statistics of a pool
+def pool_stats(seqPool):
+    data = np.array(list(seqPool.values()))
+    counts = data[:, 0]
+    dists = data[:, 1]
+    return {"total": counts.sum(),
+            "unique": len(counts),
+            "avdist": dists.mean(),
+            "wavdist": (dists*counts).sum()/counts.sum()}
+
+
+# This returns the seeds of the initial library and of each replicate
+def spawn_seeds(rng_seed, replicateNum):
+    ss = np.random.SeedSequence(rng_seed)
+    return [int(child.generate_state(1)[0]) for child in ss.spawn(replicateNum+1)]
+
+
+def build_library(settingsFile, seed, libraryFile):
+    exp = sim_.Experiment(sim_.read_settings(settingsFile))
+    exp.setup(rng_seed=seed, sinks=())
+    library = exp.initial_library()
+    exp.close()
+    utils.save_pool(libraryFile, library, reference=np.array(exp.aptamerSeqs))
+    return library, str(exp.aptamerSeqs)
+
+
+# This runs one replicate from a copy of the initial library and returns its
+# per round statistics
+def run_replicate(args):
+    settingsFile, rep, seed, libraryFile, reference, writeRounds = args
+    settings = sim_.read_settings(settingsFile)
+    prefix = "{}_rep{:03d}".format(settings.get('general', 'experiment_name'), rep)
+    sim_.override_settings(settings, {"experiment_name": prefix})
+    exp = sim_.Experiment(settings)
+    library = _library if _library is not None else utils.load_pool(libraryFile)[0]
+    rows = []
+
+    def record(r, seqPool):
+        row = {"replicate": rep, "round": r}
+        row.update(pool_stats(seqPool))
+        rows.append(row)
+
+    with open(prefix+".log", 'w') as log, contextlib.redirect_stdout(log):
+        exp.setup(rng_seed=seed, reference=reference, sinks=("rounds", "samples") if writeRounds else ())
+        exp.run({k: v.copy() for k, v in library.items()}, writeRounds=writeRounds, callback=record)
+    return rows
+
+
+# This computes the mean, standard deviation and 95% confidence interval of the
+# statistics of each round over the replicates
+def aggregate(replicates):
+    grouped = replicates.groupby("round")
+    agg = pd.DataFrame(index=grouped.size().index)
+    agg["replicates"] = grouped.size()
+    for name in statNames:
+        mean = grouped[name].mean()
+        std = grouped[name].std(ddof=1)
+        n = agg["replicates"]
+        half = stats.t.ppf(0.975, np.maximum(n-1, 1))*std/np.sqrt(n)
+        agg[name+"_mean"] = mean
+        agg[name+"_std"] = std
+        agg[name+"_ci_low"] = mean-half
+        agg[name+"_ci_high"] = mean+half
+    return agg
+
+
+def run_ensemble(settingsFile, replicateNum, jobs=1, libraryFile=None, writeRounds=False):
+    global _library
+    settings = sim_.read_settings(settingsFile)
+    outputFileNames = settings.get('general', 'experiment_name')
+    if settings.getint('general', 'shards') > 1:
+        print("Warning: shards is ignored, every replicate runs in a single process (use --jobs to "
+              "run replicates in parallel)")
+    rng_seed = settings.getint('general', 'random_seed')
+    if rng_seed == 0:
+        rng_seed = random.randint(0, 2**32)
+    print("Random seed: {}".format(rng_seed))
+    seeds = spawn_seeds(rng_seed, replicateNum)
+
+    if libraryFile is None:
+        libraryFile = outputFileNames+"_library.npz"
+        print("Creating initial library...", flush=True)
+        _library, reference = build_library(settingsFile, seeds[0], libraryFile)
+    else:
+        print("Loading initial library from {}".format(libraryFile), flush=True)
+        _library, extra = utils.load_pool(libraryFile)
+        reference = str(extra["reference"])
+    print("Initial library: {} unique sequences, reference {}".format(len(_library), reference))
+
+    tasks = [(settingsFile, rep, seeds[rep+1], libraryFile, reference, writeRounds)
+             for rep in range(replicateNum)]
+    replicateFile = outputFileNames+"_ensemble_replicates.csv"
+    ensembleFile = outputFileNames+"_ensemble.csv"
+    rows = []
+
+    def collect(repRows, n):
+        rows.extend(repRows)
+        replicates = pd.DataFrame(rows)
+        replicates.to_csv(replicateFile, index=False)
+        aggregate(replicates).to_csv(ensembleFile)
+        print("{}/{} replicates completed".format(n, replicateNum), flush=True)
+
+    if jobs > 1:
+        # forked workers share the initial library with the parent instead of loading it
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+        if ctx.get_start_method() != "fork":
+            _library = None
+        with ctx.Pool(processes=jobs) as pool:
+            for n, repRows in enumerate(pool.imap_unordered(run_replicate, tasks)):
+                collect(repRows, n+1)
+    else:
+        for n, task in enumerate(tasks):
+            collect(run_replicate(task), n+1)
+    print(aggregate(pd.DataFrame(rows))[[s+"_mean" for s in statNames]])
+    print("Ensemble statistics written to {}".format(ensembleFile))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run replicate simulations from one initial library.')
+    parser.add_argument('-s', '--settings', type=str, default="settings.init")
+    parser.add_argument('-n', '--replicates', type=int, default=10)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--library', type=str, default=None, help="load the initial library from this file")
+    parser.add_argument('--write-rounds', action='store_true', help="write the round and samples files of every replicate")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.settings):
+        print("Settings file '{}' does not exists, aborting.".format(args.settings))
+        sys.exit()
+
+    run_ensemble(args.settings, args.replicates, jobs=args.jobs, libraryFile=args.library,
+                 writeRounds=args.write_rounds)
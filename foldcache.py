@@ -0,0 +1,77 @@
+import sqlite3
+
+# number of new entries kept in memory before they are written to the database
+Nflush = 10000
+
+
+# Persistent cache of secondary structures and fold-based distances.
+# Entries are kept in an sqlite database so that the cache can be shared between the
+# runs of a sweep, including runs executing at the same time in other processes:
+# lookups go to an in-memory dict first and to the database on a miss, new entries are
+# buffered and written in batches (existing entries are never overwritten).
+# Structures are keyed by sequence and distances by (metric key, sequence), where the
+# metric key identifies the metric and the reference (see Distance.cached).
+class FoldCache:
+    def __init__(self, fileName, flushSize=Nflush):
+        self.fileName = fileName
+        self.flushSize = flushSize
+        self.folds = dict()
+        self.dists = dict()
+        self.newFolds = []
+        self.newDists = []
+        self.conn = sqlite3.connect(fileName, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS folds (seq TEXT PRIMARY KEY, struct TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dists (metric TEXT, seq TEXT, dist REAL, "
+                          "PRIMARY KEY (metric, seq))")
+        self.conn.commit()
+
+    def get_fold(self, seq):
+        struct = self.folds.get(seq)
+        if struct is None:
+            row = self.conn.execute("SELECT struct FROM folds WHERE seq=?", (seq,)).fetchone()
+            if row is not None:
+                struct = row[0]
+                self.folds[seq] = struct
+        return struct
+
+    def put_fold(self, seq, struct):
+        self.folds[seq] = struct
+        self.newFolds.append((seq, struct))
+        if len(self.newFolds) >= self.flushSize:
+            self.flush()
+
+    def get_dist(self, metric, seq):
+        d = self.dists.get((metric, seq))
+        if d is None:
+            row = self.conn.execute("SELECT dist FROM dists WHERE metric=? AND seq=?",
+                                    (metric, seq)).fetchone()
+            if row is not None:
+                d = row[0]
+                self.dists[(metric, seq)] = d
+        return d
+
+    def put_dist(self, metric, seq, d):
+        self.dists[(metric, seq)] = d
+        self.newDists.append((metric, seq, float(d)))
+        if len(self.newDists) >= self.flushSize:
+            self.flush()
+
+    # This writes the buffered entries to the database
+    def flush(self):
+        if len(self.newFolds) == 0 and len(self.newDists) == 0:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO folds VALUES (?, ?)", self.newFolds)
+            self.conn.executemany("INSERT OR IGNORE INTO dists VALUES (?, ?, ?)", self.newDists)
+        self.newFolds = []
+        self.newDists = []
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM folds").fetchone()[0]
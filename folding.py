@@ -0,0 +1,222 @@
+import numpy as np
+
+# Fold backends: the ways secondary structures are predicted (see Distance.fold).
+# Every backend is a class registered under its name with @backend(name), used as
+#     folder = folding.create(name)
+#     struct = folder.fold(seq)               # dot-bracket structure
+#     structs = folder.fold_batch(seqs)       # list of structures
+#     d = folder.bp_distance(struct1, struct2)
+# Backends declare whether their structures are the exact minimum free energy structures
+# (exact): the fold cache only stores exact structures, and the distances computed with an
+# approximate backend are stored under keys prefixed with its name.
+#   vienna: minimum free energy structures computed by ViennaRNA (exact)
+#   stem:   approximate structures found by a greedy stem search, vectorised over batches
+#           of sequences, which does not need ViennaRNA. It is meant for exploratory runs
+#           and benchmarks, not for production runs.
+
+# registered backends, by name
+backends = dict()
+
+
+def backend(name):
+    def register(cls):
+        cls.name = name
+        backends[name] = cls
+        return cls
+    return register
+
+
+def create(name):
+    if name not in backends:
+        raise ValueError("fold backend must be one of {}".format(", ".join(backends)))
+    return backends[name]()
+
+
+# The vienna backend needs the ViennaRNA Python package
+def rna_module():
+    try:
+        import RNA
+    except ImportError:
+        raise ImportError("the vienna fold backend requires the ViennaRNA Python package "
+                          "(see README), use the stem fold backend without it")
+    return RNA
+
+
+# This returns the set of base pairs (i, j) of a dot-bracket structure
+def pairs(struct):
+    stack = []
+    bps = set()
+    for i, c in enumerate(struct):
+        if c == '(':
+            stack.append(i)
+        elif c == ')':
+            bps.add((stack.pop(), i))
+    return bps
+
+
+class Folder:
+    name = None
+    exact = False
+
+    def available(self):
+        return True
+
+    def fold(self, seq):
+        return self.fold_batch([seq])[0]
+
+    def fold_batch(self, seqs):
+        return [self.fold(seq) for seq in seqs]
+
+    # This returns the number of base pairs found in only one of the structures
+    def bp_distance(self, struct1, struct2):
+        return len(pairs(struct1) ^ pairs(struct2))
+
+    def energy(self, seq, mode="mfe", target=None, temperature=37.0):
+        raise NotImplementedError("the {} fold backend does not compute free energies".format(self.name))
+
+
+@backend("vienna")
+class ViennaFolder(Folder):
+    exact = True
+
+    def __init__(self):
+        self.RNA = None
+        # ViennaRNA model details, by temperature
+        self.models = dict()
+
+    def available(self):
+        try:
+            self.rna()
+        except ImportError:
+            return False
+        return True
+
+    def rna(self):
+        if self.RNA is None:
+            self.RNA = rna_module()
+        return self.RNA
+
+    # This returns the ViennaRNA model details (energy parameters) at the given
+    # temperature, which are set up once and reused by every fold compound
+    def model(self, temperature=37.0):
+        if temperature not in self.models:
+            md = self.rna().md()
+            md.temperature = temperature
+            self.models[temperature] = md
+        return self.models[temperature]
+
+    def fold(self, seq):
+        return self.rna().fold_compound(seq, self.model()).mfe()[0]
+
+    def bp_distance(self, struct1, struct2):
+        return self.rna().bp_distance(struct1, struct2)
+
+    # This returns the minimum free energy of the fold of a sequence (mode mfe), the free
+    # energy of its ensemble of structures (mode ensemble), or, with a target sequence,
+    # the minimum free energy of its duplex with the target
+    def energy(self, seq, mode="mfe", target=None, temperature=37.0):
+        RNA = self.rna()
+        if target:
+            return RNA.fold_compound(seq+"&"+target, self.model(temperature)).mfe_dimer()[1]
+        fc = RNA.fold_compound(seq, self.model(temperature))
+        mfe = fc.mfe()[1]
+        if mode == "ensemble":
+            # scale the Boltzmann factors with the mfe to avoid overflows
+            fc.exp_params_rescale(mfe)
+            return fc.pf()[1]
+        return mfe
+
+
+# codes of the nucleotides (T and U are the same), 4 for anything else
+codes = np.full(256, 4, dtype=np.uint8)
+for c, code in zip("ACGTU", (0, 1, 2, 3, 3)):
+    codes[ord(c)] = code
+    codes[ord(c.lower())] = code
+
+# weights of the base pairs, by nucleotide codes: the number of hydrogen bonds of the
+# Watson-Crick pairs, 1 for GU wobble pairs, 0 for the pairs that cannot form
+pairWeights = np.zeros((5, 5))
+pairWeights[0, 3] = pairWeights[3, 0] = 2
+pairWeights[1, 2] = pairWeights[2, 1] = 3
+pairWeights[2, 3] = pairWeights[3, 2] = 1
+
+
+# Greedy stem search: the stem (run of stacked pairs closing a hairpin loop of at least
+# minLoop nucleotides) of highest total pair weight is formed first, then the best stem
+# compatible with the stems already formed (nested, without pseudoknots), and so on while
+# stems of at least minStem pairs and of weight at least minWeight can be formed.
+# Sequences of the same length are processed in batches, as arrays of nucleotide codes.
+@backend("stem")
+class StemFolder(Folder):
+    def __init__(self, minStem=3, minWeight=7, minLoop=3, batchSize=2**22):
+        self.minStem = minStem
+        self.minWeight = minWeight
+        self.minLoop = minLoop
+        # maximum number of entries of the pair matrices of a batch
+        self.batchSize = batchSize
+
+    def fold_batch(self, seqs):
+        structs = [None]*len(seqs)
+        byLength = dict()
+        for n, seq in enumerate(seqs):
+            byLength.setdefault(len(seq), []).append(n)
+        for L, where in byLength.items():
+            step = max(1, self.batchSize//max(1, L*L))
+            for start in range(0, len(where), step):
+                part = where[start:start+step]
+                encoded = codes[np.frombuffer("".join(seqs[n] for n in part).encode(), dtype=np.uint8)]
+                for n, struct in zip(part, self.fold_codes(encoded.reshape(len(part), L))):
+                    structs[n] = struct
+        return structs
+
+    # This returns the structures of a (batch, length) array of nucleotide codes.
+    # The pair matrices are laid out as (length, length, batch) arrays so that the stem
+    # search runs over contiguous slices, and only the sequences that formed a stem in the
+    # previous pass are searched again.
+    def fold_codes(self, seqCodes):
+        B, L = seqCodes.shape
+        out = np.full((B, L), ord('.'), dtype=np.uint8)
+        if L == 0:
+            return [""]*B
+        pos = np.arange(L)
+        a, b = pos[:, None, None], pos[None, :, None]
+        weights = pairWeights[seqCodes.T[:, None, :], seqCodes.T[None, :, :]].astype(np.float32)
+        weights[(b - a <= self.minLoop)[:, :, 0]] = 0
+        active = np.arange(B)
+        while len(active) > 0:
+            score, length = self.stems(weights)
+            score[length < self.minStem] = 0
+            best = score.reshape(L*L, -1).argmax(axis=0)
+            cols = np.arange(len(active))
+            i, j = best//L, best % L
+            k = length[i, j, cols].astype(np.int64)
+            formed = score[i, j, cols] >= self.minWeight
+            if not formed.any():
+                break
+            rows = active[formed]
+            i, j, k = i[formed], j[formed], k[formed]
+            for t in range(k.max()):
+                sel = t < k
+                out[rows[sel], i[sel]+t] = ord('(')
+                out[rows[sel], j[sel]-t] = ord(')')
+            # keep the pairs inside the loop closed by the stem, or outside the stem
+            weights = weights[:, :, formed]
+            weights *= (((a > i+k-1) & (b < j-k+1)) | (b < i) | (a > j) | ((a < i) & (b > j)))
+            active = rows
+        return [row.tobytes().decode() for row in out]
+
+    # This returns, for every pair (i, j), the total weight and the number of the stacked
+    # pairs (i, j), (i+1, j-1), ... that can form
+    def stems(self, weights):
+        L = weights.shape[0]
+        score = np.zeros_like(weights)
+        length = np.zeros(weights.shape, dtype=np.int8)
+        score[L-1] = weights[L-1]
+        length[L-1] = weights[L-1] > 0
+        for i in range(L-2, -1, -1):
+            can = weights[i, 1:] > 0
+            score[i, 1:] = np.where(can, weights[i, 1:] + score[i+1, :-1], 0)
+            length[i, 1:] = np.where(can, length[i+1, :-1] + 1, 0)
+            score[i, 0] = weights[i, 0]
+            length[i, 0] = weights[i, 0] > 0
+        return score, length
@@ -0,0 +1,131 @@
+import json
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# Global event counters (folds performed, cache hits/misses, random draws, time spent
+# in sub-steps, ...). The simulation modules increment them through count() and
+# Instrument reports the increments seen during each stage.
+# They can be incremented from background threads (see roundwriter.RoundWriter).
+counters = Counter()
+_lock = threading.Lock()
+
+
+def count(name, n=1):
+    with _lock:
+        counters[name] += n
+
+
+# This returns a copy of the counters
+def snapshot():
+    with _lock:
+        return counters.copy()
+
+
+# This accumulates the wall time spent in the enclosed block under counters[name]
+@contextmanager
+def timed(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(name, time.perf_counter() - t0)
+
+
+# This returns the peak resident set size of the process in bytes
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return int(maxrss)
+    return int(maxrss)*1024
+
+
+# This records, for each stage of each round, the wall and CPU time, the memory peaks,
+# the size of the pool and the counter increments, and appends them as one JSON
+# object per line to fileName. The items of info (e.g. the kernels used) are added to
+# every record.
+class Instrument:
+    def __init__(self, fileName=None, traceMemory=False, info=None):
+        self.fileName = fileName
+        self.traceMemory = traceMemory
+        self.info = dict(info or {})
+        self.records = []
+        self.out = None
+        if self.fileName is not None:
+            self.out = open(self.fileName, 'w')
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # Usage:
+    #     with instr.stage(r, "selection") as st:
+    #         pool = ...
+    #         st["pool"] = pool
+    # Any other key set on st is written to the record as is.
+    @contextmanager
+    def stage(self, rnd, name):
+        record = {"round": rnd, "stage": name}
+        record.update(self.info)
+        c0 = snapshot()
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - wall0
+            record["cpu_time"] = time.process_time() - cpu0
+            record["peak_rss"] = peak_rss()
+            if self.traceMemory:
+                record["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1]
+            pool = record.pop("pool", None)
+            if pool is not None:
+                record["total"] = int(sum(v[0] for v in pool.values()))
+                record["unique"] = len(pool)
+            delta = snapshot()
+            delta.subtract(c0)
+            record["counters"] = {k: v for k, v in delta.items() if v != 0}
+            record.update(hit_rates(record["counters"]))
+            self.write(record)
+
+    def write(self, record):
+        self.records.append(record)
+        if self.out is not None:
+            self.out.write(json.dumps(record, default=to_builtin)+'\n')
+            self.out.flush()
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+
+# This converts numpy scalars found in records into plain python numbers
+def to_builtin(obj):
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+# This computes <name>_hit_rate for every pair of <name>_hits/<name>_misses counters
+def hit_rates(cnts):
+    rates = dict()
+    names = set(k[:-len("_hits")] for k in cnts if k.endswith("_hits"))
+    names |= set(k[:-len("_misses")] for k in cnts if k.endswith("_misses"))
+    for name in names:
+        hits = cnts.get(name+"_hits", 0)
+        total = hits + cnts.get(name+"_misses", 0)
+        if total > 0:
+            rates[name+"_hit_rate"] = hits / total
+    return rates
+
+
+# This reads a stats file written by Instrument back into a list of records
+def read_stats(fileName):
+    with open(fileName, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
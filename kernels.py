@@ -0,0 +1,122 @@
+import importlib.util
+
+import numpy as np
+
+# Kernels of the sequential inner loops of the simulation, working on NumPy arrays:
+#     n = kernels.select_threshold(pos, thresholds, dists, counts)
+#     starts, stops = kernels.loop_bounds(structCodes, seqLength)
+#     d = kernels.levenshtein(loop1Codes, loop2Codes)
+# Every kernel has a NumPy implementation (below) and a compiled one (numbakernels.py)
+# giving the same results. The kernels draw no random numbers: they work on the draws
+# made by the simulation with NumPy and the random module, so the random streams, and
+# the results of a seeded run, do not depend on the kernels used.
+# The kernels are chosen once per process with use(name):
+#   auto:  numba when the numba package is installed, numpy otherwise
+#   numba: the compiled kernels, which are compiled on their first call and cached on disk
+#   numpy: the NumPy implementations
+kernelNames = ("auto", "numba", "numpy")
+
+# name of the kernels in use
+current = "numpy"
+
+# codes of the dot-bracket characters
+OPEN, CLOSE = ord('('), ord(')')
+
+
+def available():
+    return importlib.util.find_spec("numba") is not None
+
+
+# The numba kernels need the numba package
+def numba_module():
+    try:
+        import numbakernels
+    except ImportError:
+        raise ImportError("the numba kernels require the numba package, "
+                          "use the auto or numpy kernels without it")
+    return numbakernels
+
+
+# This chooses the kernels used by the process and returns the name of the kernels chosen
+def use(name):
+    global current, select_threshold, loop_bounds, levenshtein
+    if name not in kernelNames:
+        raise ValueError("kernels must be one of {}".format(", ".join(kernelNames)))
+    if name == "auto":
+        name = "numba" if available() else "numpy"
+    module = numba_module() if name == "numba" else numpy_kernels
+    select_threshold = module.select_threshold
+    loop_bounds = module.loop_bounds
+    levenshtein = module.levenshtein
+    current = name
+    return name
+
+
+# This carries out the threshold selection of a batch of draws (see
+# Selection.selectionProcess): the sequence at position pos[i] of the pool passes when
+# its distance dists[pos[i]] is smaller than thresholds[i], and its count in counts is
+# then incremented. It returns the number of draws that passed.
+def numpy_select_threshold(pos, thresholds, dists, counts):
+    passed = pos[dists[pos] < thresholds]
+    counts += np.bincount(passed, minlength=len(counts))
+    return len(passed)
+
+
+# This returns the bounds of the loop region of each structure of a (batch, length) array
+# of dot-bracket codes, such that seq[start:stop] is the loop found by Distance.seq_loop:
+# the region between the first ')' and the last '(' before it, the dangling end after the
+# last '(' when no ')' is found before the last two positions, the whole sequence when the
+# structure has no pair
+def numpy_loop_bounds(structs, seqLength):
+    structs = np.asarray(structs, dtype=np.uint8).reshape(len(structs), -1)
+    B = len(structs)
+    starts = np.zeros(B, dtype=np.int64)
+    stops = np.full(B, seqLength, dtype=np.int64)
+    if seqLength < 2:
+        return starts, stops
+    pos = np.arange(seqLength-1)
+    # first ')' among the positions 0..seqLength-2 that Distance.seq_loop scans
+    closing = structs[:, :seqLength-1] == CLOSE
+    first = np.where(closing.any(axis=1), closing.argmax(axis=1), seqLength-1)
+    # loop closed by the first ')': it starts after the last '(' before it
+    inner = first < seqLength-2
+    opening = (structs[:, :seqLength-1] == OPEN) & (pos < first[:, None])
+    last = (seqLength-2) - opening[:, ::-1].argmax(axis=1)
+    starts[inner] = last[inner] + 1
+    stops[inner] = first[inner]
+    # dangling end: the scan starts again from position seqLength-2
+    dangling = ~inner
+    if seqLength > 2:
+        opening = (structs[:, :seqLength-2] == OPEN)
+        last = (seqLength-3) - opening[:, ::-1].argmax(axis=1)
+        starts[dangling] = np.where(opening.any(axis=1), last, 0)[dangling]
+    starts[dangling & (structs[:, seqLength-2] == OPEN)] = seqLength-1
+    return starts, stops
+
+
+# This returns the distance between two loops (arrays of nucleotide codes) computed by
+# Distance.lavenshtein_func
+def numpy_levenshtein(loop1, loop2):
+    if len(loop1) < len(loop2):
+        loop1, loop2 = loop2, loop1
+    if len(loop2) == 0:
+        return len(loop1)
+    prev_row = np.arange(loop2.size + 1)
+    for nt in loop1:
+        curr_row = prev_row + 1
+        curr_row[1:] = np.minimum(curr_row[1:], np.add(prev_row[:-1], loop2 != nt))
+        curr_row[1:] = np.minimum(curr_row[1:], curr_row[0:-1] + 1)
+        prev_row = curr_row
+    return int(prev_row[-1])
+
+
+# the NumPy kernels, with the names of the compiled ones
+class numpy_kernels:
+    select_threshold = staticmethod(numpy_select_threshold)
+    loop_bounds = staticmethod(numpy_loop_bounds)
+    levenshtein = staticmethod(numpy_levenshtein)
+
+
+select_threshold = numpy_select_threshold
+loop_bounds = numpy_loop_bounds
+levenshtein = numpy_levenshtein
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import weakref
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+# This is a pool of sequences stored on disk, with the same interface as the in memory
+# pool, i.e. a mapping {seqIdx: np.array([count, distance, bias])} whose rows can be
+# modified in place (pool[seqIdx][0] += 1).
+# Entries are kept in two parts:
+#   - the base, sorted by index, in memory-mapped files (index and count, distance, bias
+#     columns) in which entries are found by binary search. Deleted entries are marked
+#     with a NaN count until the next merge.
+#   - the delta, a dict of at most chunkSize entries added since the last merge, which
+#     is merged into the base (external sort/merge, chunkSize entries at a time) when full.
+# Sequence indices must fit in signed 64 bit integers (sequences of up to 31 nt).
+# The files are created in a temporary directory inside directory, removed when the
+# pool is closed or garbage collected.
+class MemmapPool(MutableMapping):
+    def __init__(self, directory=None, chunkSize=10**6):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="selex_pool_", dir=directory or None)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self.chunkSize = chunkSize
+        self.keys_ = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros((0, 3))
+        self.delta = dict()
+        self.nbase = 0
+        self.generation = 0
+
+    def _memmap(self, name, dtype, shape):
+        fileName = os.path.join(self.directory, "{}{}.dat".format(name, self.generation))
+        return np.memmap(fileName, dtype=dtype, mode="w+", shape=shape)
+
+    # This returns the position of seqIdx in the base, or -1
+    def _find(self, seqIdx):
+        seqIdx = int(seqIdx)
+        if self.nbase == 0 or not -2**63 <= seqIdx < 2**63:
+            return -1
+        i = int(np.searchsorted(self.keys_, seqIdx))
+        if i < len(self.keys_) and self.keys_[i] == seqIdx and not np.isnan(self.data[i, 0]):
+            return i
+        return -1
+
+    def __getitem__(self, seqIdx):
+        if seqIdx in self.delta:
+            return self.delta[seqIdx]
+        i = self._find(seqIdx)
+        if i < 0:
+            raise KeyError(seqIdx)
+        return self.data[i]
+
+    def __contains__(self, seqIdx):
+        return seqIdx in self.delta or self._find(seqIdx) >= 0
+
+    def __setitem__(self, seqIdx, value):
+        seqIdx = int(seqIdx)
+        i = self._find(seqIdx)
+        if i >= 0:
+            self.data[i] = value
+            return
+        if len(self.keys_) > 0 and -2**63 <= seqIdx < 2**63:
+            # deleted entries of the base are reused
+            i = int(np.searchsorted(self.keys_, seqIdx))
+            if i < len(self.keys_) and self.keys_[i] == seqIdx:
+                self.data[i] = value
+                self.nbase += 1
+                return
+        if not -2**63 <= seqIdx < 2**63:
+            raise ValueError("Sequence index {} does not fit in 64 bits".format(seqIdx))
+        self.delta[seqIdx] = np.array(value, dtype=np.float64)
+        if len(self.delta) >= self.chunkSize:
+            self.merge()
+
+    def __delitem__(self, seqIdx):
+        if seqIdx in self.delta:
+            del self.delta[seqIdx]
+            return
+        i = self._find(seqIdx)
+        if i < 0:
+            raise KeyError(seqIdx)
+        self.data[i, 0] = np.nan
+        self.nbase -= 1
+
+    def __len__(self):
+        return self.nbase + len(self.delta)
+
+    # Entries of the base are listed in order of index, then those of the delta
+    def __iter__(self):
+        for start in range(0, len(self.keys_), self.chunkSize):
+            live = ~np.isnan(self.data[start:start+self.chunkSize, 0])
+            yield from self.keys_[start:start+self.chunkSize][live].tolist()
+        yield from list(self.delta)
+
+    # This yields the indices and rows (copies) of the pool, chunkSize entries at a time
+    def chunks(self):
+        for start in range(0, len(self.keys_), self.chunkSize):
+            data = self.data[start:start+self.chunkSize]
+            live = ~np.isnan(data[:, 0])
+            yield self.keys_[start:start+self.chunkSize][live], data[live]
+        if len(self.delta) > 0:
+            yield (np.fromiter(self.delta, dtype=np.int64, count=len(self.delta)),
+                   np.array(list(self.delta.values())).reshape(-1, 3))
+
+    # This returns the indices and rows of the whole pool as arrays in memory
+    def arrays(self):
+        parts = list(self.chunks())
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    # This sets the count of every entry to zero
+    def reset_counts(self):
+        for start in range(0, len(self.keys_), self.chunkSize):
+            counts = self.data[start:start+self.chunkSize, 0]
+            counts[~np.isnan(counts)] = 0
+        for v in self.delta.values():
+            v[0] = 0
+
+    # This removes the entries with a zero count
+    def remove_zero(self):
+        for start in range(0, len(self.keys_), self.chunkSize):
+            counts = self.data[start:start+self.chunkSize, 0]
+            zero = counts == 0
+            counts[zero] = np.nan
+            self.nbase -= int(zero.sum())
+        for k in [k for k, v in self.delta.items() if v[0] == 0]:
+            del self.delta[k]
+
+    # This merges the delta into the base, dropping the deleted entries of the base.
+    # The base is read and the new base written chunkSize entries at a time.
+    def merge(self):
+        dk = np.fromiter(self.delta, dtype=np.int64, count=len(self.delta))
+        order = np.argsort(dk, kind="stable")
+        dk = dk[order]
+        dd = np.array(list(self.delta.values())).reshape(-1, 3)[order]
+        n = self.nbase + len(dk)
+        oldFiles = [getattr(a, "filename", None) for a in (self.keys_, self.data)]
+        self.generation += 1
+        if n == 0:
+            keys, data = np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+        else:
+            keys = self._memmap("keys", np.int64, (n,))
+            data = self._memmap("data", np.float64, (n, 3))
+        out = 0
+        j = 0
+        for start in range(0, len(self.keys_), self.chunkSize):
+            bk = self.keys_[start:start+self.chunkSize]
+            bd = self.data[start:start+self.chunkSize]
+            live = ~np.isnan(bd[:, 0])
+            bk, bd = bk[live], bd[live]
+            if len(bk) == 0:
+                continue
+            # the delta entries that sort before the end of this chunk
+            end = int(np.searchsorted(dk, bk[-1], side="right"))
+            ck = np.concatenate([bk, dk[j:end]])
+            cd = np.concatenate([bd, dd[j:end]])
+            o = np.argsort(ck, kind="stable")
+            keys[out:out+len(ck)] = ck[o]
+            data[out:out+len(ck)] = cd[o]
+            out += len(ck)
+            j = end
+        keys[out:] = dk[j:]
+        data[out:] = dd[j:]
+        if n > 0:
+            keys.flush()
+            data.flush()
+        self.keys_, self.data = keys, data
+        self.delta = dict()
+        self.nbase = n
+        for fileName in oldFiles:
+            if fileName is not None and os.path.exists(fileName):
+                os.remove(fileName)
+
+    def close(self):
+        self.keys_ = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros((0, 3))
+        self.delta = dict()
+        self.nbase = 0
+        self._finalizer()
@@ -0,0 +1,259 @@
+import numpy as np
+
+import utils
+
+# Distance metrics measuring the affinity of sequences to the reference aptamers.
+# Every metric is a class registered under its name with @metric(name), used as
+#     m = metrics.create(name, dist, apt).prepare(reference)
+#     distances = m.evaluate(indices)    # or m.distances(seqs), m.func()(seq)
+# where dist is a Distance (folds, fold cache, see folding.py for the fold backends) and reference the reference aptamer(s)
+# (see utils.references). A metric only has to define sequence(seq), the distance of one
+# sequence to the nearest reference; it can override distances(seqs) with a batch kernel.
+# Metrics declare
+#   - their cost: "vector" when computed for many sequences at once, "sequence" when
+#     computed one sequence at a time, "fold" when every sequence is folded (these are
+#     computed in parallel for the initial library when jobs > 1)
+#   - whether their values are stored in the fold cache (cacheable), under key()
+#   - how selection uses their values: as distances compared with a random threshold in
+#     Selection.selectionProcess (threshold), or through the binding probability
+#     given by acceptance()
+#   - the dissociation constant of the sequences relative to that of the references, given
+#     by dissociation(), for the equilibrium selection model (see Selection.free_target)
+# Options of the metrics (e.g. the energy model) are given as keyword arguments to create,
+# each metric ignoring the options it does not use.
+
+# registered metrics, by name
+metrics = dict()
+
+
+def metric(name):
+    def register(cls):
+        cls.name = name
+        metrics[name] = cls
+        return cls
+    return register
+
+
+def create(name, dist, apt=None, **options):
+    if name not in metrics:
+        raise ValueError("distance must be one of {}".format(", ".join(metrics)))
+    return metrics[name](dist, apt, **options)
+
+
+class Metric:
+    name = None
+    cost = "sequence"
+    cacheable = False
+    threshold = True
+
+    # apt (an Aptamers) is only needed to evaluate sequence indices.
+    # kdFactor is the factor by which each unit of distance multiplies the dissociation
+    # constant
+    def __init__(self, dist, apt=None, kdFactor=2.0, **options):
+        self.dist = dist
+        self.apt = apt
+        self.kdFactor = kdFactor
+        self.refs = None
+
+    # the Distance object (and its fold cache) is set again in the process that uses it
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["dist"] = None
+        return state
+
+    # This computes what the metric needs to know about the references, once
+    def prepare(self, reference):
+        self.refs = utils.references(reference)
+        return self
+
+    # This identifies the metric and the references in the fold cache
+    def key(self):
+        return "{}:{}".format(self.name, ",".join(self.refs))
+
+    def sequence(self, seq):
+        raise NotImplementedError
+
+    # This returns the distance function of a single sequence, going through the fold
+    # cache for cacheable metrics
+    def func(self):
+        if self.cacheable:
+            return self.dist.cached(self.key(), self.sequence)
+        return self.sequence
+
+    def distances(self, seqs):
+        distance = self.func()
+        return np.array([distance(seq) for seq in seqs], dtype=int).reshape(-1)
+
+    def evaluate(self, indices):
+        return self.distances(self.apt.pseudoAptamerGenerator_batch(indices))
+
+    # This returns the probability for sequences of the given values to pass selection.
+    # For threshold metrics a sequence passes when its distance is smaller than a random
+    # integer drawn in [0, seqLength-stringency] (see Selection.selectionProcess)
+    def acceptance(self, values, seqLength, stringency):
+        top = seqLength - stringency
+        return np.clip((top - np.asarray(values, dtype=np.float64))/(top + 1), 0, 1)
+
+    # This returns the dissociation constant of sequences of the given values relative to
+    # that of the references
+    def dissociation(self, values):
+        return np.power(float(self.kdFactor), np.asarray(values, dtype=np.float64))
+
+
+@metric("hamming")
+class Hamming(Metric):
+    cost = "vector"
+
+    def sequence(self, seq):
+        return self.dist.hamming_min_func(self.refs, seq)
+
+    def distances(self, seqs):
+        return self.dist.hamming_matrix(self.refs, list(seqs)).min(axis=1)
+
+
+# Metrics computed from the secondary structure of the sequences define structure(seq,
+# struct) instead of sequence(seq), so that batches of sequences are folded at once
+# (see Distance.fold_batch)
+class StructureMetric(Metric):
+    cost = "fold"
+    cacheable = True
+
+    def prepare(self, reference):
+        Metric.prepare(self, reference)
+        self.structs = self.dist.fold_batch(self.refs)
+        return self
+
+    def structure(self, seq, struct):
+        raise NotImplementedError
+
+    def sequence(self, seq):
+        return self.structure(seq, self.dist.fold(seq))
+
+    def structures(self, seqs):
+        return [self.structure(seq, struct) for seq, struct in zip(seqs, self.dist.fold_batch(seqs))]
+
+    def distances(self, seqs):
+        seqs = list(seqs)
+        if self.cacheable:
+            values = self.dist.cached_batch(self.key(), seqs, self.structures)
+        else:
+            values = self.structures(seqs)
+        return np.array(values, dtype=int).reshape(-1)
+
+
+@metric("basepair")
+class BasePair(StructureMetric):
+    def key(self):
+        return "basepair:"+",".join(self.structs)
+
+    def structure(self, seq, struct):
+        return self.dist.bp_min_struct(self.structs, struct)
+
+
+@metric("loop")
+class Loop(StructureMetric):
+    def prepare(self, reference):
+        StructureMetric.prepare(self, reference)
+        self.loops = [utils.apt_loopFinder(seq, struct, len(seq)) for seq, struct in zip(self.refs, self.structs)]
+        return self
+
+    def structure(self, seq, struct):
+        return self.dist.loop_min_struct(self.refs, self.structs, self.loops, len(seq), seq, struct)
+
+    # the loops of the batch are found at once (see kernels.loop_bounds)
+    def structures(self, seqs):
+        byLength = dict()
+        for n, seq in enumerate(seqs):
+            byLength.setdefault(len(seq), []).append(n)
+        structs = self.dist.fold_batch(seqs)
+        values = [None]*len(seqs)
+        for L, where in byLength.items():
+            loops = self.dist.seq_loops([seqs[n] for n in where], [structs[n] for n in where], L)
+            for n, loop in zip(where, loops):
+                values[n] = self.dist.loop_min_loop(self.structs, self.loops, structs[n], loop)
+        return values
+
+
+@metric("random")
+class Random(Metric):
+    cost = "vector"
+
+    def sequence(self, seq):
+        return self.dist.nodist_func(self.refs, seq)
+
+    def distances(self, seqs):
+        return np.full(len(seqs), -1, dtype=int)
+
+
+# Free energy based affinity. The value of a sequence is its free energy (see
+# Distance.energy: mfe, ensemble, or duplex with energyTarget when one is given) minus that of
+# the best reference, in units of 0.1 kcal/mol (negative for sequences more stable than the
+# references). Energies are stored in the fold cache, independently of the references.
+# A sequence binds the target with probability 1/(1+exp((dG - energyThreshold)/RT)),
+# where dG is its free energy difference with the best reference in kcal/mol, and its
+# dissociation constant is exp(dG/RT) times that of the best reference.
+@metric("energy")
+class Energy(Metric):
+    cost = "fold"
+    cacheable = True
+    threshold = False
+
+    def __init__(self, dist, apt=None, energyMode="mfe", energyTarget="", energyThreshold=2.0,
+                 temperature=37.0, **options):
+        Metric.__init__(self, dist, apt, **options)
+        self.mode = energyMode
+        self.target = energyTarget
+        self.energyThreshold = energyThreshold
+        self.temperature = temperature
+
+    def prepare(self, reference):
+        Metric.prepare(self, reference)
+        self.refEnergy = min(self.energy(seq) for seq in self.refs)
+        return self
+
+    def key(self):
+        return "energy:{}:{}:{}".format(self.mode, self.temperature, self.target)
+
+    def energy(self, seq):
+        return self.dist.energy(seq, self.mode, self.target, self.temperature)
+
+    def score(self, energy):
+        return int(round(10*(energy - self.refEnergy)))
+
+    def sequence(self, seq):
+        return self.score(self.energy(seq))
+
+    def func(self):
+        energy = self.dist.cached(self.key(), self.energy)
+        return lambda seq: self.score(energy(seq))
+
+    def acceptance(self, values, seqLength, stringency):
+        RT = gasConstant*(273.15 + self.temperature)
+        dG = np.asarray(values, dtype=np.float64)/10
+        return 1/(1 + np.exp(np.minimum((dG - self.energyThreshold)/RT, 700)))
+
+    def dissociation(self, values):
+        RT = gasConstant*(273.15 + self.temperature)
+        dG = np.asarray(values, dtype=np.float64)/10
+        return np.exp(np.clip(dG/RT, -700, 700))
+
+
+# gas constant in kcal/(mol.K)
+gasConstant = 1.98720425864083e-3
+
+
+# This returns the distances of the sequences seqs for each of the (prepared) metrics, as a
+# (len(seqs), len(metricList)) array. The sequences are folded once for all the
+# structure-based metrics, which must share their Distance.
+def fused_distances(metricList, seqs):
+    seqs = list(seqs)
+    values = np.zeros((len(seqs), len(metricList)))
+    structs = None
+    for n, m in enumerate(metricList):
+        if isinstance(m, StructureMetric):
+            if structs is None:
+                structs = m.dist.fold_batch(seqs)
+            values[:, n] = [m.structure(seq, struct) for seq, struct in zip(seqs, structs)]
+        else:
+            values[:, n] = m.distances(seqs)
+    return values
@@ -0,0 +1,65 @@
+import numba
+import numpy as np
+
+# Compiled versions of the kernels of kernels.py, which document them. They give the same
+# results as the NumPy implementations and are only imported by kernels.use.
+
+OPEN, CLOSE = ord('('), ord(')')
+
+
+@numba.njit(cache=True)
+def select_threshold(pos, thresholds, dists, counts):
+    n = 0
+    for i in range(len(pos)):
+        if dists[pos[i]] < thresholds[i]:
+            counts[pos[i]] += 1
+            n += 1
+    return n
+
+
+# This follows the scan of Distance.seq_loop on every structure
+@numba.njit(cache=True)
+def loop_bounds(structs, seqLength):
+    B = structs.shape[0]
+    starts = np.zeros(B, dtype=np.int64)
+    stops = np.full(B, seqLength, dtype=np.int64)
+    for b in range(B):
+        s = structs[b]
+        base = 0
+        i = 0
+        while base != CLOSE and i < seqLength-1:
+            base = s[i]
+            i += 1
+        if i == seqLength-1:
+            while base != OPEN and i > 0:
+                base = s[i-1]
+                i -= 1
+            starts[b] = i
+        else:
+            stops[b] = i-1
+            while base != OPEN:
+                i -= 1
+                base = s[i-1]
+            starts[b] = i
+    return starts, stops
+
+
+@numba.njit(cache=True)
+def levenshtein(loop1, loop2):
+    if len(loop1) < len(loop2):
+        loop1, loop2 = loop2, loop1
+    n = len(loop2)
+    if n == 0:
+        return len(loop1)
+    prev_row = np.arange(n + 1)
+    curr_row = np.empty(n + 1, dtype=prev_row.dtype)
+    for nt in loop1:
+        curr_row[0] = prev_row[0] + 1
+        for j in range(1, n + 1):
+            curr_row[j] = min(prev_row[j] + 1, prev_row[j-1] + (loop2[j-1] != nt))
+        # the insertions only use the values of the row before this step, as in
+        # Distance.lavenshtein_func
+        prev_row[0] = curr_row[0]
+        for j in range(1, n + 1):
+            prev_row[j] = min(curr_row[j], curr_row[j-1] + 1)
+    return prev_row[n]
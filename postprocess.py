@@ -1,10 +1,14 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 
-import RNA
-
 import Distance
+import metrics
+import roundstats
+import utils
 
 D = Distance.Distance()
 
@@ -18,38 +22,40 @@ params = {'legend.fontsize': 'medium',
 plt.rcParams.update(params)
 
 
+# This reads the distances and counts of a round file (possibly compressed) and computes its summary statistics
+# and its unweighted and count-weighted distance frequencies (see roundstats.summarise)
+def round_summary(fileName):
+    with utils.open_round(fileName) as f:
+        data = pd.read_csv(f, sep='\t', header=None, usecols=[1, 2], names=["dist", "count"],
+                           dtype=np.int64, engine="c")
+    return roundstats.summarise(data["dist"].to_numpy(), data["count"].to_numpy())
+
+
+# This computes the summaries of the given rounds, in parallel when jobs > 1
+def round_summaries(fileNames, jobs=None):
+    if jobs is None:
+        jobs = os.cpu_count()
+    jobs = min(jobs, len(fileNames))
+    if jobs <= 1:
+        return [round_summary(f) for f in fileNames]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(round_summary, fileNames))
+
+
 # This generate the main plots from the simulation results
 # The plots include changes in total and unique sequence numbers, in average distance
 # and changes in the average distance of each affinity group
+# The statistics written during the simulation (see roundstats.RoundStats) are used when
+# they cover all the rounds, otherwise the round files are read again.
 def dataAnalysis(seqLength, roundNum, outputFileNames, plots, distanceMeasure,
-                 aptSeq=None, aptStruct=None, aptLoop=None, imgformat="pdf"):
-    pstats = pd.DataFrame(columns=range(roundNum), index=["total", "unique", "avdist", "wavdist"])
-    pdf = pd.DataFrame(columns=range(roundNum))
-    wpdf = pd.DataFrame(columns=range(roundNum))
-    for rnd in range(roundNum):
-        data = pd.read_table("{}_R{:03d}".format(outputFileNames, rnd+1), names=["seq", "dist", "count"])
-        data["wdist"] = data["dist"]*data["count"]
-        bin_edges = range(data["dist"].min(), max(0, data["dist"].max()))
-        c, v = np.histogram(data["dist"], bins=bin_edges, density=True)
-        wc, wv = np.histogram(data["dist"], bins=bin_edges, density=True, weights=data["count"])
-        for vi, ci in zip(v, c):
-            pdf.loc[vi, rnd] = ci
-        for vi, ci in zip(wv, wc):
-            wpdf.loc[vi, rnd] = ci
-        pstats.loc["avdist", rnd] = data["dist"].mean()
-        pstats.loc["wavdist", rnd] = data["wdist"].sum() / data["count"].sum()
-        pstats.loc["total", rnd] = data["count"].sum()
-        pstats.loc["unique", rnd] = len(data["count"])
-    pdf[pdf.isnull()] = 0
-    pdf.sort_index(inplace=True)
-    wpdf[wpdf.isnull()] = 0
-    wpdf.sort_index(inplace=True)
+                 aptSeq=None, aptStruct=None, aptLoop=None, imgformat="pdf", jobs=None, reuse=True):
+    tables = roundstats.read_tables(outputFileNames, roundNum) if reuse else None
+    if tables is None:
+        fileNames = ["{}_R{:03d}".format(outputFileNames, rnd+1) for rnd in range(roundNum)]
+        tables = roundstats.tables(round_summaries(fileNames, jobs))
+        roundstats.write_tables(outputFileNames, *tables)
+    pstats, pdf, wpdf = tables
     print(pstats)
-    with open(outputFileNames+"_stats.csv", 'w') as p:
-        pstats.to_csv(p)
-    with open(outputFileNames+"_dists.csv", 'w') as p:
-        pdf.to_csv(p)
-        wpdf.to_csv(p)
     # If the user requested generating plots
     if plots:
         # 30 colors
@@ -88,7 +94,7 @@ def dataAnalysis(seqLength, roundNum, outputFileNames, plots, distanceMeasure,
                 for si in range(s):
                     idx = idxs[s*i+si]
                     ax.plot(pdf_.columns, pdf_.loc[idx], label='d = {}'.format(idx), color=co30[si])
-                ax.ticklabel_format(syle='sci', axis='y', scilimits=(0, 0))
+                ax.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
                 ax.legend(prop={'size': 6})
             axes[0, 0].set_ylim((pdf_.min().min(), pdf_.max().max()))
             fig1.suptitle(f"{tname} Sequences")
@@ -129,32 +135,102 @@ def dataAnalysis(seqLength, roundNum, outputFileNames, plots, distanceMeasure,
 #                fig3.text(0.5, 0.98, 'Total Sequences', ha='center')
 
 
-def plot_histo(Nrounds, prefix, target, imgformat="pdf", method=None):
-    plt.style.use("seaborn-white")
+# This provides the distances of the sequences of a round to the target, i.e. to the
+# nearest of the target sequences when several are given (see utils.references).
+# The distances stored in the round files are used when they were computed with the
+# requested method, otherwise they are recomputed with the metric of that name (see
+# metrics.py), fold-based ones through the fold cache stored in cacheFile if one is given
+# and with the given fold backend (see folding.py).
+class DistanceProvider:
+    def __init__(self, target, method=None, storedMethod=None, cacheFile=None, backend="vienna"):
+        self.target = target
+        self.method = method
+        self.storedMethod = storedMethod
+        self.cacheFile = cacheFile
+        self.backend = backend
+        self._dist = None
+
+    # the Distance object (and its fold cache) is created in the process that uses it
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_dist"] = None
+        return state
+
+    def dist(self):
+        if self._dist is None:
+            if self.cacheFile:
+                from foldcache import FoldCache
+                self._dist = Distance.Distance(cache=FoldCache(self.cacheFile), backend=self.backend)
+            elif self.backend != D.folder.name:
+                self._dist = Distance.Distance(backend=self.backend)
+            else:
+                self._dist = D
+        return self._dist
+
+    def stored(self):
+        return self.method is None or self.method == self.storedMethod
+
+    def distances(self, data):
+        if self.stored():
+            return data["dist"].to_numpy()
+        return metrics.create(self.method, self.dist()).prepare(self.target).distances(data["seq"].tolist())
+
+    def close(self):
+        if self._dist is not None and self._dist.cache is not None:
+            self._dist.cache.close()
+        self._dist = None
+
+
+# This reads a round file and returns the count-weighted density of its distances
+# over bins
+def round_histogram(fileName, provider, bins):
+    with utils.open_round(fileName) as f:
+        if provider.stored():
+            data = pd.read_csv(f, sep='\t', header=None, usecols=[1, 2], names=["dist", "count"])
+        else:
+            data = pd.read_csv(f, sep='\t', header=None, names=["seq", "dist", "count"])
+    rd = provider.distances(data)
+    # flushes the folds added to the cache
+    provider.close()
+    h, edges = np.histogram(rd, bins=bins, density=True, weights=data["count"])
+    return h
+
+
+def round_histograms(fileNames, provider, bins, jobs=None):
+    if jobs is None:
+        jobs = os.cpu_count()
+    jobs = min(jobs, len(fileNames))
+    if jobs <= 1:
+        return [round_histogram(f, provider, bins) for f in fileNames]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(round_histogram, fileNames, [provider]*len(fileNames),
+                             [bins]*len(fileNames)))
+
+
+def plot_histo(Nrounds, prefix, target, imgformat="pdf", method=None, storedMethod=None,
+               cacheFile=None, jobs=None, backend="vienna"):
+    plt.style.use("seaborn-v0_8-white" if "seaborn-v0_8-white" in plt.style.available else "seaborn-white")
     fig, axes = plt.subplots(1, Nrounds, figsize=(2.1*Nrounds, 10), sharey=True)
-    plot_histo_(Nrounds, prefix, target, axes, method)
+    plot_histo_(Nrounds, prefix, target, axes, method, storedMethod, cacheFile, jobs, backend)
     fig.suptitle("Distribution of the distance over %d rounds" % Nrounds)
     plt.savefig("{}_SELEX_histo.{}".format(prefix, imgformat))
 
 
-def plot_histo_(Nrounds, prefix, target, axes, method=None):
-    bins = range(len(target))
-    for i, ax in enumerate(axes):
-        data = pd.read_table("{}_R{:03d}".format(prefix, i+1), names=["seq", "dist", "count"])
-        if method is not None:
-            if method == "hamming":
-                rd = [D.hamming_func(target, i_) for i_ in data["seq"]]
-            else:
-                struct_target = RNA.fold(target)[0]
-                rd = [RNA.bp_distance(struct_target, RNA.fold(i_)[0]) for i_ in data["seq"]]
-        else:
-            rd = data["dist"]
-        ax.hist(rd, bins=bins, normed=True, weights=data["count"], orientation="horizontal", label="weighted")
+# The histograms of the rounds are computed in parallel and then drawn on axes
+def plot_histo_(Nrounds, prefix, target, axes, method=None, storedMethod=None,
+                cacheFile=None, jobs=None, backend="vienna"):
+    seqLength = len(utils.references(target)[0])
+    bins = np.arange(seqLength)
+    provider = DistanceProvider(target, method, storedMethod, cacheFile, backend)
+    fileNames = ["{}_R{:03d}".format(prefix, i+1) for i in range(Nrounds)]
+    hs = round_histograms(fileNames, provider, bins, jobs)
+    for i, (ax, h) in enumerate(zip(axes, hs)):
+        ax.hist(bins[:-1], bins=bins, weights=h, orientation="horizontal", label="weighted")
         # # plot unweighted graph if weights present
         # if sum(wsamp) > len(wsamp):
         #     ax.hist(rd, bins=bins, normed=True, orientation="horizontal", histtype="step", color="C1",
         #              linewidth=2, label="unweighted")
-        ax.set_ylim((0, len(target)))
+        ax.set_ylim((0, seqLength))
         # ax.set_xscale("log")
         ax.set_xticklabels([])
         ax.set_xlabel("R {:d}".format(i+1))
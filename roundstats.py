@@ -0,0 +1,126 @@
+import numpy as np
+
+import utils
+
+# pandas is only imported by the functions building or reading the tables, after the
+# first round, so that it does not slow down the start of the simulation
+
+statNames = ["total", "unique", "avdist", "wavdist", "entropy"]
+
+
+# This computes the summary statistics of a round from the distance and count of each
+# unique sequence, and its unweighted and count-weighted distance frequencies.
+# The frequencies are returned as arrays indexed by distance-dmin.
+# The entropy is the Shannon entropy (in bits) of the sequence frequencies.
+def summarise(dist, count):
+    total = count.sum()
+    dmin = int(dist.min())
+    hist = np.bincount(dist-dmin).astype(float)
+    whist = np.bincount(dist-dmin, weights=count)
+    p = count[count > 0]/total
+    stats = {"total": total,
+             "unique": len(count),
+             "avdist": dist.mean(),
+             "wavdist": (dist*count).sum() / total,
+             "entropy": -(p*np.log2(p)).sum()}
+    return stats, dmin, hist/hist.sum(), whist/whist.sum()
+
+
+# This assembles per round frequency arrays starting at the distances dmins into a
+# distance x round DataFrame
+def frequency_matrix(dmins, freqs, columns):
+    dmin = min(dmins)
+    dmax = max(d+len(f) for d, f in zip(dmins, freqs))
+    import pandas as pd
+    m = np.zeros((dmax-dmin, len(freqs)))
+    for rnd, (d, f) in enumerate(zip(dmins, freqs)):
+        m[d-dmin:d-dmin+len(f), rnd] = f
+    return pd.DataFrame(m, index=range(dmin, dmax), columns=columns)
+
+
+# This builds the statistics and distance frequency tables from the round summaries
+def tables(summaries):
+    columns = range(len(summaries))
+    import pandas as pd
+    pstats = pd.DataFrame([s[0] for s in summaries], index=columns, dtype=object).T
+    pstats = pstats.loc[statNames]
+    dmins = [s[1] for s in summaries]
+    pdf = frequency_matrix(dmins, [s[2] for s in summaries], columns)
+    wpdf = frequency_matrix(dmins, [s[3] for s in summaries], columns)
+    return pstats, pdf, wpdf
+
+
+def write_tables(outputFileNames, pstats, pdf, wpdf):
+    with open(outputFileNames+"_stats.csv", 'w') as p:
+        pstats.to_csv(p)
+    with open(outputFileNames+"_dists.csv", 'w') as p:
+        pdf.to_csv(p)
+        wpdf.to_csv(p)
+
+
+# This reads the tables written by write_tables, and returns None if they are missing
+# or do not cover roundNum rounds
+def read_tables(outputFileNames, roundNum):
+    import pandas as pd
+    try:
+        pstats = pd.read_csv(outputFileNames+"_stats.csv", index_col=0)
+        with open(outputFileNames+"_dists.csv", 'r') as p:
+            lines = p.read().splitlines()
+    except OSError:
+        return None
+    if pstats.shape[1] < roundNum or not set(statNames) <= set(pstats.index):
+        return None
+    # the unweighted and weighted tables are written one after the other, each with a header
+    headers = [i for i, line in enumerate(lines) if line.startswith(",")]
+    if len(headers) != 2:
+        return None
+    pdf = pd.read_csv(pd.io.common.StringIO("\n".join(lines[:headers[1]])), index_col=0)
+    wpdf = pd.read_csv(pd.io.common.StringIO("\n".join(lines[headers[1]:])), index_col=0)
+    columns = list(range(roundNum))
+    for t in (pstats, pdf, wpdf):
+        t.columns = [int(c) for c in t.columns]
+    return pstats[columns], pdf[columns], wpdf[columns]
+
+
+# This accumulates the statistics of each round while the simulation runs, from the pool
+# in memory, and keeps [experiment_name]_stats.csv and [experiment_name]_dists.csv (the
+# tables of postprocess.dataAnalysis) up to date after each round. The topk most
+# abundant sequences of each round are appended to [experiment_name]_topk.csv.
+# As in postprocess, the tables cover rounds 1 and above (column 0 is round 1).
+class RoundStats:
+    def __init__(self, outputFileNames, apt, topk=10):
+        self.outputFileNames = outputFileNames
+        self.apt = apt
+        self.topk = topk
+        self.summaries = dict()
+        if self.topk > 0:
+            with open(self.outputFileNames+"_topk.csv", 'w') as t:
+                t.write("round,rank,seq,dist,count\n")
+
+    def update(self, rnd, seqPool):
+        keys, data = utils.pool_arrays(seqPool)
+        dist = data[:, 1].astype(np.int64)
+        count = data[:, 0].astype(np.int64)
+        summary = summarise(dist, count)
+        self.summaries[rnd] = summary
+        stats = summary[0]
+        print("R{}: total = {}, unique = {}, average distance = {:.3f}, weighted average distance = {:.3f}, "
+              "entropy = {:.3f}".format(rnd, stats["total"], stats["unique"], stats["avdist"],
+                                        stats["wavdist"], stats["entropy"]), flush=True)
+        if rnd > 0:
+            write_tables(self.outputFileNames, *tables(self.round_summaries()))
+        if self.topk > 0:
+            # tail bins (negative indices) are not sequences
+            real = keys >= 0
+            key = np.where(real, count, -1)
+            top = np.argpartition(-key, min(self.topk, len(key))-1)[:self.topk]
+            top = top[np.argsort(-key[top], kind="stable")]
+            top = top[real[top]]
+            with open(self.outputFileNames+"_topk.csv", 'a') as t:
+                for rank, i in enumerate(top):
+                    t.write("{},{},{},{},{}\n".format(rnd, rank+1, self.apt.pseudoAptamerGenerator(keys[i]),
+                                                      dist[i], count[i]))
+
+    # This returns the summaries of rounds 1, 2, ...
+    def round_summaries(self):
+        return [self.summaries[r] for r in sorted(self.summaries) if r > 0]
@@ -0,0 +1,113 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+import instrument
+import utils
+
+# number of lines encoded and written at a time
+chunkSize = 2**16
+
+
+# This takes a copy of the sequence indices, distances and counts of a pool, so that the
+# pool can be modified while the copy is written
+def snapshot(seqPool):
+    idx, data = utils.pool_arrays(seqPool)
+    return idx, data[:, 1].astype(np.int64), data[:, 0].astype(np.int64)
+
+
+# This writes the sequence, distance and count of every sequence to fileName, one
+# tab separated line per sequence (the format of the round and samples files).
+# The file is compressed on the fly (see utils.compressions) and its name gets the
+# suffix of the compression; files of the same name with another suffix are removed
+# so that readers (utils.open_round) find the new one.
+def write_pool(fileName, apt, idx, dist, count, compression="none", level=None):
+    with instrument.timed("write_time"):
+        for other, suffix in utils.compressions.items():
+            if other != compression and os.path.exists(fileName+suffix):
+                os.remove(fileName+suffix)
+        with utils.open_compressed(fileName+utils.compressions[compression], compression, 'w', level) as f:
+            for i in range(0, len(idx), chunkSize):
+                seqs = apt.pseudoAptamerGenerator_batch(idx[i:i+chunkSize])
+                f.write("".join(["{}\t{}\t{}\n".format(s, d, c) for s, d, c in
+                                 zip(seqs, dist[i:i+chunkSize].tolist(), count[i:i+chunkSize].tolist())]))
+
+
+# This writes round and samples files in a background thread, while the simulation
+# carries on. Pools are copied when they are submitted, and at most maxPending files
+# wait to be written (submit blocks beyond that). flush() waits until all the submitted
+# files are written. With maxPending = 0 files are written synchronously.
+# Files are compressed with compression at level (see write_pool).
+# Errors raised while writing are raised again by the next submit or flush.
+class RoundWriter:
+    def __init__(self, apt, maxPending=2, compression="none", level=None):
+        self.apt = apt
+        self.maxPending = maxPending
+        self.compression = compression
+        self.level = level
+        self.error = None
+        self.thread = None
+        if self.maxPending > 0:
+            self.queue = queue.Queue(maxsize=self.maxPending)
+            self.thread = threading.Thread(target=self._work, name="RoundWriter", daemon=True)
+            self.thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    write_pool(job[0], self.apt, *job[1:], self.compression, self.level)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fileName, idx, dist, count):
+        self.check()
+        if self.thread is None:
+            write_pool(fileName, self.apt, idx, dist, count, self.compression, self.level)
+        else:
+            self.queue.put((fileName, idx, dist, count))
+
+    def write(self, fileName, seqPool):
+        self.submit(fileName, *snapshot(seqPool))
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread is not None:
+            try:
+                self.flush()
+            finally:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+
+# A writer that discards the files submitted to it, for simulations run without file
+# outputs (see sim_.SelexSimulation)
+class NullWriter:
+    def submit(self, fileName, idx, dist, count):
+        pass
+
+    def write(self, fileName, seqPool):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,496 @@
+import contextlib
+import multiprocessing
+import os
+import random
+import traceback
+from collections.abc import Mapping
+
+import numpy as np
+
+import instrument
+import kernels
+import metrics
+import utils
+from Amplification import Amplification
+from Aptamers import Aptamers
+from Distance import Distance
+from foldcache import FoldCache
+from Selection import Nrsamples, free_target
+from sim_ import Experiment
+
+# Sharded simulation: the pool is split across worker processes (shards), each sequence
+# belonging to the shard given by a hash of its index. Every round
+#   - sampling and selection are drawn in two levels: the parent splits the number of
+#     draws across the shards with a multinomial draw weighted by the mass of each shard
+#     (sum of counts for sampling, sum of counts times probability of passing selection
+#     for selection), then each shard draws its share from its own sequences;
+#   - amplification and mutation run in every shard at the same time, and the mutants
+#     that belong to another shard are sent to it, where their counts are added.
+# Both levels together draw from the same distribution as a single draw over the whole
+# pool, so the sharded simulation follows the same distribution as Experiment.run.
+# Tail bins (negative indices) stay in the shard that created them, and the tail bins of the
+# same distance are merged when the pool is gathered (see merge_tails).
+
+# multiplier of the Fibonacci hash of sequence indices
+golden = np.uint64(0x9E3779B97F4A7C15)
+
+
+# This returns the shard owning each sequence index
+def owner(idx, nshards):
+    h = np.asarray(idx).astype(np.uint64) * golden
+    return ((h >> np.uint64(32)) % np.uint64(nshards)).astype(np.int64)
+
+
+# This concatenates arrays of sequence indices of different types (see utils.index_array)
+def concat_indices(parts):
+    parts = [p for p in parts if len(p) > 0]
+    if len(parts) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    dtypes = set(p.dtype for p in parts)
+    if len(dtypes) == 1:
+        return np.concatenate(parts)
+    if all(p.dtype == np.int64 or p.max() < 2**63 for p in parts if p.dtype != object):
+        return np.concatenate([p.astype(np.int64) for p in parts if p.dtype != object] +
+                              [p for p in parts if p.dtype == object])
+    return np.concatenate([p.astype(object) for p in parts])
+
+
+# This merges the rows of the tail bins (negative indices) created by different shards for
+# the same distance, adding their counts and averaging their biases weighted by the counts
+# as utils.prune_pool does. The merged tail bins follow the other rows.
+def merge_tails(idx, data):
+    if idx.dtype.kind != 'i':
+        return idx, data
+    tail = idx < 0
+    keys, inverse = np.unique(idx[tail], return_inverse=True)
+    if len(keys) == int(tail.sum()):
+        return idx, data
+    rows = data[tail]
+    merged = np.zeros((len(keys), 3))
+    merged[:, 0] = np.bincount(inverse, weights=rows[:, 0], minlength=len(keys))
+    merged[inverse, 1] = rows[:, 1]
+    merged[inverse, 2] = rows[:, 2]
+    weighted = np.bincount(inverse, weights=rows[:, 0]*rows[:, 2], minlength=len(keys))
+    positive = merged[:, 0] > 0
+    merged[positive, 2] = weighted[positive]/merged[positive, 0]
+    return np.concatenate([idx[~tail], keys]), np.concatenate([data[~tail], merged])
+
+
+# A read-only view of the pool held by the shards after a round, with the interface of a
+# pool ({seqIdx: np.array([count, distance, bias])}) and arrays() like MemmapPool.
+# Its total and unique numbers of sequences are known without moving the pool, which is
+# only gathered from the shards when it is read (by a callback, the statistics or the
+# round writer). It can be read until the shards run the next round (see expire).
+class ShardView(Mapping):
+    def __init__(self, shards, total, unique):
+        self.shards = shards
+        self.total = total
+        self.unique = unique
+        self.idx = None
+        self.data = None
+        self._pos = None
+
+    def arrays(self):
+        if self.idx is None:
+            if self.shards is None:
+                raise ValueError("the pool of this round is no longer held by the shards")
+            self.idx, self.data = self.shards.gather()
+        return self.idx, self.data
+
+    # This is called when the shards move on to the next round
+    def expire(self):
+        self.shards = None
+
+    def __getitem__(self, seqIdx):
+        if self._pos is None:
+            self._pos = {k: i for i, k in enumerate(self.arrays()[0].tolist())}
+        return self.data[self._pos[seqIdx]]
+
+    def __iter__(self):
+        return iter(self.arrays()[0].tolist())
+
+    def __len__(self):
+        return self.unique
+
+
+# The part of the pool held by one worker process, and the objects to amplify and
+# mutate it. Every method is called by the parent through ShardPool.call.
+class Shard:
+    def __init__(self, settings, shard, nshards, seed, reference):
+        self.exp = Experiment(settings)
+        kernels.use(self.exp.kernels)
+        self.shard = shard
+        self.nshards = nshards
+        self.reference = reference
+        random.seed(seed)
+        np.random.seed(seed)
+        self.cache = FoldCache(self.exp.fold_cache) if self.exp.fold_cache else None
+        self.D = Distance(self.exp.pcrBias, self.cache, self.exp.foldBackend)
+        self.apt = Aptamers(self.exp.alphabet(), self.exp.seqLength)
+        self.amplify_ = Amplification()
+        # the budget of the pool is shared between the shards
+        self.poolBudget = -(-self.exp.poolBudget//nshards)
+        self.mut = self.exp.mutation(self.D, self.poolBudget)
+        # the metric giving the probability of the sequences to be selected
+        self.acceptor = metrics.create(self.exp.distanceMeasure, self.D, **self.exp.metricOptions)
+        self.pool = self.exp.pool_factory()()
+        # counts and dissociation constants for the equilibrium selection (see binding)
+        self.equilibrium = None
+        self.pipeline = self.exp.selection_pipeline(self.apt, self.D)
+
+    # This adds sequences to the shard, adding up the counts of those already present
+    def merge(self, idx, data):
+        for seqIdx, row in zip(idx.tolist(), data):
+            if seqIdx in self.pool:
+                utils.add_count(self.pool[seqIdx], row[0])
+            else:
+                self.pool[seqIdx] = row.copy()
+        return len(self.pool)
+
+    # This returns the selection weight of each row of data: its count (negative counts,
+    # which mutation can leave, count as zero as in utils.rv_int) times its probability
+    # of passing selection (see metrics.Metric.acceptance)
+    def weights(self, data):
+        return np.maximum(data[:, 0], 0)*self.acceptor.acceptance(data[:, 1], self.exp.seqLength,
+                                                                   self.exp.stringency)
+
+    # This thins the shard, whose count is part of the total count of the pool
+    def thin(self, mass, total):
+        return utils.thin_pool(self.pool, mass, total)
+
+    # This returns the total count of the shard, its number of sequences that are not tail
+    # bins, and the indices of its tail bins (which other shards may hold too)
+    def size(self):
+        idx, data = utils.pool_arrays(self.pool)
+        tail = idx < 0 if idx.dtype.kind == 'i' else np.zeros(len(idx), dtype=bool)
+        return int(data[:, 0].sum()), int((~tail).sum()), idx[tail].tolist()
+
+    # This returns the total count of the shard, and its mass for selection
+    def masses(self):
+        idx, data = utils.pool_arrays(self.pool)
+        return float(np.maximum(data[:, 0], 0).sum()), float(self.weights(data).sum())
+
+    # This draws size sequences of the shard (with replacement for multinomial, without
+    # for hypergeometric) and returns their indices, distances and counts
+    def sample(self, size, mode):
+        if len(self.pool) == 0 or size == 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        selectionDist = utils.rv_int(self.pool, "selectionDist")
+        if mode == "hypergeometric":
+            samps, N = selectionDist.hypergeometric(size)
+        else:
+            samps, N = selectionDist.multinomial(size)
+        dist = np.array([self.pool[seqIdx][1] for seqIdx in samps.tolist()]).reshape(-1).astype(np.int64)
+        return samps, dist, N
+
+    # This selects size sequences of the shard, each drawn with a probability proportional
+    # to its count times its probability of passing selection, and keeps only those
+    def select(self, size):
+        keys = list(self.pool)
+        data = np.array([self.pool[k] for k in keys]).reshape(-1, 3)
+        weights = self.weights(data)
+        if size > 0:
+            N = np.random.multinomial(size, weights/weights.sum())
+            instrument.count("rng_draws", len(weights))
+        else:
+            N = np.zeros(len(keys), dtype=np.int64)
+        for seqIdx, n in zip(keys, N.tolist()):
+            if n > 0:
+                self.pool[seqIdx][0] = n
+            else:
+                del self.pool[seqIdx]
+        return int(N.sum()), len(self.pool)
+
+    # This runs the selection steps of round rnd on the shard (see Selection.SelectionPipeline)
+    # and returns its total and unique numbers of sequences
+    def steps(self, rnd):
+        return self.pipeline.apply(self.pool, rnd, self.exp.seqLength)
+
+    # This prepares the equilibrium selection of the shard (see Selection.free_target): the
+    # counts and dissociation constants of its sequences
+    def binding(self):
+        keys = list(self.pool)
+        data = np.array([self.pool[k] for k in keys]).reshape(-1, 3)
+        kd = self.exp.kdReference*self.acceptor.dissociation(data[:, 1])
+        self.equilibrium = (keys, np.maximum(data[:, 0], 0), kd)
+
+    # This returns the number of bound sequences of the shard at the free target F
+    def bound(self, F):
+        keys, counts, kd = self.equilibrium
+        return float(np.dot(counts, F/(F + kd)))
+
+    # This draws the bound copies of every sequence of the shard at the free target F,
+    # and keeps only those
+    def bind(self, F):
+        keys, counts, kd = self.equilibrium
+        N = np.random.binomial(counts.astype(np.int64), F/(F + kd))
+        instrument.count("rng_draws", len(N))
+        for seqIdx, n in zip(keys, N.tolist()):
+            if n > 0:
+                self.pool[seqIdx][0] = n
+            else:
+                del self.pool[seqIdx]
+        self.equilibrium = None
+        return int(N.sum()), len(self.pool)
+
+    # This amplifies and mutates the shard, and removes and returns the mutants that belong
+    # to other shards, with their owners
+    def amplify(self):
+        self.pool = self.amplify_.randomPCR_with_ErrorsAndBias(self.pool, self.mut, self.reference,
+                                                               self.apt, self.exp.distanceMeasure)
+        keys = list(self.pool)
+        idx = utils.index_array(keys)
+        if idx.dtype == object:
+            raise ValueError("Sequence indices do not fit in 64 bits")
+        own = owner(idx, self.nshards)
+        if idx.dtype.kind == 'i':
+            own[idx < 0] = self.shard
+        out = np.flatnonzero(own != self.shard)
+        data = np.zeros((len(out), 3))
+        for i, j in enumerate(out.tolist()):
+            data[i] = self.pool[keys[j]]
+            del self.pool[keys[j]]
+        return idx[out], data, own[out]
+
+    # This merges the sequences of low abundance of the shard into tail bins, once the
+    # mutants of the other shards are merged and the pool is thinned, and returns their number
+    def prune(self):
+        return utils.prune_pool(self.pool, self.poolBudget, self.exp.tailThreshold)
+
+    def arrays(self):
+        return utils.pool_arrays(self.pool)
+
+    def close(self):
+        if hasattr(self.pool, "close"):
+            self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+# This is the loop of a worker process: it runs the commands sent by the parent on its
+# shard and sends back their results with the counter increments they caused.
+# Progress messages of the shard are discarded.
+def serve(conn, args):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            shard = Shard(*args)
+        except BaseException:
+            conn.send(("error", traceback.format_exc()))
+            return
+        conn.send(("ok", None))
+        while True:
+            cmd, cargs = conn.recv()
+            c0 = instrument.snapshot()
+            try:
+                result = getattr(shard, cmd)(*cargs)
+            except BaseException:
+                conn.send(("error", traceback.format_exc()))
+                continue
+            delta = instrument.snapshot()
+            delta.subtract(c0)
+            conn.send(("ok", (result, {k: v for k, v in delta.items() if v != 0})))
+            if cmd == "close":
+                return
+
+
+# The worker processes, one per shard
+class ShardPool:
+    def __init__(self, settings, nshards, seed, reference):
+        self.nshards = nshards
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(nshards)]
+        self.conns = []
+        self.procs = []
+        for shard in range(nshards):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=serve, args=(child, (settings, shard, nshards, seeds[shard], reference)),
+                               name="SelexShard{}".format(shard), daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        for conn in self.conns:
+            self._receive(conn)
+
+    def _receive(self, conn):
+        status, result = conn.recv()
+        if status == "error":
+            self.terminate()
+            raise RuntimeError("Shard worker failed:\n"+result)
+        return result
+
+    # This runs cmd on every shard, with the arguments args[shard] (the same arguments for
+    # all shards when args is a tuple), and returns the results in shard order
+    def call(self, cmd, args=()):
+        for shard, conn in enumerate(self.conns):
+            conn.send((cmd, args if isinstance(args, tuple) else args[shard]))
+        results = []
+        for conn in self.conns:
+            result, counters = self._receive(conn)
+            for name, n in counters.items():
+                instrument.count(name, n)
+            results.append(result)
+        return results
+
+    # This gives each shard its sequences among idx
+    def distribute(self, idx, data):
+        own = owner(idx, self.nshards)
+        if idx.dtype.kind == 'i':
+            own[idx < 0] = 0
+        self.call("merge", [(idx[own == s], data[own == s]) for s in range(self.nshards)])
+
+    # This returns the total and unique numbers of sequences held by the shards
+    def size(self):
+        sizes = self.call("size")
+        tails = set()
+        for s in sizes:
+            tails.update(s[2])
+        return sum(s[0] for s in sizes), sum(s[1] for s in sizes) + len(tails)
+
+    # This returns the indices and rows of the pool held by the shards (see merge_tails)
+    def gather(self):
+        parts = self.call("arrays")
+        return merge_tails(concat_indices([p[0] for p in parts]),
+                           np.concatenate([p[1] for p in parts]).reshape(-1, 3))
+
+    def close(self):
+        try:
+            self.call("close")
+        finally:
+            for proc in self.procs:
+                proc.join()
+            self.conns = []
+            self.procs = []
+
+    def terminate(self):
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        self.conns = []
+        self.procs = []
+
+
+# This returns the number of sequences selected from a pool of total count total and
+# selection mass mass: Selection.selectionProcess draws batches of Nrsamples sequences,
+# each passing selection with probability mass/total, until scale have passed
+def selected_number(total, mass, scale):
+    n = 0
+    while n < scale:
+        n += np.random.binomial(Nrsamples, mass/total)
+    return int(n)
+
+
+# An experiment whose rounds are run by shards worker processes (setting shards).
+# The initial library is built and sampled by the parent as in Experiment, then split
+# across the shards. Sampling uses multinomial draws for the choice mode, which follows the
+# same distribution.
+class ShardedExperiment(Experiment):
+    def start(self, slctdSeqs=None):
+        if len(self.Apt.alphabetSet)**self.seqLength > 2**64:
+            raise ValueError("sharded simulation needs sequence indices that fit in 64 bits")
+        Experiment.start(self, slctdSeqs)
+        self.shardPool = ShardPool(self.settings, self.shards, self.rng_seed, self.aptamerSeqs)
+
+    # The worker processes are terminated when a round fails
+    def step(self, writeRounds=True, callback=None):
+        try:
+            return self._step(self.shardPool, writeRounds, callback)
+        except BaseException:
+            self.shardPool.terminate()
+            raise
+
+    def _step(self, shards, writeRounds, callback):
+        r = self.nextRound
+        if(r == 0):
+            library = self.initial_library() if self.pool is None else self.pool
+            shards.distribute(*utils.pool_arrays(library))
+            del library
+        else:
+            header = "SELEX Round "+str(r)+" has started"
+            print(header)
+            print("-"*len(header))
+            self.pool.expire()
+            print("total number of sequences in initial pool = "+str(self.pool.total))
+            print("total number of unique sequences in initial pool = "+str(self.pool.unique), flush=True)
+            with self.instr.stage(r, "selection") as st:
+                st["total"], st["unique"] = self.select(shards, r)
+            print("Selection carried out for R"+str(r))
+        with self.instr.stage(r, "amplification") as st:
+            results = shards.call("amplify")
+            # send the mutants to the shards they belong to
+            idx = concat_indices([res[0] for res in results])
+            data = np.concatenate([res[1] for res in results]).reshape(-1, 3)
+            own = np.concatenate([res[2] for res in results])
+            shards.call("merge", [(idx[own == s], data[own == s]) for s in range(shards.nshards)])
+            if self.poolMass > 0:
+                # the shards are thinned by the same fraction (see utils.thin_pool)
+                total = sum(res[0] for res in shards.call("masses"))
+                lost = sum(shards.call("thin", (self.poolMass, total)))
+                if lost > 0:
+                    print("{} sequences lost when thinning the pool to {} copies".format(lost, self.poolMass))
+            # the pool is pruned after it is thinned, as in Experiment.step
+            if self.poolBudget > 0:
+                pruned = sum(shards.call("prune"))
+                if pruned > 0:
+                    print("{} sequences merged into tail bins".format(pruned))
+            amplfdSeqs = ShardView(shards, *shards.size())
+            st["total"], st["unique"] = amplfdSeqs.total, amplfdSeqs.unique
+        print("Amplification carried out for R"+str(r))
+        self.end_round(r, amplfdSeqs, writeRounds, callback)
+        return amplfdSeqs
+
+    # The final pool is gathered before the shards are closed
+    def finish(self):
+        if isinstance(self.pool, ShardView):
+            if len(self.shardPool.procs) > 0:
+                self.pool.arrays()
+            self.pool.expire()
+        self.shardPool.close()
+        Experiment.finish(self)
+
+    # This samples the pool to the samples file of round r, then selects scale sequences,
+    # in two levels (see above), and returns the total and unique counts of the selected pool
+    def select(self, shards, r):
+        print("seq selection threshold = "+str(self.selectionThreshold))
+        totals, masses = map(np.array, zip(*shards.call("masses")))
+        if totals.sum() <= 0:
+            raise ValueError("no sequence left in the pool of round {}".format(r))
+        print("Sampling has started...")
+        if self.samplingMode == "hypergeometric":
+            rng = np.random.default_rng(np.random.randint(0, 2**32, dtype=np.uint64))
+            size = min(self.samplingSize, int(totals.sum()))
+            sizes = rng.multivariate_hypergeometric(totals.astype(np.int64), size)
+        else:
+            sizes = np.random.multinomial(self.samplingSize, totals/totals.sum())
+        samples = shards.call("sample", [(int(n), self.samplingMode) for n in sizes])
+        with instrument.timed("sample_write_time"):
+            self.sampleWriter.submit(self.outputFileNames+"_samples_R{:03d}".format(r),
+                                     concat_indices([s[0] for s in samples]),
+                                     np.concatenate([s[1] for s in samples]),
+                                     np.concatenate([s[2] for s in samples]))
+        print("Sampling has completed")
+        if len(self.selectionSteps) > 0:
+            kept = shards.call("steps", (r,))
+            print("{} sequences kept by the selection steps".format(sum(k[0] for k in kept)))
+            totals, masses = map(np.array, zip(*shards.call("masses")))
+            if totals.sum() <= 0:
+                raise ValueError("no sequence of the pool is left after the selection steps")
+        if self.selectionModel == "equilibrium":
+            # the free target is shared by the shards: its equation is solved by the parent
+            shards.call("binding")
+            free = free_target(lambda F: sum(shards.call("bound", (F,))), self.selectionThreshold)
+            selected = shards.call("bind", (free,))
+            print("free target fraction = {}".format(free/self.selectionThreshold))
+            if sum(n for n, unique in selected) == 0:
+                raise ValueError("no sequence bound at equilibrium, increase scale or lower kd_reference or "
+                                 "kd_factor")
+            print("sequence selection has been carried out")
+            return shards.size()
+        if masses.sum() <= 0:
+            raise ValueError("no sequence of the pool can pass selection")
+        size = selected_number(totals.sum(), masses.sum(), self.selectionThreshold)
+        sizes = np.random.multinomial(size, masses/masses.sum())
+        shards.call("select", [(int(n),) for n in sizes])
+        print("sequence selection has been carried out")
+        return shards.size()
@@ -0,0 +1,175 @@
+import atexit
+import multiprocessing
+import os
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Columns of a pool (sequence indices, counts, distances, ...) and preallocated output
+# columns placed in shared memory, so that worker processes can read them and write their
+# results in place without the pool being pickled.
+#
+# Usage:
+#     with SharedColumns.create({"idx": idx, "dist": (np.float64, len(idx))}) as cols:
+#         run_slices(functools.partial(worker, cols.spec), len(idx), jobs)
+#         dist = cols["dist"].copy()
+#
+# where worker(spec, start, stop) does
+#     cols = SharedColumns.attach(spec)
+#     cols["dist"][start:stop] = ...
+#
+# Segments are named selex_<pid>_<token>. They are removed by the process that created
+# them when it closes them, at exit, or, if that process crashed, by cleanup_stale() which
+# is called whenever new segments are created.
+
+prefix = "selex_"
+
+# segments created by this process and not removed yet
+_owned = dict()
+
+
+def _unlink(name):
+    shm = _owned.pop(name, None)
+    if shm is not None:
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# forked worker processes inherit _owned but must not remove the segments
+@atexit.register
+def _cleanup_owned():
+    for name in list(_owned):
+        if name.startswith("{}{}_".format(prefix, os.getpid())):
+            _unlink(name)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# This removes the segments left behind by processes that no longer exist
+# (segments are listed in /dev/shm, where POSIX shared memory lives on Linux)
+def cleanup_stale(shmDir="/dev/shm"):
+    if not os.path.isdir(shmDir):
+        return 0
+    removed = 0
+    for name in os.listdir(shmDir):
+        if not name.startswith(prefix):
+            continue
+        try:
+            pid = int(name[len(prefix):].split('_')[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not _alive(pid):
+            try:
+                os.remove(os.path.join(shmDir, name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+# This attaches an existing segment. Before Python 3.13 (no track argument) attaching
+# registers the segment with the resource tracker. Worker processes, whatever their start
+# method, share the tracker of the process that created the segment, where the registration
+# must be kept for the owner to unlink it; only a process with its own tracker (not started
+# by multiprocessing) unregisters it, so that its tracker does not remove it at exit.
+def _attach_segment(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if multiprocessing.parent_process() is None and name not in _owned:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedColumns:
+    def __init__(self, spec, segments, owner):
+        self.spec = spec
+        self.segments = segments
+        self.owner = owner
+        self.arrays = {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=segments[name].buf)
+                       for name, (segName, dtype, shape) in spec.items()}
+
+    # This creates the columns: each value is either an array, which is copied into
+    # shared memory, or a (dtype, shape) pair, for a column initialised to zero
+    @classmethod
+    def create(cls, columns):
+        cleanup_stale()
+        spec = dict()
+        segments = dict()
+        try:
+            for name, col in columns.items():
+                if isinstance(col, np.ndarray):
+                    dtype, shape = col.dtype, col.shape
+                else:
+                    dtype, shape = np.dtype(col[0]), col[1]
+                    shape = shape if isinstance(shape, tuple) else (shape,)
+                if dtype == object:
+                    raise TypeError("Column {} cannot be placed in shared memory".format(name))
+                segName = "{}{}_{}".format(prefix, os.getpid(), secrets.token_hex(6))
+                size = max(1, int(np.prod(shape))*dtype.itemsize)
+                shm = shared_memory.SharedMemory(name=segName, create=True, size=size)
+                _owned[segName] = shm
+                segments[name] = shm
+                spec[name] = (segName, dtype.str, tuple(shape))
+                arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                if isinstance(col, np.ndarray):
+                    arr[...] = col
+                else:
+                    arr[...] = 0
+                del arr
+        except BaseException:
+            for shm in segments.values():
+                _unlink(shm.name)
+            raise
+        return cls(spec, segments, True)
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec, {name: _attach_segment(segName) for name, (segName, dtype, shape) in spec.items()},
+                  False)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    # The arrays must not be used after close; copy the results out before
+    def close(self):
+        self.arrays = dict()
+        for shm in self.segments.values():
+            if self.owner:
+                _unlink(shm.name)
+            else:
+                shm.close()
+        self.segments = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# This calls func(start, stop) on slices of range(size) of at most chunkSize items,
+# in jobs worker processes, and returns the results of the calls in order
+def run_slices(func, size, jobs, chunkSize=None):
+    if chunkSize is None:
+        chunkSize = max(1, -(-size//(4*jobs)))
+    starts = list(range(0, size, chunkSize))
+    stops = [min(size, s+chunkSize) for s in starts]
+    if jobs <= 1 or len(starts) <= 1:
+        return [func(start, stop) for start, stop in zip(starts, stops)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(func, starts, stops))
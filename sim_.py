@@ -2,6 +2,8 @@
 # -*- coding: UTF8 -*-
 
 import argparse
+import contextlib
+import functools
 import os.path
 import sys
 import random
@@ -9,134 +11,580 @@ import random
 import numpy as np
 
 from Aptamers import Aptamers
-from Selection import Selection
+from Selection import Selection, SelectionPipeline, SelectionStep
 from Distance import Distance
 from Amplification import Amplification
 from Mutation import Mutation
+from instrument import Instrument
+from foldcache import FoldCache
+from memmappool import MemmapPool
+from roundstats import RoundStats
+from roundwriter import NullWriter, RoundWriter
+import kernels
+import metrics
+import roundwriter
 import utils
 
 # Fetch experiment parameters from the settings file
 import configparser
 
 
-def main_sim(settings_file, postprocess_only):
-    settings = configparser.ConfigParser({"initial_samples": "100000",
-                                          "random_seed": "0",
-                                          "img_format": "pdf",
-                                          "pcr_bias": "0.1"},
+# This writes the sequence, distance and count of every sequence in the pool to outFile
+def write_round(outFile, seqPool, apt):
+    roundwriter.write_pool(outFile, apt, *roundwriter.snapshot(seqPool))
+
+
+# default values of the optional settings
+default_settings = {"initial_samples": "100000",
+                    "random_seed": "0",
+                    "img_format": "pdf",
+                    "pcr_bias": "0.1",
+                    "pool_mass": "0",
+                    "run_stats": "True",
+                    "trace_memory": "False",
+                    "fold_cache": "",
+                    "online_stats": "True",
+                    "top_k": "10",
+                    "write_queue": "2",
+                    "compression": "none",
+                    "compression_level": "",
+                    "sampling_mode": "multinomial",
+                    "pool_budget": "0",
+                    "tail_threshold": "1",
+                    "pool_storage": "memory",
+                    "pool_directory": "",
+                    "pool_chunk_size": "1000000",
+                    "jobs": "1",
+                    "shards": "1",
+                    "fold_backend": "vienna",
+                    "kernels": "auto",
+                    "energy_mode": "mfe",
+                    "energy_target": "",
+                    "energy_threshold": "2.0",
+                    "temperature": "37.0",
+                    "selection_model": "threshold",
+                    "kd_reference": "1000",
+                    "kd_factor": "2.0",
+                    "selection_steps": ""}
+
+# section of the settings file each parameter belongs to
+settings_sections = {"selex_type": "general",
+                     "aptamer_mode": "general",
+                     "reference_aptamer": "general",
+                     "sequence_length": "general",
+                     "random_seed": "general",
+                     "number_of_rounds": "general",
+                     "experiment_name": "general",
+                     "sampling_size": "general",
+                     "sampling_mode": "general",
+                     "post_process": "general",
+                     "img_format": "general",
+                     "run_stats": "general",
+                     "trace_memory": "general",
+                     "fold_cache": "general",
+                     "online_stats": "general",
+                     "top_k": "general",
+                     "write_queue": "general",
+                     "compression": "general",
+                     "compression_level": "general",
+                     "pool_budget": "general",
+                     "tail_threshold": "general",
+                     "pool_storage": "general",
+                     "pool_directory": "general",
+                     "pool_chunk_size": "general",
+                     "jobs": "general",
+                     "shards": "general",
+                     "fold_backend": "general",
+                     "kernels": "general",
+                     "initial_samples": "selectionparams",
+                     "scale": "selectionparams",
+                     "distance": "selectionparams",
+                     "stringency": "selectionparams",
+                     "energy_mode": "selectionparams",
+                     "energy_target": "selectionparams",
+                     "energy_threshold": "selectionparams",
+                     "temperature": "selectionparams",
+                     "selection_model": "selectionparams",
+                     "kd_reference": "selectionparams",
+                     "kd_factor": "selectionparams",
+                     "selection_steps": "selectionparams",
+                     "number_of_pcr": "amplificationparams",
+                     "pcr_efficiency": "amplificationparams",
+                     "pcr_error_rate": "amplificationparams",
+                     "pcr_bias": "amplificationparams",
+                     "pool_mass": "amplificationparams"}
+
+
+def read_settings(settings_file):
+    settings = configparser.ConfigParser(default_settings,
                                          inline_comment_prefixes=(';',))
     settings.read(settings_file)
+    return settings
+
+
+# This sets the given parameters in settings. Parameters are given by name, or as
+# section.name for parameters that are not listed in settings_sections. Unknown names
+# raise ValueError
+def override_settings(settings, params):
+    for name, value in params.items():
+        if '.' in name:
+            section, name = name.split('.', 1)
+        elif name in settings_sections:
+            section = settings_sections[name]
+        else:
+            raise ValueError("unknown parameter {}, parameters are {} (or section.name)".format(
+                name, ", ".join(sorted(settings_sections))))
+        if not settings.has_section(section):
+            settings.add_section(section)
+        settings.set(section, name, str(value))
+    return settings
+
+
+# the settings file shipped with the simulation
+base_settings = os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.init")
+
+
+# This returns settings read from a settings file, or made of the parameters of a dict (see
+# override_settings) on top of base_settings, with the parameters params overridden.
+# Settings objects are copied, so that the parameters can be overridden without changing them.
+def make_settings(settings, params=None):
+    if isinstance(settings, configparser.ConfigParser):
+        copy = configparser.ConfigParser(default_settings, inline_comment_prefixes=(';',))
+        copy.read_dict({section: dict(settings.items(section, raw=True)) for section in settings.sections()})
+        settings = copy
+    elif isinstance(settings, dict):
+        params = dict(settings, **(params or {}))
+        settings = read_settings(base_settings)
+    else:
+        settings = read_settings(settings)
+    return override_settings(settings, params or {})
+
+
+# files a simulation can write:
+#   rounds:   the pool of every round ([experiment_name]_R[round])
+#   samples:  the samples of every round ([experiment_name]_samples_R[round])
+#   stats:    the online statistics (see roundstats.py)
+#   runstats: the run stats (see instrument.py)
+outputs = ("rounds", "samples", "stats", "runstats")
+
 
-    if not settings.has_option("selectionparams", "initial_samples"):
-        print("No initial samples defined, using default")
-
-    aptamerType = settings.get('general', 'selex_type')
-    aptamerNum = settings.getint('general', 'aptamer_mode')
-    aptamerSeq = settings.get('general', 'reference_aptamer')
-    seqLength = settings.getint('general', 'sequence_length')
-    rng_seed = settings.getint('general', 'random_seed')
-    roundNum = settings.getint('general', 'number_of_rounds')
-    outputFileNames = settings.get('general', 'experiment_name')
-    # how many sampled sequence to output each round, stored in output_samples_Ri.txt
-    samplingSize = settings.getint('general', 'sampling_size')
-    post_process = settings.getboolean('general', 'post_process')
-    img_format = settings.get('general', 'img_format')
-
-    # how many sequence to select each round
-    initialSamples = settings.getint('selectionparams', 'initial_samples')
-    selectionThreshold = settings.getint('selectionparams', 'scale')
-    distanceMeasure = settings.get('selectionparams', 'distance')
-    stringency = settings.getint('selectionparams', 'stringency')
-
-    pcrCycleNum = settings.getint('amplificationparams', 'number_of_pcr')
-    pcrYield = settings.getfloat('amplificationparams', 'pcr_efficiency')
-    pcrErrorRate = settings.getfloat('amplificationparams', 'pcr_error_rate')
-    pcrBias = settings.getfloat('amplificationparams', 'pcr_bias')
-
-    def call_post_process(target):
+# This holds the parameters of a SELEX experiment, read from the settings, and the objects
+# used to simulate it
+class Experiment:
+    def __init__(self, settings):
+        if not settings.has_option("selectionparams", "initial_samples"):
+            print("No initial samples defined, using default")
+        self.settings = settings
+
+        self.aptamerType = settings.get('general', 'selex_type')
+        self.aptamerNum = settings.getint('general', 'aptamer_mode')
+        self.aptamerSeq = settings.get('general', 'reference_aptamer')
+        self.seqLength = settings.getint('general', 'sequence_length')
+        self.rng_seed = settings.getint('general', 'random_seed')
+        self.roundNum = settings.getint('general', 'number_of_rounds')
+        self.outputFileNames = settings.get('general', 'experiment_name')
+        # how many sampled sequence to output each round, stored in output_samples_Ri.txt
+        self.samplingSize = settings.getint('general', 'sampling_size')
+        # how the samples are drawn: multinomial, hypergeometric (without replacement) or choice
+        self.samplingMode = settings.get('general', 'sampling_mode')
+        self.post_process = settings.getboolean('general', 'post_process')
+        self.img_format = settings.get('general', 'img_format')
+        # per round and per stage timings, memory use and counters, stored in output_runstats.jsonl
+        self.run_stats = settings.getboolean('general', 'run_stats')
+        self.trace_memory = settings.getboolean('general', 'trace_memory')
+        # sqlite file caching structures and distances, can be shared between runs
+        self.fold_cache = settings.get('general', 'fold_cache')
+        # how secondary structures are predicted (see folding.py): vienna or stem
+        self.foldBackend = settings.get('general', 'fold_backend')
+        # implementation of the inner loops (see kernels.py): auto, numba or numpy
+        self.kernels = settings.get('general', 'kernels')
+        # per round statistics computed from the pool in memory, stored in output_stats.csv,
+        # output_dists.csv and, for the top_k most abundant sequences, output_topk.csv
+        self.online_stats = settings.getboolean('general', 'online_stats')
+        self.top_k = settings.getint('general', 'top_k')
+        # number of round files that can wait to be written in the background (0 to write
+        # them before going on with the next round)
+        self.write_queue = settings.getint('general', 'write_queue')
+        # compression of the round and samples files (none, gzip, xz or zstd), and its level
+        # (empty for the default level of the method)
+        self.compression = settings.get('general', 'compression')
+        level = settings.get('general', 'compression_level')
+        self.compressionLevel = int(level) if level else None
+        if self.compression not in utils.compressions:
+            raise ValueError("compression {} not supported, use one of {}".format(
+                             self.compression, ", ".join(utils.compressions)))
+        if self.compression == "zstd":
+            utils.zstandard_module()
+        # maximum number of entries in the pool (0 for no limit), and count at or below which
+        # sequences are merged first into per distance tail bins when the pool exceeds it
+        self.poolBudget = settings.getint('general', 'pool_budget')
+        self.tailThreshold = settings.getint('general', 'tail_threshold')
+        # storage of the pool: in memory, or on disk in memory-mapped files (memmap) inside
+        # pool_directory, processed pool_chunk_size entries at a time
+        self.poolStorage = settings.get('general', 'pool_storage')
+        self.poolDirectory = settings.get('general', 'pool_directory')
+        self.poolChunkSize = settings.getint('general', 'pool_chunk_size')
+        # number of processes for the parallel stages (distances of the initial library)
+        self.jobs = settings.getint('general', 'jobs')
+        # number of worker processes holding a part of the pool each (see sharded.py)
+        self.shards = settings.getint('general', 'shards')
+        if self.poolStorage not in ("memory", "memmap"):
+            raise ValueError("pool storage {} not supported, use memory or memmap".format(self.poolStorage))
+
+        # how many sequence to select each round
+        self.initialSamples = settings.getint('selectionparams', 'initial_samples')
+        self.selectionThreshold = settings.getint('selectionparams', 'scale')
+        self.distanceMeasure = settings.get('selectionparams', 'distance')
+        self.stringency = settings.getint('selectionparams', 'stringency')
+        # free energy model of the energy distance (see metrics.Energy)
+        self.metricOptions = dict(energyMode=settings.get('selectionparams', 'energy_mode'),
+                                  energyTarget=settings.get('selectionparams', 'energy_target'),
+                                  energyThreshold=settings.getfloat('selectionparams', 'energy_threshold'),
+                                  temperature=settings.getfloat('selectionparams', 'temperature'),
+                                  kdFactor=settings.getfloat('selectionparams', 'kd_factor'))
+        # threshold or equilibrium binding, with the dissociation constant of the references
+        self.selectionModel = settings.get('selectionparams', 'selection_model')
+        self.kdReference = settings.getfloat('selectionparams', 'kd_reference')
+        # positive and negative selection steps run before the selection of each round, each
+        # described by a section of the settings (see selection_pipeline)
+        self.selectionSteps = []
+        for name in settings.get('selectionparams', 'selection_steps').replace(',', ' ').split():
+            if not settings.has_section(name):
+                raise ValueError("selection step {} has no section in the settings".format(name))
+            stepType = settings.get(name, 'type', fallback='negative')
+            if stepType not in ("positive", "negative"):
+                raise ValueError("selection step type {} not supported, use positive or negative".format(stepType))
+            rounds = settings.get(name, 'rounds', fallback='').replace(',', ' ').split()
+            self.selectionSteps.append((name, stepType == "positive",
+                                        settings.get(name, 'reference_aptamer'),
+                                        settings.get(name, 'distance', fallback=self.distanceMeasure),
+                                        settings.getint(name, 'stringency', fallback=self.stringency),
+                                        tuple(int(r) for r in rounds)))
+
+        self.pcrCycleNum = settings.getint('amplificationparams', 'number_of_pcr')
+        self.pcrYield = settings.getfloat('amplificationparams', 'pcr_efficiency')
+        self.pcrErrorRate = settings.getfloat('amplificationparams', 'pcr_error_rate')
+        self.pcrBias = settings.getfloat('amplificationparams', 'pcr_bias')
+        # number of copies the pool is thinned to after amplification (0 to keep them all)
+        self.poolMass = settings.getint('amplificationparams', 'pool_mass')
+
+    def call_post_process(self, target):
         import postprocess
         print("Data post-processing has started...")
-        postprocess.dataAnalysis(seqLength, roundNum, outputFileNames, post_process, distanceMeasure, imgformat=img_format)
+        postprocess.dataAnalysis(self.seqLength, self.roundNum, self.outputFileNames, self.post_process,
+                                 self.distanceMeasure, imgformat=self.img_format, reuse=self.online_stats)
         # postprocess.dataAnalysis(seqLength, roundNum, "{}_samples".format(outputFileNames),
         #                          post_process, distanceMeasure, imgformat=img_format)
-        postprocess.plot_histo(roundNum, outputFileNames, target, "png", "hamming")
-        postprocess.plot_histo(roundNum, "{}_samples".format(outputFileNames), target, "png", "hamming")
+        postprocess.plot_histo(self.roundNum, self.outputFileNames, target, "png", "hamming",
+                               self.distanceMeasure, self.fold_cache, backend=self.foldBackend)
+        postprocess.plot_histo(self.roundNum, "{}_samples".format(self.outputFileNames), target, "png", "hamming",
+                               self.distanceMeasure, self.fold_cache, backend=self.foldBackend)
         print("Data post-processing is complete.")
         return
 
-    if postprocess_only:
-        call_post_process(aptamerSeq)
-        sys.exit()
+    # This instantiates the classes used by the simulation, seeds the random number
+    # generators and chooses the reference aptamer.
+    # The reference aptamer can be imposed (e.g. to share it between replicates), and the
+    # files written restricted to the given sinks (see outputs, all of them by default)
+    def setup(self, rng_seed=None, reference=None, sinks=None):
+        self.sinks = set(outputs if sinks is None else sinks)
+        if not self.sinks <= set(outputs):
+            raise ValueError("sinks must be among {}".format(", ".join(outputs)))
+        self.kernelName = kernels.use(self.kernels)
+        print("Kernels: {}".format(self.kernelName))
+        self.cache = FoldCache(self.fold_cache) if self.fold_cache else None
+        self.D = Distance(self.pcrBias, self.cache, self.foldBackend)
 
-    D = Distance(pcrBias)
-    S = Selection(distanceMeasure, selectionThreshold, initialSamples, samplingSize, stringency, D)
-
-    if rng_seed == 0:
-        rng_seed = random.randint(0, 2**32)
-    print("Random seed: {}".format(rng_seed))
-    random.seed(rng_seed)
-    np.random.seed(rng_seed)
-
-    # SELEX simulation based on random aptamer assignment, hamming-based definite selection, and
-    # non-ideal stochastic amplfication with no bias.
-    if(aptamerType == 'DNA'):
-        alphabetSet = 'ACGT'
-    elif(aptamerType == 'RNA'):
-        alphabetSet = 'ACGU'
-    else:
-        print("Error: Simulation of %.s aptamers not supported" % aptamerType)
-        sys.exit()
+        self.seed(self.rng_seed if rng_seed is None else rng_seed)
 
-    # Instantiating classes
-    Apt = Aptamers(alphabetSet, seqLength)
-    Amplify = Amplification()
+        # SELEX simulation based on random aptamer assignment, hamming-based definite selection, and
+        # non-ideal stochastic amplfication with no bias.
+        alphabetSet = self.alphabet()
 
-    # initialize Mutation object from class
-    mut = Mutation(D, seqLength=Apt.seqLength, errorRate=pcrErrorRate,
-                   pcrCycleNum=pcrCycleNum, pcrYld=pcrYield)
+        # Instantiating classes
+        self.Apt = Aptamers(alphabetSet, self.seqLength)
+        self.Amplify = Amplification()
+        if "rounds" in self.sinks or "samples" in self.sinks:
+            self.writer = RoundWriter(self.Apt, self.write_queue, self.compression, self.compressionLevel)
+        else:
+            self.writer = NullWriter()
+        # the samples are drawn whether or not they are written, so that the random streams
+        # do not depend on the sinks
+        self.sampleWriter = self.writer if "samples" in self.sinks else NullWriter()
+        self.S = Selection(self.distanceMeasure, self.selectionThreshold, self.initialSamples,
+                           self.samplingSize, self.stringency, self.D, self.sampleWriter, self.samplingMode,
+                           self.pool_factory(), self.jobs, self.metricOptions,
+                           self.selectionModel, self.kdReference,
+                           self.selection_pipeline(self.Apt, self.D))
 
-    if aptamerNum > 0:
-        aptamerSeqs, initialSeqNum = Apt.optimumAptamerGenerator(aptamerNum)
-    else:
-        aptamerSeqs = aptamerSeq
-        initialSeqNum = len(alphabetSet)**len(aptamerSeq)
-    if len(aptamerSeqs) > 1:
-        print("optimum sequences have been chosen: {}".format(aptamerSeqs))
-    else:
-        print("optimum sequence has been chosen: {}".format(aptamerSeqs))
-    assert len(aptamerSeq) == seqLength
-    print("seq length = "+str(seqLength))
+        # initialize Mutation object from class
+        self.mut = self.mutation(self.D, self.poolBudget)
+
+        # the reference aptamers are kept as a comma separated string (see utils.references)
+        if reference is not None:
+            self.aptamerSeqs = reference
+            self.initialSeqNum = len(alphabetSet)**self.seqLength
+        elif self.aptamerNum > 0:
+            self.aptamerSeqs, self.initialSeqNum = self.Apt.optimumAptamerGenerator(self.aptamerNum)
+        else:
+            self.aptamerSeqs = ",".join(utils.references(self.aptamerSeq))
+            self.initialSeqNum = len(alphabetSet)**self.seqLength
+        if len(utils.references(self.aptamerSeqs)) > 1:
+            print("optimum sequences have been chosen: {}".format(self.aptamerSeqs))
+        else:
+            print("optimum sequence has been chosen: {}".format(self.aptamerSeqs))
+        assert all(len(seq) == self.seqLength for seq in utils.references(self.aptamerSeqs))
+        print("seq length = "+str(self.seqLength))
+        runStats = self.run_stats and "runstats" in self.sinks
+        self.instr = Instrument(self.outputFileNames+"_runstats.jsonl" if runStats else None,
+                                self.trace_memory, {"kernels": self.kernelName})
+        onlineStats = self.online_stats and "stats" in self.sinks
+        self.roundStats = RoundStats(self.outputFileNames, self.Apt, self.top_k) if onlineStats else None
+
+    def alphabet(self):
+        if(self.aptamerType == 'DNA'):
+            return 'ACGT'
+        elif(self.aptamerType == 'RNA'):
+            return 'ACGU'
+        raise ValueError("Simulation of %s aptamers not supported" % self.aptamerType)
+
+    # This returns the function creating empty pools in the configured storage
+    def pool_factory(self):
+        if self.poolStorage == "memmap":
+            return functools.partial(MemmapPool, self.poolDirectory, self.poolChunkSize)
+        return dict
+
+    # This returns the selection steps (see Selection.SelectionPipeline), or None without steps
+    def selection_pipeline(self, apt, D):
+        if len(self.selectionSteps) == 0:
+            return None
+        steps = []
+        for name, positive, reference, distname, stringency, rounds in self.selectionSteps:
+            if any(len(seq) != self.seqLength for seq in utils.references(reference)):
+                raise ValueError("the reference aptamers of selection step {} must have length {}".format(
+                                 name, self.seqLength))
+            metric = metrics.create(distname, D, apt, **self.metricOptions).prepare(reference)
+            steps.append(SelectionStep(name, positive, metric, stringency, rounds))
+        return SelectionPipeline(steps, apt)
 
-    for r in range(roundNum+1):
+    def mutation(self, D, poolBudget):
+        return Mutation(D, seqLength=self.seqLength, errorRate=self.pcrErrorRate,
+                        pcrCycleNum=self.pcrCycleNum, pcrYld=self.pcrYield,
+                        poolBudget=poolBudget, tailThreshold=self.tailThreshold,
+                        metricOptions=self.metricOptions)
+
+    def seed(self, rng_seed):
+        if rng_seed == 0:
+            rng_seed = random.randint(0, 2**32)
+        print("Random seed: {}".format(rng_seed))
+        random.seed(rng_seed)
+        np.random.seed(rng_seed)
+        self.rng_seed = rng_seed
+
+    # This creates the initial library and samples it (round 0 selection)
+    def initial_library(self):
+        header = "Creating initial library"
+        print(header)
+        print("-"*len(header))
+        print("total number of sequences in initial library = "+str(self.initialSeqNum), flush=True)
+        with self.instr.stage(0, "selection") as st:
+            amplfdSeqs = self.S.stochasticSelection_initial(self.Apt, self.aptamerSeqs, self.initialSeqNum,
+                                                            self.outputFileNames, 0)
+            st["pool"] = amplfdSeqs
+        return amplfdSeqs
+
+    # This carries out the SELEX rounds, starting from the initial library slctdSeqs.
+    # Each round is written to file if writeRounds is set, and callback(r, amplfdSeqs)
+    # is called after the amplification of each round r.
+    def run(self, slctdSeqs=None, writeRounds=True, callback=None):
+        self.start(slctdSeqs)
+        while not self.done():
+            self.step(writeRounds, callback)
+        self.finish()
+        return self.pool
+
+    # The rounds can also be run one at a time: start() sets the initial library (created
+    # by the first step when slctdSeqs is None), each step() runs the next round and returns
+    # its pool, and finish() waits for the files and closes the outputs
+    def start(self, slctdSeqs=None):
+        self.pool = slctdSeqs
+        self.nextRound = 0
+
+    def done(self):
+        return self.nextRound > self.roundNum
+
+    def step(self, writeRounds=True, callback=None):
+        r = self.nextRound
         if(r == 0):
-            header = "Creating initial library"
-            print(header)
-            print("-"*len(header))
-            print("total number of sequences in initial library = "+str(initialSeqNum), flush=True)
-            amplfdSeqs = S.stochasticSelection_initial(Apt, aptamerSeqs, initialSeqNum, outputFileNames, r)
+            amplfdSeqs = self.initial_library() if self.pool is None else self.pool
         else:
             header = "SELEX Round "+str(r)+" has started"
             print(header)
             print("-"*len(header))
-            totalSeqNum, uniqSeqNum = utils.seqNumberCounter(amplfdSeqs)
+            totalSeqNum, uniqSeqNum = utils.seqNumberCounter(self.pool)
             print("total number of sequences in initial pool = "+str(totalSeqNum))
             print("total number of unique sequences in initial pool = "+str(int(uniqSeqNum)), flush=True)
-            amplfdSeqs = S.stochasticSelection(Apt, amplfdSeqs, outputFileNames, r)
+            with self.instr.stage(r, "selection") as st:
+                amplfdSeqs = self.S.stochasticSelection(self.Apt, self.pool, self.outputFileNames, r)
+                st["pool"] = amplfdSeqs
             print("Selection carried out for R"+str(r))
-        amplfdSeqs = Amplify.randomPCR_with_ErrorsAndBias(amplfdSeqs, mut, aptamerSeqs, Apt, distanceMeasure)
+        with self.instr.stage(r, "amplification") as st:
+            amplfdSeqs = self.Amplify.randomPCR_with_ErrorsAndBias(amplfdSeqs, self.mut, self.aptamerSeqs,
+                                                                   self.Apt, self.distanceMeasure)
+            if self.poolMass > 0:
+                lost = utils.thin_pool(amplfdSeqs, self.poolMass)
+                if lost > 0:
+                    print("{} sequences lost when thinning the pool to {} copies".format(lost, self.poolMass))
+            if self.poolBudget > 0:
+                pruned = utils.prune_pool(amplfdSeqs, self.poolBudget, self.tailThreshold)
+                if pruned > 0:
+                    print("{} sequences merged into tail bins".format(pruned))
+            st["pool"] = amplfdSeqs
         print("Amplification carried out for R"+str(r))
-        outFile = outputFileNames + "_R{:03d}".format(r)
-        nxtRnd = open(outFile, 'w')
-        print("writing R"+str(r)+" seqs to file")
-        for seqIdx in amplfdSeqs:
-            seq = Apt.pseudoAptamerGenerator(seqIdx)
-            # write seq, distance, and count for now
-            nxtRnd.write(str(seq)+'\t'+str(int(amplfdSeqs[seqIdx][1]))+'\t'+str(int(amplfdSeqs[seqIdx][0]))+'\n')
-        nxtRnd.close()
-    print("SELEX completed")
-
-    if post_process:
-        call_post_process(aptamerSeqs)
+        self.end_round(r, amplfdSeqs, writeRounds, callback)
+        return amplfdSeqs
+
+    # This passes the pool of round r to the callback, the statistics and the round file
+    def end_round(self, r, amplfdSeqs, writeRounds, callback):
+        if callback is not None:
+            callback(r, amplfdSeqs)
+        if self.roundStats is not None:
+            with self.instr.stage(r, "stats"):
+                self.roundStats.update(r, amplfdSeqs)
+        if writeRounds and "rounds" in self.sinks:
+            outFile = self.outputFileNames + "_R{:03d}".format(r)
+            with self.instr.stage(r, "write"):
+                print("writing R"+str(r)+" seqs to file")
+                self.writer.write(outFile, amplfdSeqs)
+        self.pool = amplfdSeqs
+        self.nextRound = r+1
+
+    def finish(self):
+        # wait for the files still being written
+        with self.instr.stage(self.roundNum, "flush"):
+            self.writer.flush()
+        self.close()
+        print("SELEX completed")
+
+    def close(self):
+        self.writer.close()
+        self.instr.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+# A SELEX simulation that can be embedded in other programs. It is built from a settings
+# object, a settings file or a dict of parameters (see make_settings), and its rounds are
+# run all at once with run(), or one at a time with step() or by iterating over it:
+#     sim = SelexSimulation({"number_of_rounds": 5, "distance": "hamming"}, callbacks=[func])
+#     for r in sim:
+#         idx, data = sim.arrays()
+# Every callback is called as callback(r, idx, data) after the amplification of each round
+# r, with the indices and the (count, distance, bias) rows of the pool (see
+# utils.pool_arrays). No file is written unless sinks lists some of the outputs, and the
+# progress messages are only printed when verbose is set.
+class SelexSimulation:
+    def __init__(self, settings, params=None, callbacks=(), sinks=(), verbose=False,
+                 seed=None, reference=None):
+        settings = make_settings(settings, params)
+        self.callbacks = list(callbacks)
+        self.verbose = verbose
+        self.devnull = None if verbose else open(os.devnull, "w")
+        with self.output():
+            if settings.getint('general', 'shards') > 1:
+                from sharded import ShardedExperiment
+                self.exp = ShardedExperiment(settings)
+            else:
+                self.exp = Experiment(settings)
+            self.exp.setup(seed, reference, sinks)
+            self.exp.start()
+        self.finished = False
+
+    def output(self):
+        if self.devnull is None:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(self.devnull)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def done(self):
+        return self.exp.done()
+
+    # This runs the next round and returns its number
+    def step(self):
+        if self.done():
+            raise ValueError("all the {} rounds have been run".format(self.exp.roundNum))
+        r = self.exp.nextRound
+        # the callbacks write to the stdout of the caller
+        self.stdout = sys.stdout
+        with self.output():
+            self.exp.step(callback=self.call if self.callbacks else None)
+            if self.done():
+                self.close()
+        return r
+
+    def call(self, r, pool):
+        idx, data = utils.pool_arrays(pool)
+        with contextlib.redirect_stdout(self.stdout):
+            for callback in self.callbacks:
+                callback(r, idx, data)
+
+    def __iter__(self):
+        while not self.done():
+            yield self.step()
+
+    # This runs the remaining rounds and returns the arrays of the final pool
+    def run(self):
+        for r in self:
+            pass
+        return self.arrays()
+
+    # This returns the indices and the (count, distance, bias) rows of the current pool
+    def arrays(self):
+        return utils.pool_arrays(self.exp.pool)
+
+    def sequences(self, idx):
+        return self.exp.Apt.pseudoAptamerGenerator_batch(idx)
+
+    # the run stats of every stage of the rounds run so far (see instrument.py)
+    @property
+    def stats(self):
+        return self.exp.instr.records
+
+    # This waits for the files still being written and closes the outputs (the rounds left
+    # cannot be run afterwards)
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.exp.nextRound = self.exp.roundNum+1
+            with self.output():
+                self.exp.finish()
+            if self.devnull is not None:
+                self.devnull.close()
+                self.devnull = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main_sim(settings_file, postprocess_only):
+    settings = read_settings(settings_file)
+    if postprocess_only:
+        exp = Experiment(settings)
+        exp.call_post_process(exp.aptamerSeq)
+        return
+
+    sim = SelexSimulation(settings, sinks=outputs, verbose=True)
+    sim.run()
+    exp = sim.exp
+
+    if exp.post_process:
+        exp.call_post_process(exp.aptamerSeqs)
         print("The simulation has ended.")
     else:
         print("The simulation has ended without post-processing.")
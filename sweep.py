@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+# -*- coding: UTF8 -*-
+
+# Parameter sweep runner.
+#
+# Usage:
+#     python sweep.py -s settings.init -g grid.json -o sweep -j 8 --retries 1
+#
+# grid.json is either a dict mapping parameter names to lists of values, whose
+# cartesian product is simulated, or a list of dicts giving the parameters of each run:
+#     {"stringency": [-3, 0], "scale": [1000, 10000], "random_seed": [1, 2, 3]}
+# Parameters are named as in the settings file (see sim_.settings_sections), or
+# section.name for other ones.
+#
+# Each run is simulated by sim_.py in its own process, in [output]/runXXXX, with at most
+# --jobs runs at a time. All runs share the same fold cache (an sqlite file, see
+# foldcache.FoldCache) so sequences folded by one run are not refolded by the others.
+# Failed runs are retried --retries times and then skipped. One JSON line per finished
+# run, with its parameters, status and run stats summary, is appended to
+# [output]/sweep_index.jsonl; with --resume, runs that already succeeded are skipped.
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import sim_
+from instrument import read_stats, hit_rates
+
+sim_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim_.py")
+
+# experiment name of the runs, inside their own directories
+run_name = "run"
+
+
+# This returns the list of the parameters of each run of the grid
+def expand_grid(grid):
+    if isinstance(grid, list):
+        return grid
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[n] for n in names])]
+
+
+# This writes the settings file of a single run in runDir and returns its name
+def write_run_settings(baseSettings, runDir, params):
+    settings = sim_.read_settings(baseSettings)
+    overrides = {"experiment_name": run_name,
+                 "post_process": False,
+                 "run_stats": True}
+    overrides.update(params)
+    sim_.override_settings(settings, overrides)
+    os.makedirs(runDir, exist_ok=True)
+    settingsFile = os.path.join(runDir, "settings.init")
+    with open(settingsFile, 'w') as f:
+        settings.write(f)
+    return settingsFile
+
+
+# This runs the simulation set up in runDir and returns its status and wall time
+def run_simulation(runDir, timeout=None):
+    t0 = time.perf_counter()
+    with open(os.path.join(runDir, "log"), 'w') as log:
+        try:
+            proc = subprocess.run([sys.executable, sim_script, "-s", "settings.init"],
+                                  cwd=runDir, stdout=log, stderr=subprocess.STDOUT, timeout=timeout)
+            status = "ok" if proc.returncode == 0 else "failed"
+        except subprocess.TimeoutExpired:
+            status = "timeout"
+    return status, time.perf_counter() - t0
+
+
+# This summarises the run stats file of a run
+def run_summary(runDir):
+    statsFile = os.path.join(runDir, run_name+"_runstats.jsonl")
+    if not os.path.exists(statsFile):
+        return dict()
+    records = read_stats(statsFile)
+    if len(records) == 0:
+        return dict()
+    counters = dict()
+    for rec in records:
+        for k, v in rec["counters"].items():
+            counters[k] = counters.get(k, 0) + v
+    rounds = set(rec["round"] for rec in records)
+    summary = {"rounds": len(rounds),
+               "sim_time": sum(rec["wall_time"] for rec in records),
+               "peak_rss": max(rec["peak_rss"] for rec in records),
+               "final_unique": [rec["unique"] for rec in records if "unique" in rec][-1],
+               "folds": counters.get("folds", 0)}
+    summary["time_per_round"] = summary["sim_time"]/len(rounds)
+    summary.update(hit_rates(counters))
+    return summary
+
+
+class Sweep:
+    def __init__(self, baseSettings, outDir, jobs=1, retries=0, timeout=None, cache=None):
+        self.baseSettings = baseSettings
+        self.outDir = outDir
+        self.jobs = jobs
+        self.retries = retries
+        self.timeout = timeout
+        self.cache = os.path.abspath(cache or os.path.join(outDir, "fold_cache.sqlite"))
+        self.indexFile = os.path.join(outDir, "sweep_index.jsonl")
+        self.lock = threading.Lock()
+
+    # This returns the ids of the runs that already succeeded
+    def completed(self):
+        done = set()
+        if os.path.exists(self.indexFile):
+            for rec in read_stats(self.indexFile):
+                if rec["status"] == "ok":
+                    done.add(rec["run"])
+        return done
+
+    def run_one(self, runId, params):
+        runDir = os.path.join(self.outDir, runId)
+        runParams = {"fold_cache": self.cache}
+        runParams.update(params)
+        write_run_settings(self.baseSettings, runDir, runParams)
+        for attempt in range(self.retries+1):
+            status, wall = run_simulation(runDir, self.timeout)
+            if status == "ok":
+                break
+        rec = {"run": runId, "params": params, "status": status, "attempts": attempt+1, "wall_time": wall}
+        rec.update(run_summary(runDir))
+        with self.lock:
+            with open(self.indexFile, 'a') as f:
+                f.write(json.dumps(rec)+'\n')
+        return rec
+
+    def run(self, grid, resume=False):
+        os.makedirs(self.outDir, exist_ok=True)
+        runs = [("run{:04d}".format(i), params) for i, params in enumerate(expand_grid(grid))]
+        if resume:
+            done = self.completed()
+            runs = [(runId, params) for runId, params in runs if runId not in done]
+        elif os.path.exists(self.indexFile):
+            os.remove(self.indexFile)
+        print("Running {} simulations, {} at a time".format(len(runs), self.jobs), flush=True)
+        records = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(self.run_one, runId, params) for runId, params in runs]
+            for n, future in enumerate(as_completed(futures)):
+                rec = future.result()
+                records.append(rec)
+                print("[{}/{}] {} {}: {} after {} attempt(s), {:.1f} s".format(
+                      n+1, len(runs), rec["run"], rec["params"], rec["status"],
+                      rec["attempts"], rec["wall_time"]), flush=True)
+        failed = [rec["run"] for rec in records if rec["status"] != "ok"]
+        if failed:
+            print("{} run(s) failed: {}".format(len(failed), ", ".join(sorted(failed))))
+        print("Sweep index written to {}".format(self.indexFile))
+        return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the simulation over a parameter grid.')
+    parser.add_argument('-s', '--settings', type=str, default="settings.init", help="base settings file")
+    parser.add_argument('-g', '--grid', type=str, required=True, help="JSON file with the parameter grid")
+    parser.add_argument('-o', '--output', type=str, default="sweep", help="output directory")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="number of simultaneous runs")
+    parser.add_argument('--retries', type=int, default=0, help="number of retries of failed runs")
+    parser.add_argument('-t', '--timeout', type=float, default=None, help="time limit per run (s)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="shared fold cache file (default: [output]/fold_cache.sqlite)")
+    parser.add_argument('--resume', action='store_true', help="skip the runs that already succeeded")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.settings):
+        print("Settings file '{}' does not exists, aborting.".format(args.settings))
+        sys.exit()
+    with open(args.grid, 'r') as g:
+        grid = json.load(g)
+    Sweep(args.settings, args.output, jobs=args.jobs, retries=args.retries,
+          timeout=args.timeout, cache=args.cache).run(grid, resume=args.resume)
@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+
+from memmappool import MemmapPool
+
+
+def assert_same(pool, ref):
+    assert len(pool) == len(ref)
+    assert sorted(pool) == sorted(ref)
+    for k, v in ref.items():
+        assert k in pool
+        assert (pool[k] == v).all()
+    idx, data = pool.arrays()
+    assert sorted(idx.tolist()) == sorted(ref)
+    for k, row in zip(idx.tolist(), data):
+        assert (row == ref[k]).all()
+
+
+# A memory-mapped pool and a dict go through the same 20000 random operations (insertions,
+# in place updates, deletions, reinsertions of deleted entries, count resets and removal of
+# zero counts), with a small chunk size so that the delta is merged into the base often
+def test_memmap_pool_matches_dict(tmp_path):
+    rng = random.Random(11)
+    pool = MemmapPool(str(tmp_path), chunkSize=16)
+    ref = dict()
+    keys = list(range(-5, 200)) + [2**62, 2**63-1, -2**63]
+    for step in range(20000):
+        op = rng.random()
+        k = rng.choice(keys)
+        if op < 0.35:
+            row = np.array([rng.randint(0, 9), rng.randint(0, 20), rng.random()])
+            pool[k] = row
+            ref[k] = row.copy()
+        elif op < 0.6:
+            if k in ref:
+                n = rng.randint(1, 5)
+                pool[k][0] += n
+                ref[k][0] += n
+            else:
+                assert k not in pool
+        elif op < 0.8:
+            if k in ref:
+                del pool[k]
+                del ref[k]
+            else:
+                assert k not in pool
+        elif op < 0.81:
+            pool.reset_counts()
+            for v in ref.values():
+                v[0] = 0
+        elif op < 0.83:
+            pool.remove_zero()
+            for z in [z for z, v in ref.items() if v[0] == 0]:
+                del ref[z]
+        elif op < 0.835:
+            pool.merge()
+        if step % 500 == 0:
+            assert_same(pool, ref)
+    assert_same(pool, ref)
+    pool.close()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,33 @@
+import random
+
+import numpy as np
+
+import instrument
+import utils
+from Aptamers import Aptamers
+from Distance import Distance
+from Mutation import Mutation
+
+
+# The sequences of the previous pool cannot be pruned during mutation, so a previous pool
+# larger than the budget must not trigger a prune after every sequence
+def test_prune_calls_per_round(monkeypatch):
+    random.seed(1)
+    np.random.seed(1)
+    budget = 50
+    apt = Aptamers("ACGT", 20)
+    mut = Mutation(Distance(backend="stem"), seqLength=20, errorRate=0.01, pcrCycleNum=3, pcrYld=0.85,
+                   poolBudget=budget)
+    idx = np.unique(np.random.randint(0, 4**20, size=1000))
+    pool = {int(k): np.array([5.0, 10.0, 0.0]) for k in idx}
+    calls = []
+    prune_pool = utils.prune_pool
+    monkeypatch.setattr(utils, "prune_pool", lambda *args: calls.append(1) or prune_pool(*args))
+    c0 = instrument.snapshot()
+    mut.generate_mutants_new(pool, apt.pseudoAptamerGenerator(0), apt, "hamming")
+    delta = instrument.snapshot()
+    delta.subtract(c0)
+    assert delta["new_mutants"] > 10*budget
+    assert 0 < len(calls) <= delta["new_mutants"]/budget + 1
+    # the new mutants are kept within twice the budget
+    assert len(pool) - len(idx) <= 2*budget + 21
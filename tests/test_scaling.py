@@ -0,0 +1,8 @@
+from bench.scaling import reference_of_length
+
+
+def test_reference_of_length_resizes_every_reference():
+    refs = reference_of_length("GTACGACAGTCATCCTACAC, ACGTTG", 25).split(",")
+    assert [len(ref) for ref in refs] == [25, 25]
+    assert refs[0].startswith("GTACGACAGTCATCCTACAC") and refs[1].startswith("ACGTTGACGTTG")
+    assert reference_of_length("GTACGACAGTCATCCTACAC", 8) == "GTACGACA"
@@ -0,0 +1,33 @@
+import numpy as np
+
+from sim_ import SelexSimulation
+
+seeds = range(1, 17)
+rounds = 2
+params = {"distance": "hamming", "number_of_rounds": rounds, "initial_samples": 2000, "scale": 200,
+          "sampling_size": 100, "number_of_pcr": 10, "pool_mass": 5*10**5}
+
+
+# This returns the total and unique numbers of sequences and the weighted average distance
+# of every round of a simulation, as an array of shape (rounds+1, 3)
+def round_stats(seed, shards):
+    stats = []
+
+    def record(r, idx, data):
+        counts = data[:, 0]
+        stats.append((counts.sum(), len(idx), np.dot(counts, data[:, 1])/counts.sum()))
+
+    SelexSimulation(dict(params, random_seed=seed, shards=shards), callbacks=[record]).run()
+    return np.array(stats)
+
+
+# The sharded engine follows the same distribution as the single process engine: over
+# 16 seeds, the mean of every statistic of every round agrees within sampling error.
+# The pool is thinned (across the shards) in every round. pool_budget is left out, as it is
+# split between the shards, which prune their own sequences.
+def test_sharded_matches_single_process():
+    single = np.array([round_stats(seed, 1) for seed in seeds])
+    sharded = np.array([round_stats(seed, 2) for seed in seeds])
+    se = np.sqrt((single.var(axis=0, ddof=1) + sharded.var(axis=0, ddof=1))/len(seeds))
+    diff = np.abs(single.mean(axis=0) - sharded.mean(axis=0))
+    assert (diff <= 4*se + 1e-9*np.abs(single.mean(axis=0))).all(), (single.mean(axis=0), sharded.mean(axis=0))
@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the initial library of a loop distance simulation, whose distances are computed by two
+# worker processes attached to the library in shared memory
+script = textwrap.dedent("""
+    import os, sys
+    sys.path.insert(0, {root!r})
+    from sim_ import SelexSimulation
+    sim = SelexSimulation({{"distance": "loop", "fold_backend": "stem", "jobs": 2, "number_of_rounds": 1,
+                           "initial_samples": 2000, "scale": 200, "sampling_size": 100, "random_seed": 7}})
+    sim.run()
+    print(os.getpid())
+""")
+
+
+def test_jobs_stage_leaves_no_segment(tmp_path):
+    proc = subprocess.run([sys.executable, "-c", script.format(root=root)], cwd=tmp_path,
+                          capture_output=True, text=True, timeout=600)
+    assert proc.returncode == 0, proc.stderr
+    # the resource tracker reports unregistered or leaked segments on stderr
+    assert "Traceback" not in proc.stderr and "leaked" not in proc.stderr, proc.stderr
+    pid = proc.stdout.split()[-1]
+    if os.path.isdir("/dev/shm"):
+        assert [name for name in os.listdir("/dev/shm") if name.startswith("selex_{}_".format(pid))] == []
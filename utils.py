@@ -1,8 +1,13 @@
+import gzip
+import lzma
+import os
 import random
 from math import factorial
 import numpy as np
 import numpy.random as nr
 
+import instrument
+
 
 def seqNumberCounter(seqPool):
     totalSeqNum = int(0)
@@ -19,6 +24,14 @@ def binomCoeff(n, k):
     return binom
 
 
+# This returns the list of reference aptamers given as a comma separated string (the form
+# they take in the settings file and in Experiment.aptamerSeqs) or as a list
+def references(aptamerSeqs):
+    if isinstance(aptamerSeqs, str):
+        return [seq.strip() for seq in aptamerSeqs.split(',')]
+    return [str(seq) for seq in aptamerSeqs]
+
+
 # This finds the loop region in a given sequence
 def apt_loopFinder(apt_seq, apt_struct, seqLength):
     base = None
@@ -57,17 +70,182 @@ def apt_loopFinder(apt_seq, apt_struct, seqLength):
 
 class rv_int():
     def __init__(self, seqPool, distName):
-        self.si = list(seqPool)
-        self.probas = np.array([seqPool[i][0] for i in self.si], dtype=np.float64)
+        if hasattr(seqPool, "arrays"):
+            self.si, data = seqPool.arrays()
+            self.probas = data[:, 0].copy()
+        else:
+            self.si = list(seqPool)
+            self.probas = np.array([seqPool[i][0] for i in self.si], dtype=np.float64)
         npb = self.probas[self.probas < -0.1]
         if len(npb) > 0:
             print("ERROR", npb)
         self.probas[self.probas < 0] = 0
+        self.counts = self.probas.copy()
         self.probas /= self.probas.sum()
 
     def rvs(self, size=1):
+        instrument.count("rng_draws", size)
         return nr.choice(self.si, p=self.probas, size=size)
 
+    # This draws size positions in si, with the same random numbers as rvs
+    def positions(self, size=1):
+        instrument.count("rng_draws", size)
+        return nr.choice(len(self.probas), p=self.probas, size=size)
+
+    # This draws size indices with replacement as a single multinomial draw over the
+    # pool and returns the drawn indices with their counts
+    def multinomial(self, size):
+        instrument.count("rng_draws", len(self.probas))
+        N = nr.multinomial(size, self.probas)
+        return self.sparse(N)
+
+    # This draws size sequences without replacement from the pool counts (multivariate
+    # hypergeometric draw), i.e. at most the count of each sequence, and returns the drawn
+    # indices with their counts. The whole pool is returned when size exceeds its total.
+    # Generator is seeded from the global random state to stay reproducible.
+    def hypergeometric(self, size):
+        instrument.count("rng_draws", len(self.probas))
+        counts = self.counts.astype(np.int64)
+        size = min(size, int(counts.sum()))
+        rng = np.random.default_rng(nr.randint(0, 2**32, dtype=np.uint64))
+        N = rng.multivariate_hypergeometric(counts, size, method="marginals")
+        return self.sparse(N)
+
+    def sparse(self, N):
+        nz = np.flatnonzero(N)
+        return np.asarray(self.si)[nz], N[nz]
+
+
+# This converts sequence indices to an array of unsigned 64 bit integers when they fit,
+# of signed 64 bit integers when there are tail bins (negative indices), and of python
+# integers otherwise
+def index_array(keys):
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    lo, hi = min(keys), max(keys)
+    if lo >= 0 and hi < 2**64:
+        return np.array(keys, dtype=np.uint64)
+    if lo >= -2**63 and hi < 2**63:
+        return np.array(keys, dtype=np.int64)
+    return np.array([int(k) for k in keys], dtype=object)
+
+
+# This returns the indices (see index_array) and the [count, distance, bias] rows of
+# the entries of a pool, as arrays in memory. Pools stored on disk (memmappool.MemmapPool)
+# read them chunk by chunk
+def pool_arrays(seqPool):
+    if hasattr(seqPool, "arrays"):
+        return seqPool.arrays()
+    keys = list(seqPool)
+    return index_array(keys), np.array([seqPool[k] for k in keys]).reshape(-1, 3)
+
+
+# This saves a pool to a .npz file, with the indices converted by index_array
+def save_pool(fileName, seqPool, **extra):
+    idx, data = pool_arrays(seqPool)
+    np.savez(fileName, idx=idx, data=data, **extra)
+
+
+# This loads a pool saved by save_pool, and returns it with the extra arrays saved with it
+def load_pool(fileName):
+    with np.load(fileName, allow_pickle=True) as f:
+        seqPool = {int(k): row.copy() for k, row in zip(f["idx"], f["data"])}
+        extra = {k: f[k] for k in f.files if k not in ("idx", "data")}
+    return seqPool, extra
+
+
+# Tail bins: sequences of low abundance can be merged (see prune_pool) into a single
+# entry per distance, with a negative index, which keeps their total count, their distance
+# and their count-weighted average bias. Tail bins are amplified and selected like other
+# entries but are not mutated, and are written with a sequence of N's.
+# Distances can be negative (e.g. the energy scores of sequences more stable than the
+# references), so they are interleaved (0, -1, 1, -2, ...) before being turned into
+# indices below -1.
+def tail_key(dist):
+    dist = int(dist)
+    return -(2*dist if dist >= 0 else -2*dist-1)-2
+
+
+def is_tail(seqIdx):
+    return seqIdx < 0
+
+
+# This merges entries of the pool into tail bins when the pool holds more than maxSize
+# entries: first the entries with a count of at most threshold, then the least abundant
+# ones until the pool fits in maxSize (when possible). Entries whose index is in
+# protected are kept. It returns the number of merged entries.
+def prune_pool(seqPool, maxSize, threshold=1, protected=()):
+    if len(seqPool) <= maxSize:
+        return 0
+    keys = [k for k in seqPool if k >= 0 and k not in protected]
+    data = np.array([seqPool[k] for k in keys]).reshape(-1, 3)
+    counts = data[:, 0]
+    merged = np.flatnonzero(counts <= threshold)
+    # number of entries to merge, allowing for the tail bins that may be created
+    newBins = sum(1 for d in np.unique(data[:, 1]) if tail_key(d) not in seqPool)
+    excess = min(len(keys), len(seqPool) - maxSize + newBins)
+    if len(merged) < excess:
+        merged = np.argsort(counts, kind="stable")[:excess]
+    for i in merged:
+        count, dist, bias = seqPool.pop(keys[i])
+        tk = tail_key(dist)
+        assert is_tail(tk)
+        if tk in seqPool:
+            b = seqPool[tk]
+            if b[0]+count > 0:
+                b[2] = (b[2]*b[0]+bias*count)/(b[0]+count)
+            b[0] += count
+        else:
+            seqPool[tk] = np.array([count, dist, bias])
+    instrument.count("pruned", len(merged))
+    return len(merged)
+
+
+# Counts are kept in the float64 rows of the pool, which hold integers exactly up to
+# maxCount. Amplification computes them with python integers, checks that they stay in
+# this range (add_count) and never removes more copies than an entry holds (remove_count).
+# The pool can be kept well below it with pool_mass (see thin_pool).
+maxCount = 2**53
+
+
+# This adds n copies to the count of a pool entry (row)
+def add_count(row, n):
+    count = int(row[0]) + int(n)
+    if count > maxCount:
+        raise OverflowError("sequence count {} cannot be stored exactly (maximum {}), set pool_mass "
+                            "or reduce number_of_pcr".format(count, maxCount))
+    row[0] = count
+
+
+# This removes n copies from the count of a pool entry (row), or all of its copies when it
+# holds fewer, and returns the number of copies removed
+def remove_count(row, n):
+    removed = min(max(int(row[0]), 0), int(n))
+    row[0] = int(row[0]) - removed
+    return removed
+
+
+# This thins the pool to about mass copies, as when an aliquot of the pcr product is taken:
+# a binomial fraction mass/total of the copies of every entry is kept, where total is the
+# count of the pool (of all the shards for a sharded pool), computed when not given.
+# Nothing is done when the pool holds at most mass copies. Entries left without copies are
+# removed, and their number is returned.
+def thin_pool(seqPool, mass, total=None):
+    idx, data = pool_arrays(seqPool)
+    counts = np.maximum(data[:, 0], 0).astype(np.int64)
+    if total is None:
+        total = int(counts.sum())
+    if total <= mass:
+        return 0
+    counts = nr.binomial(counts, mass/total)
+    instrument.count("rng_draws", len(counts))
+    for seqIdx, n in zip(idx.tolist(), counts.tolist()):
+        if n > 0:
+            seqPool[seqIdx][0] = n
+        else:
+            del seqPool[seqIdx]
+    return int((counts == 0).sum())
+
 
 def batch_size(size, Nbatch):
     i = 0
@@ -80,4 +258,57 @@ def batch_size(size, Nbatch):
 
 # long random numbers, via random
 def randint(a, b, size=1):
+    instrument.count("rng_draws", size)
     return np.array([random.randint(a, b) for i in range(size)])
+
+
+# compression methods of the round and samples files, with the suffix they add to the
+# file names and their default compression level
+compressions = {"none": "", "gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+default_levels = {"gzip": 1, "xz": 1, "zstd": 3}
+
+
+# zstd compression needs the optional zstandard package
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+# This opens fileName in text mode ('r', 'w' or 'a'), through the given compression
+def open_compressed(fileName, compression="none", mode='r', level=None):
+    if level is None:
+        level = default_levels.get(compression)
+    if compression == "none":
+        return open(fileName, mode)
+    elif compression == "gzip":
+        if mode == 'r':
+            return gzip.open(fileName, 'rt')
+        return gzip.open(fileName, mode+'t', compresslevel=level)
+    elif compression == "xz":
+        if mode == 'r':
+            return lzma.open(fileName, 'rt')
+        return lzma.open(fileName, mode+'t', preset=level)
+    elif compression == "zstd":
+        zstandard = zstandard_module()
+        if mode == 'r':
+            return zstandard.open(fileName, 'rt')
+        return zstandard.open(fileName, mode+'t', cctx=zstandard.ZstdCompressor(level=level))
+    raise ValueError("Unknown compression '{}', expected one of {}".format(compression, ", ".join(compressions)))
+
+
+# This returns the name under which a round or samples file was written, i.e. fileName
+# followed by the suffix of its compression, and the compression
+def round_file(fileName):
+    for compression, suffix in compressions.items():
+        if os.path.exists(fileName+suffix):
+            return fileName+suffix, compression
+    raise FileNotFoundError("No round file {}[{}]".format(fileName, "|".join(compressions.values())))
+
+
+# This opens a round or samples file for reading, whatever its compression
+def open_round(fileName):
+    path, compression = round_file(fileName)
+    return open_compressed(path, compression)